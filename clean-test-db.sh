@@ -2,16 +2,31 @@
 
 set -e  # Exit on failure
 
-if [ $# -ne 1 ] || ! { [ "$1" = "ada" ] || [ "$1" = "sci" ] || [ "$1" = "both" ]; } ; then
-  echo "Delete the test database Docker volumes and recreate them empty."
-  echo "Usage: clean-test-db.sh [both|ada|sci]"
+if [ $# -lt 1 ] || [ $# -gt 2 ] || ! { [ "$1" = "ada" ] || [ "$1" = "sci" ] || [ "$1" = "both" ]; } ; then
+  echo "Delete the test database Docker volumes and recreate them empty, or from a snapshot taken by deploy.py."
+  echo "Usage: clean-test-db.sh [both|ada|sci] [SNAPSHOT_TAR]"
   exit 1
 fi
 
+SNAPSHOT=$2
+if [ -n "$SNAPSHOT" ] && [ "$1" = "both" ] ; then
+  echo "A snapshot can only be restored for one site at a time."
+  exit 1
+fi
+
+recreate_volume() {
+  docker volume rm $1 && docker volume create $1
+  if [ -n "$SNAPSHOT" ] ; then
+    # The postgres image is already present for the test database, and has tar:
+    docker run --rm -v $1:/to -v "$(cd "$(dirname "$SNAPSHOT")" && pwd)":/from:ro --entrypoint tar postgres:16 \
+      -C /to -xf "/from/$(basename "$SNAPSHOT")"
+  fi
+}
+
 if [ "$1" = "sci" ] || [ "$1" = "both" ] ; then
-    docker volume rm sci-pg-test && docker volume create sci-pg-test
+    recreate_volume sci-pg-test
 fi
 
 if [ "$1" = "ada" ] || [ "$1" = "both" ] ; then
-    docker volume rm ada-pg-test && docker volume create ada-pg-test
+    recreate_volume ada-pg-test
 fi
@@ -3,14 +3,42 @@
 
 # TODO eliminate differences between test and live - ETL, DB fresh build vs DB migration
 import argparse
+import asyncio
+import codecs
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import http.client
+import io
+import json
+import math
+import os
 import re
+import selectors
+import socket
+import ssl
 import subprocess
 import sys
 import getpass
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Union
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the script is only used to print the commands to run:
+    fcntl = None
+
 # Global flag, whether commands should be executed by this script or not
 EXEC = False
+# Global flag, whether the operator is there to answer questions. When not, commands are run without confirmation and
+# anything which would need an answer fails the step instead.
+INTERACTIVE = True
 DOCKER_REPO = "ghcr.io/isaacphysics"
 
 class Site(object):
@@ -20,6 +48,468 @@ class Site(object):
     BOTH = 'both'
 
 
+# Matches the container names created by the compose scripts, e.g. sci-app-live-v1.2.3, ada-pg-test, sci-renderer or
+# ada-etl-v3.4.5 (ETL containers are named for their API version and have no env):
+CONTAINER_NAME_REGEX = re.compile(r'^(?P<site>ada|phy|sci)-(?P<role>app|api|pg|renderer|etl)'
+                                  r'(?:-(?P<env>test|staging|dev|live|etl))?(?:-(?P<version>.+))?$')
+
+
+class InventoryUnavailable(Exception):
+    pass
+
+
+class _UnixSocketHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self._socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+
+def docker_socket_path():
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return '/var/run/docker.sock'
+
+
+class DockerInventory(object):
+    """A snapshot of the containers, volumes and images on this host, read from the Docker Engine API in one go so
+    that lookups don't each need a docker CLI call. The snapshot is taken lazily and thrown away by invalidate(), which
+    should be called after anything that might change what is running."""
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or docker_socket_path()
+        self._lock = threading.RLock()
+        self._snapshot = None
+
+    def _get(self, path, query=None):
+        connection = _UnixSocketHTTPConnection(self.socket_path)
+        try:
+            connection.request('GET', path + ('?' + urllib.parse.urlencode(query) if query else ''))
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise InventoryUnavailable(f"Could not query the Docker Engine API at {self.socket_path}: {e}")
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise InventoryUnavailable(f"Docker Engine API returned {response.status} for {path}: {body[:200]!r}")
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise InventoryUnavailable(f"Docker Engine API returned a response for {path} which isn't JSON ({e}): {body[:200]!r}")
+
+    def _take_snapshot(self):
+        containers = {}
+        for container in self._get('/containers/json', {'all': 'true'}):
+            for name in container.get('Names') or []:
+                name = name.lstrip('/')
+                match = CONTAINER_NAME_REGEX.match(name)
+                networks = (container.get('NetworkSettings') or {}).get('Networks') or {}
+                network = networks.get('isaac') or next(iter(networks.values()), {})
+                containers[name] = dict(match.groupdict() if match else {'site': None, 'role': None, 'env': None, 'version': None},
+                                        name=name,
+                                        ip=network.get('IPAddress') or None,
+                                        id=container.get('Id'),
+                                        image=container.get('Image'),
+                                        image_id=container.get('ImageID'),
+                                        labels=container.get('Labels') or {},
+                                        created=container.get('Created', 0),
+                                        volumes=[mount['Name'] for mount in container.get('Mounts') or [] if mount.get('Type') == 'volume'],
+                                        running=container.get('State') == 'running')
+        volumes = {volume['Name']: volume for volume in self._get('/volumes').get('Volumes') or []}
+        images = {}
+        for image in self._get('/images/json'):
+            record = {'id': image.get('Id'), 'tags': image.get('RepoTags') or [], 'labels': image.get('Labels') or {},
+                      'size': image.get('Size', 0), 'created': image.get('Created', 0)}
+            images[record['id']] = record
+            for tag in record['tags']:
+                images[tag] = record
+        return {'containers': containers, 'volumes': volumes, 'images': images}
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._take_snapshot()
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def available(self):
+        try:
+            self.snapshot
+            return True
+        except InventoryUnavailable:
+            return False
+
+    def containers(self, site=None, role=None, env=None, version=None, running=True):
+        """Returns the containers matching every given field; pass running=None to include stopped containers too."""
+        wanted = {'site': site, 'role': role, 'env': env, 'version': version}
+        return [
+            container for container in self.snapshot['containers'].values()
+            if all(value is None or container[field] == value for field, value in wanted.items())
+            and (running is None or container['running'] == running)
+        ]
+
+    def versions(self, site, role, env, running=True):
+        return sorted(container['version'] for container in self.containers(site, role, env, running=running))
+
+    def container(self, name):
+        return self.snapshot['containers'].get(name)
+
+    def volume_exists(self, name):
+        return name in self.snapshot['volumes']
+
+    def image_exists(self, image):
+        return image in self.snapshot['images']
+
+    def image_label(self, image, label):
+        record = self.snapshot['images'].get(image)
+        return record['labels'].get(label) if record else None
+
+    def disk_usage(self):
+        """Bytes used by images, containers' writable layers and volumes. Asks the daemon to measure them, which can
+        take a while, so is not part of the snapshot."""
+        usage = self._get('/system/df')
+        return {
+            'images': usage.get('LayersSize') or 0,
+            'containers': sum(container.get('SizeRw') or 0 for container in usage.get('Containers') or []),
+            'volumes': sum(max(0, (volume.get('UsageData') or {}).get('Size', 0)) for volume in usage.get('Volumes') or []),
+        }
+
+
+INVENTORY = DockerInventory()
+
+
+def use_inventory():
+    """Whether to look up containers, volumes and images in the inventory. Without --exec, or away from the Docker host,
+    the commands to look them up are printed for the operator to run instead, and their answers read back."""
+    return EXEC and INVENTORY.available()
+
+
+# Only one worker may talk to the operator at a time, so prompts are serialised through this lock. It is re-entrant so
+# that multi-question exchanges can hold it across their individual prompts.
+PROMPT_LOCK = threading.RLock()
+# Per-worker state: the output prefix and the record of steps run for the site being deployed.
+_worker = threading.local()
+
+
+class PrefixedOutput(object):
+    """Stream wrapper which prefixes each line written by a worker thread with that worker's site, so that the output
+    of concurrent site pipelines can be told apart."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._at_line_start = True
+        self._line_owner = None
+
+    def write(self, text):
+        prefix = getattr(_worker, 'prefix', '')
+        with self._lock:
+            if not prefix:
+                return self._stream.write(text)
+            prefixed = []
+            if not self._at_line_start and self._line_owner != threading.get_ident():
+                # Another worker left a partial line, finish it rather than appending to it:
+                prefixed.append('\n')
+                self._at_line_start = True
+            for line in text.splitlines(keepends=True):
+                if self._at_line_start:
+                    prefixed.append(prefix)
+                prefixed.append(line)
+                self._at_line_start = line.endswith('\n')
+            self._line_owner = threading.get_ident()
+            self._stream.write(''.join(prefixed))
+            return len(text)
+
+    def end_line(self):
+        """Notes that the terminal has moved to a new line without us writing one, e.g. when the operator hits enter."""
+        with self._lock:
+            self._at_line_start = True
+
+    def flush(self):
+        with self._lock:
+            self._stream.flush()
+
+    def fileno(self):
+        # Stops input() from bypassing this wrapper and writing prompts straight to the terminal without a prefix.
+        raise io.UnsupportedOperation("fileno")
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class Tracer(object):
+    """Records how long each deployment step and command took as nested spans, so slow phases can be found. Time spent
+    waiting for the operator is tracked separately from time spent doing work, and is added to every enclosing span."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self.spans = []
+        self._open_stacks = {}
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        stack = self._local.__dict__.setdefault('stack', [])
+        record = {'name': name, 'cat': category, 'track': getattr(_worker, 'prefix', '').strip() or 'main',
+                  'start': time.perf_counter() - self._origin, 'duration': None, 'prompt_wait': 0.0,
+                  'depth': len(stack), 'args': args}
+        stack.append(record)
+        with self._lock:
+            self._open_stacks[threading.get_ident()] = stack
+        try:
+            yield record
+        finally:
+            stack.pop()
+            if not stack:
+                with self._lock:
+                    self._open_stacks.pop(threading.get_ident(), None)
+            record['duration'] = time.perf_counter() - self._origin - record['start']
+            if category == 'prompt' and not any(ancestor['cat'] == 'prompt' for ancestor in stack):
+                record['prompt_wait'] = record['duration']
+                for ancestor in stack:
+                    ancestor['prompt_wait'] += record['duration']
+            with self._lock:
+                self.spans.append(record)
+
+    def current_activity(self, track=None):
+        """Describes what each thread is doing right now (its innermost step, and any command that step is running),
+        so that something observed from another thread can be tied to it. Optionally only for one site's track."""
+        activities = []
+        with self._lock:
+            stacks = [list(stack) for stack in self._open_stacks.values()]
+        for stack in stacks:
+            steps = [span for span in stack if span['cat'] == 'step' and (track is None or span['track'] == track)]
+            if not steps:
+                continue
+            activity = steps[-1]['name']
+            commands = [span for span in stack if span['cat'] in ('command', 'prompt')]
+            if commands and commands[-1]['start'] >= steps[-1]['start']:
+                activity += f" ({commands[-1]['cat']}: {commands[-1]['name'][:60]})"
+            activities.append(activity)
+        return '; '.join(activities) or 'between steps'
+
+    def write_chrome_trace(self, path):
+        """Writes the spans in the Chrome trace event format, viewable in chrome://tracing or https://ui.perfetto.dev."""
+        tracks = sorted({span['track'] for span in self.spans})
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tracks.index(track), 'args': {'name': track}}
+                  for track in tracks]
+        with self._lock:
+            for span in sorted(self.spans, key=lambda span: span['start']):
+                events.append({
+                    'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': 1, 'tid': tracks.index(span['track']),
+                    'ts': round(span['start'] * 1e6), 'dur': round(span['duration'] * 1e6),
+                    'args': dict(span['args'], prompt_wait_s=round(span['prompt_wait'], 3),
+                                 execution_s=round(span['duration'] - span['prompt_wait'], 3)),
+                })
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+        return path
+
+    def print_slowest(self, limit=10):
+        spans = [span for span in self.spans if span['cat'] in ('step', 'command', 'probe')]
+        spans.sort(key=lambda span: span['duration'] - span['prompt_wait'], reverse=True)
+        print(f"\n# Slowest steps (execution time excludes waiting for the operator)")
+        print(f"{'execution':>10} {'prompt':>8} {'total':>8}  step")
+        for span in spans[:limit]:
+            label = span['name'] if span['cat'] == 'step' else f"{span['cat']}: {span['name'][:80]}"
+            print(f"{span['duration'] - span['prompt_wait']:9.1f}s {span['prompt_wait']:7.1f}s {span['duration']:7.1f}s  "
+                  f"{span['track']} {label}")
+
+
+TRACER = Tracer()
+
+
+@contextlib.contextmanager
+def operator_prompt(name='prompt'):
+    """Holds the operator's attention for one or more questions, tracing the time taken as prompt-wait."""
+    with TRACER.span(name, 'prompt'), PROMPT_LOCK:
+        yield
+
+
+class StepFailed(Exception):
+    pass
+
+
+def ask(prompt):
+    if not INTERACTIVE:
+        raise StepFailed(f"An answer is needed, but running non-interactively: {prompt.strip()}")
+    with operator_prompt(prompt.strip().splitlines()[-1][:80] if prompt.strip() else 'prompt'):
+        response = input(prompt)
+        if isinstance(sys.stdout, PrefixedOutput):
+            sys.stdout.end_line()
+        return response
+
+
+def deploy_step(func):
+    """Traces a deployment step, records its outcome for the site the current worker is deploying, and checkpoints it
+    in the journal (if there is one) so that a resumed deployment can skip it."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        ctx = args[0] if args and isinstance(args[0], dict) else {}
+        record = {'step': func.__name__, 'env': ctx.get('env'), 'status': 'running'}
+        with TRACER.span(func.__name__, 'step', env=ctx.get('env')):
+            if JOURNAL is not None and ctx.get('site'):
+                return JOURNAL.checkpoint(record, ctx, lambda: record_step(record, func, *args, **kwargs))
+            return record_step(record, func, *args, **kwargs)
+    return wrapper
+
+
+def add_step_record(record):
+    stack = _worker.__dict__.setdefault('stack', [])
+    record['depth'] = len(stack)
+    steps = getattr(_worker, 'steps', None)
+    if steps is not None:
+        steps.append(record)
+    return stack
+
+
+def record_step(record, func, *args, **kwargs):
+    stack = add_step_record(record)
+    stack.append(record)
+    try:
+        result = func(*args, **kwargs)
+        if record['status'] == 'running':
+            record['status'] = 'succeeded'
+        return result
+    except SystemExit:
+        record['status'] = 'aborted'
+        raise
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        stack.pop()
+
+
+def mark_current_step_failed():
+    for record in getattr(_worker, 'stack', []):
+        record['status'] = 'failed'
+
+
+_MISSING = object()
+# The context values which identify what a step was run for:
+JOURNAL_INPUT_KEYS = ('site', 'env', 'app', 'api', 'old_app', 'old_api', 'previous_servers_exist')
+
+
+class DeployJournal(object):
+    """An append-only record of each step's inputs, outputs and status. When resuming, a step which completed before
+    is skipped, and its outputs restored into the context, as long as its result can be seen to still hold."""
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resuming = resume
+        self.completed = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    entry = json.loads(line)
+                    if entry['status'] == 'completed':
+                        self.completed[entry['key']] = entry
+                    else:
+                        self.completed.pop(entry['key'], None)
+            print(f"# Resuming from {path}: {len(self.completed)} step(s) completed previously")
+        elif not resume:
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                # It may be an unfinished deployment's, so is kept rather than overwritten
+                rotated_path = f"{path}.{time.strftime('%Y%m%d-%H%M%S', time.localtime(os.path.getmtime(path)))}"
+                os.replace(path, rotated_path)
+                print(f"# Moved the previous journal aside to {rotated_path} (pass --resume to carry on from a journal)")
+            open(path, 'w').close()
+
+    def _write(self, entry):
+        with self._lock, open(self.path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps(dict(entry, time=time.time()), default=list) + "\n")
+
+    def checkpoint(self, record, ctx, run):
+        key = f"{ctx['site']}:{ctx.get('env')}:{record['step']}"
+        entry = self.completed.get(key)
+        inputs = journal_inputs(ctx)
+        if entry is not None and entry['inputs'] != inputs:
+            changed = sorted(name for name in set(inputs) | set(entry['inputs']) if entry['inputs'].get(name) != inputs.get(name))
+            print(f"# Completed {record['step']} for {ctx['site']} {ctx.get('env')} before, but for a different "
+                  f"{', '.join(changed)}, so running it again")
+        elif entry is not None and step_still_holds(record['step'], dict(ctx, **entry['outputs'])):
+            print(f"# Already completed {record['step']} for {ctx['site']} {ctx.get('env')}, skipping")
+            ctx.update(entry['outputs'])
+            record['status'] = 'resumed'
+            add_step_record(record)
+            return entry.get('result')
+
+        self._write({'key': key, 'step': record['step'], 'status': 'started', 'inputs': inputs})
+        before = dict(ctx)
+        status = 'failed'
+        result = None
+        try:
+            result = run()
+            status = 'completed' if record['status'] == 'succeeded' else record['status']
+            return result
+        except SystemExit:
+            status = 'aborted'
+            raise
+        finally:
+            outputs = {name: value for name, value in ctx.items() if name != 'env' and before.get(name, _MISSING) is not value}
+            self._write({'key': key, 'step': record['step'], 'status': status, 'inputs': inputs, 'outputs': outputs,
+                         'result': result if isinstance(result, (bool, int, float, str, type(None))) else None})
+
+
+JOURNAL = None
+
+
+def journal_inputs(ctx):
+    inputs = {name: ctx.get(name) for name in JOURNAL_INPUT_KEYS}
+    # A tag like "master" can be moved between runs, so the app image it pointed at is an input too
+    if ctx.get('subject') and use_inventory():
+        image = INVENTORY.snapshot['images'].get(f"{DOCKER_REPO}/isaac-{ctx['subject']}-app:{ctx.get('app')}")
+        inputs['app_image_id'] = image['id'] if image else None
+    return inputs
+
+
+def step_still_holds(step, ctx):
+    """Checks that what a previously completed step did has not since been undone, where that can be checked."""
+    if step in STEPS_NEVER_SKIPPED:
+        return False
+    check = STEP_RESULT_CHECKS.get(step)
+    try:
+        return check is None or check(ctx)
+    except InventoryUnavailable:
+        return False
+
+
+def app_container_running(ctx):
+    return bool(INVENTORY.containers(ctx['site'], 'app', ctx['env'], ctx['app']))
+
+
+# Cheap checks whose answers may have changed, so are always made again:
+STEPS_NEVER_SKIPPED = {'volume_exists'}
+STEP_RESULT_CHECKS = {
+    'get_target_api_version_from_app_image': lambda ctx: INVENTORY.image_label(
+        f"{DOCKER_REPO}/isaac-{ctx['subject']}-app:{ctx['app']}", 'apiVersion') == ctx['api'],
+    'prefetch_images': lambda ctx: all(INVENTORY.image_exists(image) for image in ctx.get('prefetched_images', ())),
+    'update_config': lambda ctx: os.path.isdir(os.path.join(DECRYPTED_CONFIG_DIRECTORY, ctx['env'], ctx['site'])),
+    'bring_up_the_new_containers': app_container_running,
+    'deploy_test': app_container_running,
+    'deploy_staging_or_dev': app_container_running,
+    'deploy_live': app_container_running,
+    'blue_green_cutover': app_container_running,
+    'deploy_etl': lambda ctx: bool(INVENTORY.containers(ctx['site'], 'etl', version=ctx['api'])),
+    'capture_test_db_snapshot': lambda ctx: bool(ctx.get('test_db_snapshot')) and os.path.exists(ctx['test_db_snapshot']),
+}
+
+
 def assert_using_a_tty():
     if not sys.stdout.isatty():
         print("Error: Must run this method with a tty. If you're using windows try:\n" + f"winpty {' '.join(sys.argv)}")
@@ -34,14 +524,54 @@ def check_repos_are_up_to_date():
 def parse_command_line_arguments():
     parser = argparse.ArgumentParser(description='Deploy the site')
     parser.add_argument('site', choices=[Site.ADA, Site.PHY, Site.SCI, Site.BOTH])
-    parser.add_argument('env', choices=['test', 'staging', 'dev', 'live', 'etl'])
-    parser.add_argument('app', help="The app version target for this deployment. Examples master or v1.2.3")
+    parser.add_argument('env', choices=['test', 'staging', 'dev', 'live', 'etl', 'gc'], help="The env to deploy to, or gc to remove old versions' containers, images and volumes")
+    parser.add_argument('app', help="The app version target for this deployment. Examples master or v1.2.3", nargs='?', default=None)
     parser.add_argument('api', help="⚠️DEPRECATED The api version target for this deployment", nargs='?', default=None)
     parser.add_argument('--exec', help="Whether the script should execute the commands itself after prompting the user", action='store_true')
+    parser.add_argument('--parallel', help="When deploying both sites, run each site's deployment concurrently", action='store_true')
+    parser.add_argument('--plan', help="Print the deployment as a graph of steps and their dependencies, then stop", action='store_true')
+    parser.add_argument('--apply', help="Run the deployment plan's steps as their dependencies complete, without asking before each command (needs --exec)", action='store_true')
+    parser.add_argument('--interactive', help="With --apply, still confirm each step and command", action='store_true')
+    parser.add_argument('--jobs', type=int, default=2, help="With --apply, how many steps may run at once (default 2)")
+    parser.add_argument('--release-type', choices=['full', 'front-end-only'], help="Whether a live release includes a new API (asked during the deployment if not given)")
+    parser.add_argument('--prefetch', help="Pull every image needed concurrently before starting, so later steps don't need the network", action='store_true')
+    parser.add_argument('--prefetch-parallelism', type=int, default=4, help="How many images to pull at once when prefetching (default 4)")
+    parser.add_argument('--blue-green', help="Start the new live app and renderer alongside the old ones and only stop the old ones once the new ones are ready", action='store_true')
+    parser.add_argument('--drain-seconds', type=float, default=10, help="How long to let old containers finish serving requests before stopping them in a blue/green cutover (default 10)")
+    parser.add_argument('--monitor-availability', help="Probe the live app, APIs and renderer in the background throughout a live deployment and report any downtime and latency spikes", action='store_true')
+    parser.add_argument('--monitor-rate', type=float, default=5, help="Requests per second to each endpoint when monitoring availability (default 5)")
+    parser.add_argument('--keep', type=int, default=2, help="With gc, how many versions before the most recent to keep for each site, role and env, and for each image (default 2)")
+    parser.add_argument('--gc-batch-size', type=int, default=20, help="With gc, how many containers, images or volumes to remove in each command (default 20)")
+    parser.add_argument('--router-config-directory', default='../isaac-router', help="With gc, where the router's config is, so containers it refers to are kept (default ../isaac-router)")
+    parser.add_argument('--container-port', type=int, default=80, help="The port the app and renderer containers serve on, for readiness checks (default 80)")
+    parser.add_argument('--migrations', choices=['manual', 'plan', 'dry-run', 'apply'], default='manual',
+                        help="How to handle DB migrations: print them to run by hand (default), only show the plan, run them and roll back, or run and commit them")
+    parser.add_argument('--lock-timeout', default='5s', help="Postgres lock_timeout for the migration transaction (default 5s)")
+    parser.add_argument('--statement-timeout', default='5min', help="Postgres statement_timeout for the migration transaction (default 5min)")
+    parser.add_argument('--psql-command', help="Command to run psql against the database being migrated (default: psql in the site's postgres container)")
+    parser.add_argument('--db-snapshots', help="Reset test databases from a snapshot of a freshly built database for the same schema, taking one if there isn't one yet", action='store_true')
+    parser.add_argument('--db-snapshot-directory', default='/local/data/test-db-snapshots', help="Where test database snapshots are kept (default /local/data/test-db-snapshots)")
+    parser.add_argument('--refresh-config', help="Decrypt the configuration even if the encrypted files haven't changed since it was last decrypted", action='store_true')
+    parser.add_argument('--resume', help="Carry on from an earlier run of the same deployment, skipping steps which completed and still hold", action='store_true')
+    parser.add_argument('--journal', help=f"Where to checkpoint each step (default: {STATE_DIRECTORY}/journals/SITE-ENV-APP.jsonl)")
+    parser.add_argument('--log-file', help=f"Where to write the output of executed commands (default: a new file in {STATE_DIRECTORY}/logs)")
+    parser.add_argument('--trace-file', help=f"Where to write a Chrome trace-event timeline of the run (default: a new file in {STATE_DIRECTORY}/traces)")
+    parser.add_argument('--probe-deadline', type=float, help=f"Seconds to wait for new services to become ready (default {PROBE_DEFAULTS['deadline']:.0f})")
+    parser.add_argument('--probe-successes', type=int, help=f"Consecutive successful responses before a service counts as ready (default {PROBE_DEFAULTS['successes']})")
+    parser.add_argument('--probe-max-interval', type=float, help=f"Longest wait in seconds between readiness checks (default {PROBE_DEFAULTS['max_interval']:.0f})")
     return parser.parse_args()
 
 
 def validate_args(args):
+    if args['env'] == 'gc':
+        if args['keep'] < 0 or args['gc_batch_size'] < 1:
+            print("Error: --keep must not be negative and --gc-batch-size must be positive")
+            sys.exit(1)
+        return args
+    if args['app'] is None:
+        print(f"Error: the app param is needed to deploy to {args['env']}")
+        sys.exit(1)
+
     match = re.match(r'^\d+\.\d+\.\d+$', args['app'])
     if match:
         print(f"Error: the app param should be v{args['app']} not {args['app']}")
@@ -54,52 +584,132 @@ def validate_args(args):
         print(f"WARNING ⚠️: The 'api' argument is deprecated and this value will be ignored. The API version is now derived from the app image. See https://github.com/isaacphysics/isaac-adrs/blob/main/7-automated-docker-builds.md for more info.\n")
         args['api'] = None
 
+    if args.get('monitor_rate') is not None and args['monitor_rate'] <= 0:
+        print(f"Error: --monitor-rate must be positive, not {args['monitor_rate']}")
+        sys.exit(1)
+
     return args
 
 
+STATE_DIRECTORY = os.path.expanduser('~/.isaac-deploy')
+# Only the start of a command's stdout is kept to be returned to the caller, who only ever parses short output:
+CAPTURE_LIMIT = 64 * 1024
+# How many of the most recent lines of a command's output are kept in memory, e.g. to show after a failure:
+TAIL_LINES = 200
+
+_log_lock = threading.Lock()
+_log_file = None
+
+
+def open_deploy_log(path=None):
+    global _log_file
+    if path is None:
+        path = os.path.join(STATE_DIRECTORY, 'logs', f"deploy-{time.strftime('%Y%m%d-%H%M%S')}.log")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    _log_file = open(path, 'a', encoding='utf-8')
+    print(f"# Logging command output to {path}")
+    return path
+
+
+def log_lines(lines, stream='out'):
+    if _log_file is None:
+        return
+    prefix = getattr(_worker, 'prefix', '')
+    timestamp = time.strftime('%H:%M:%S')
+    with _log_lock:
+        _log_file.writelines(f"{timestamp} {prefix}[{stream}] {line}\n" for line in lines)
+        _log_file.flush()
+
+
+def run_streaming_command(command, env_vars=None, chunk_size=1024, print_output=True, capture_limit=CAPTURE_LIMIT,
+                          tail_lines=TAIL_LINES, keep_lines=None):
+    """Runs a shell command, streaming its stdout and stderr as they arrive to the terminal and the deploy log.
+
+    Only a bounded amount of output is held in memory: the first capture_limit characters of stdout, which is returned
+    for the caller to parse, and a ring buffer of the last tail_lines lines from either stream. Callers which need
+    particular lines from anywhere in a long output can pick them out as they arrive with keep_lines, a predicate whose
+    chosen stdout lines are returned as 'kept_lines'."""
+    log_lines([f"$ {command}"], stream='cmd')
+    captured = []
+    kept_lines = []
+    captured_size = 0
+    tail = collections.deque(maxlen=tail_lines)
+    partial_lines = {'out': '', 'err': ''}
+    echo_streams = {'out': sys.stdout, 'err': sys.stderr}
+
+    def handle(stream, text):
+        nonlocal captured_size
+        if not text:
+            return
+        if print_output:
+            echo_streams[stream].write(text)
+            echo_streams[stream].flush()
+        if stream == 'out' and captured_size < capture_limit:
+            captured.append(text[:capture_limit - captured_size])
+            captured_size += len(captured[-1])
+        *complete_lines, partial_lines[stream] = (partial_lines[stream] + text).split('\n')
+        tail.extend((stream, line) for line in complete_lines)
+        log_lines(complete_lines, stream)
+        if keep_lines and stream == 'out':
+            kept_lines.extend(line for line in complete_lines if keep_lines(line))
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                          env=env_vars if env_vars else None) as proc:
+        with selectors.DefaultSelector() as selector:
+            for stream, pipe in (('out', proc.stdout), ('err', proc.stderr)):
+                # Decode incrementally so multibyte characters split across reads are not mangled:
+                selector.register(pipe, selectors.EVENT_READ, (stream, codecs.getincrementaldecoder('utf-8')(errors='replace')))
+            while selector.get_map():
+                for key, _ in selector.select():
+                    stream, decoder = key.data
+                    chunk = os.read(key.fileobj.fileno(), chunk_size)
+                    if chunk:
+                        handle(stream, decoder.decode(chunk))
+                    else:
+                        handle(stream, decoder.decode(b'', final=True))
+                        selector.unregister(key.fileobj)
+        return_code = proc.wait()
+
+    for stream, line in partial_lines.items():
+        if line:
+            tail.append((stream, line))
+            log_lines([line], stream)
+            if keep_lines and stream == 'out' and keep_lines(line):
+                kept_lines.append(line)
+    log_lines([f"exit code {return_code}"], stream='cmd')
+    return {'return_code': return_code, 'stdout': ''.join(captured), 'tail': list(tail), 'kept_lines': kept_lines}
+
+
+def traced_command(func):
+    @functools.wraps(func)
+    def wrapper(command, *args, **kwargs):
+        with TRACER.span(command, 'command'):
+            return func(command, *args, **kwargs)
+    return wrapper
+
+
+@traced_command
 def ask_to_run_command(command,
                        print_output=True,
                        expected_nonzero_exit_codes: Union[list, None] = None,
                        env_vars: Union[dict, None] = None,
                        chunk_size=1024,
-                       run_anyway=False):
+                       run_anyway=False,
+                       keep_lines=None):
+    """Runs a command (or, without --exec, asks the operator to), returning its output. With keep_lines, only the
+    lines of stdout it picks out are returned, but from all of the output rather than just the start of it."""
     if not EXEC:
-        return input(f"{command}\n")
-
-    run = run_anyway
-    if not run_anyway:
-        response = input(f"Execute: {command}?: ").lower()
-        while response not in ["y", "yes", "s", "skip", "a", "abort"]:
-            response = input("Please respond with one of:\n - Yes (or y)\n - Skip (or s)\n - Abort (or a)\n").lower()
-
-        if response in ["a", "abort"]:
-            print("! Aborting release process, please clean up after yourself !")
-            sys.exit(1)
-        if response in ["s", "skip"]:
-            print("Skipping command...")
-            return
-        if response in ["y", "yes"]:
-            run = True
+        response = ask(f"{command}\n")
+        INVENTORY.invalidate()
+        return response
 
+    run = run_anyway or ask_to_execute(command)
     if run:
-        output = ""
-        return_code = None
-        with subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, env=env_vars if env_vars else None) as proc:
-            stdout_data = []
-            while True:
-                output = proc.stdout
-                if output is None:
-                    break
-
-                chunk = output.read(chunk_size)
-                if not chunk:
-                    break
-                decoded_chunk = chunk.decode('utf-8', errors='replace')
-                print(decoded_chunk, end='', flush=True)  # Print in real time
-                stdout_data.append(decoded_chunk)  # Store for later
-
-            return_code = proc.wait()
-            output = ''.join(stdout_data).strip()
+        result = run_streaming_command(command, env_vars=env_vars, chunk_size=chunk_size, print_output=print_output,
+                                       keep_lines=keep_lines)
+        return_code = result['return_code']
+        output = "\n".join(result['kept_lines']) if keep_lines else result['stdout'].strip()
+        INVENTORY.invalidate()
         if return_code == 0:
             return output
         elif expected_nonzero_exit_codes and return_code in expected_nonzero_exit_codes:
@@ -108,17 +718,367 @@ def ask_to_run_command(command,
             return output
         else:
             print(f"Command returned unexpected exit code {return_code}.")
-            print("! There was an unexpected error, please clean up after yourself !")
-            response = input(f"Continue, or Abort?: [c/a] ")
+            if not print_output and result['tail']:
+                print("Last lines of output:\n" + "\n".join(line for _, line in result['tail']))
+            continue_or_abort()
+
+
+def ask_to_execute(command):
+    """Asks whether to run a command (or batch of commands), returning whether to run it. Exits if told to abort."""
+    if not INTERACTIVE:
+        print(f"Executing: {command}")
+        return True
+    with operator_prompt():
+        response = ask(f"Execute: {command}?: ").lower()
+        while response not in ["y", "yes", "s", "skip", "a", "abort"]:
+            response = ask("Please respond with one of:\n - Yes (or y)\n - Skip (or s)\n - Abort (or a)\n").lower()
 
-            while response.lower() not in ["c", "continue", "a", "abort"]:
-                response = input("Please respond with one of:\n - Continue (or c)\n - Abort (or a)\n")
-            if response in ["a", "abort"]:
-                sys.exit(1)
-            if response in ["c", "continue"]:
-                print("Continuing...")
+    if response in ["a", "abort"]:
+        print("! Aborting release process, please clean up after yourself !")
+        sys.exit(1)
+    if response in ["s", "skip"]:
+        print("Skipping command...")
+        return False
+    return True
+
+
+def continue_or_abort():
+    print("! There was an unexpected error, please clean up after yourself !")
+    mark_current_step_failed()
+    if not INTERACTIVE:
+        raise StepFailed("Not continuing after an error when running non-interactively")
+    with operator_prompt():
+        response = ask(f"Continue, or Abort?: [c/a] ").lower()
+
+        while response not in ["c", "continue", "a", "abort"]:
+            response = ask("Please respond with one of:\n - Continue (or c)\n - Abort (or a)\n").lower()
+    if response in ["a", "abort"]:
+        sys.exit(1)
+    if response in ["c", "continue"]:
+        print("Continuing...")
+
+
+PROBE_DEFAULTS = {
+    'interval': 0.5,  # Seconds to wait after the first failed attempt
+    'backoff': 1.5,  # Multiplier applied to the wait after each failed attempt
+    'max_interval': 5.0,  # Upper limit on the wait between attempts
+    'deadline': 600.0,  # Seconds after which all checks that are not yet ready are given up on
+    'successes': 3,  # Consecutive successful responses required before an endpoint counts as ready
+    'timeout': 5.0,  # Seconds allowed for each request
+}
+
+
+class ReadinessCheck(object):
+    def __init__(self, name, url, expected_status=200, expected_body=None):
+        self.name = name
+        self.url = url
+        self.expected_status = expected_status
+        self.expected_body = expected_body
+
+    def is_ready(self, status, body):
+        return status == self.expected_status and (self.expected_body is None or body.strip() == self.expected_body)
+
+    def current_url(self):
+        return self.url
+
+
+class DynamicCheck(ReadinessCheck):
+    """A check whose URL is looked up before every request, for endpoints that move during a deployment. The lookup
+    returns None when there is nothing to check yet, and raises LookupError when the endpoint has gone away."""
+
+    def __init__(self, name, resolve_url, expected_status=200, expected_body=None):
+        super().__init__(name, None, expected_status, expected_body)
+        self.resolve_url = resolve_url
+
+    def current_url(self):
+        return self.resolve_url()
+
+
+async def _http_get(url, timeout):
+    """A minimal HTTP GET, returning the status code and body. HTTP/1.0 is used so the body is never chunked."""
+    parsed = urllib.parse.urlsplit(url)
+    use_tls = parsed.scheme == 'https'
+    port = parsed.port or (443 if use_tls else 80)
+    path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+
+    async def request():
+        reader, writer = await asyncio.open_connection(parsed.hostname, port, ssl=ssl.create_default_context() if use_tls else None)
+        try:
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {parsed.netloc}\r\nUser-Agent: isaac-deploy\r\n\r\n".encode('ascii'))
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+        return status, body.decode('utf-8', errors='replace')
+
+    return await asyncio.wait_for(request(), timeout)
+
+
+async def probe_until_ready(check, settings):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    interval = settings['interval']
+    result = {'check': check, 'ready': False, 'time_to_ready': None, 'attempts': 0, 'latencies': [], 'last_error': None}
+    consecutive_successes = 0
+    while loop.time() - start < settings['deadline']:
+        result['attempts'] += 1
+        request_start = loop.time()
+        try:
+            status, body = await _http_get(check.url, settings['timeout'])
+            result['latencies'].append(loop.time() - request_start)
+            ready = check.is_ready(status, body)
+            result['last_error'] = None if ready else f"unexpected response {status}: {body[:100]!r}"
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+            ready = False
+            result['last_error'] = repr(e)
+
+        if ready:
+            consecutive_successes += 1
+            if consecutive_successes >= settings['successes']:
+                result['ready'] = True
+                result['time_to_ready'] = loop.time() - start
+                return result
+            # Once responding, check again promptly rather than backing off:
+            await asyncio.sleep(settings['interval'])
+        else:
+            consecutive_successes = 0
+            remaining = settings['deadline'] - (loop.time() - start)
+            await asyncio.sleep(max(0, min(interval, remaining)))
+            interval = min(interval * settings['backoff'], settings['max_interval'])
+    return result
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def wait_until_ready(checks, settings=None):
+    """Probes all the given endpoints concurrently until each has responded as expected enough times in a row, or the
+    deadline has passed. Prints a report and returns whether every endpoint became ready."""
+    settings = dict(PROBE_DEFAULTS, **(settings or {}))
+    print(f"Waiting for {', '.join(check.name for check in checks)} (deadline {settings['deadline']:.0f}s, "
+          f"{settings['successes']} consecutive successes required)...")
+
+    async def probe_all():
+        return await asyncio.gather(*(probe_until_ready(check, settings) for check in checks))
+
+    with TRACER.span(', '.join(check.name for check in checks), 'probe'):
+        results = asyncio.run(probe_all())
+    for result in results:
+        latencies_ms = [latency * 1000 for latency in result['latencies']]
+        latency_report = ", ".join(f"p{pct} {percentile(latencies_ms, pct):.0f}ms" for pct in (50, 90, 99)) if latencies_ms else "no responses"
+        if result['ready']:
+            print(f"{result['check'].name} is up after {result['time_to_ready']:.1f}s and {result['attempts']} attempts ({latency_report}).")
+        else:
+            print(f"{result['check'].name} was NOT ready after {result['attempts']} attempts ({latency_report}). "
+                  f"Last error: {result['last_error']}")
+    return all(result['ready'] for result in results)
+
+
+class AvailabilityMonitor(object):
+    """Polls endpoints in a background thread while a switch-over happens, to measure how long each was unavailable.
+    Requests are started at a fixed rate, whether or not earlier ones have finished. An endpoint's gap runs from its last
+    good response before a failure to its next good response; failures before its first good response (e.g. while a new
+    API starts) don't count as downtime. With record_events, every failure and latency spike is also recorded along with
+    the deployment step that was running at the time."""
+
+    SPIKE_FACTOR = 3.0  # A response is a spike if it took this many times the median of recent responses...
+    SPIKE_MINIMUM = 0.5  # ...and at least this many seconds
+    RECENT_LATENCIES = 100
+
+    def __init__(self, checks, interval=0.1, timeout=2.0, record_events=False, track=None):
+        self.checks = checks
+        self.interval = interval
+        self.timeout = timeout
+        self.record_events = record_events
+        self.track = track
+        self.events = []
+        self._stopping = threading.Event()
+        self._thread = None
+        self.results = {check.name: {'requests': 0, 'failures': 0, 'pending_failures': 0, 'last_ok': None, 'down_since': None,
+                                     'longest_gap': 0.0, 'total_downtime': 0.0, 'spikes': 0, 'latencies': [],
+                                     'recent_latencies': collections.deque(maxlen=self.RECENT_LATENCIES)}
+                        for check in checks}
+
+    def _record_event(self, check, kind, detail, started):
+        self.events.append(dict(started, check=check.name, kind=kind, detail=detail))
+
+    async def _poll(self, check):
+        result = self.results[check.name]
+        loop = asyncio.get_running_loop()
+        request_start = time.perf_counter()
+        # Failures and spikes are put down to whatever was happening when the request was sent
+        started = {'time': time.time(), 'during': TRACER.current_activity(self.track)} if self.record_events else None
+        error = None
+        try:
+            url = check.current_url() if not isinstance(check, DynamicCheck) else await loop.run_in_executor(None, check.current_url)
+            if url is None:
                 return
-
+            status, body = await _http_get(url, self.timeout)
+            ok = check.is_ready(status, body)
+            if not ok:
+                error = f"unexpected response {status}: {body[:100]!r}"
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError, LookupError, InventoryUnavailable) as e:
+            ok, error = False, repr(e)
+        now = time.perf_counter()
+        latency = now - request_start
+        result['requests'] += 1
+        if ok:
+            if result['down_since'] is not None:
+                gap = now - result['down_since']
+                result['longest_gap'] = max(result['longest_gap'], gap)
+                result['total_downtime'] += gap
+                result['down_since'] = None
+            result['last_ok'] = now
+            result['latencies'].append(latency)
+            recent = sorted(result['recent_latencies'])
+            if recent and latency > max(self.SPIKE_FACTOR * recent[len(recent) // 2], self.SPIKE_MINIMUM):
+                result['spikes'] += 1
+                if self.record_events:
+                    self._record_event(check, 'spike', f"{latency * 1000:.0f}ms (recent median {recent[len(recent) // 2] * 1000:.0f}ms)", started)
+            result['recent_latencies'].append(latency)
+        elif result['last_ok'] is None:
+            result['pending_failures'] += 1
+        else:
+            result['failures'] += 1
+            if result['down_since'] is None:
+                result['down_since'] = result['last_ok']
+            if self.record_events:
+                self._record_event(check, 'failure', error, started)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        requests = set()
+        next_tick = loop.time()
+        while not self._stopping.is_set():
+            for check in self.checks:
+                request = asyncio.ensure_future(self._poll(check))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+            next_tick += self.interval
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+        if requests:
+            await asyncio.wait(requests)
+
+    def start(self):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._run(),), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        now = time.perf_counter()
+        for result in self.results.values():
+            if result['down_since'] is not None:
+                gap = now - result['down_since']
+                result['longest_gap'] = max(result['longest_gap'], gap)
+                result['total_downtime'] += gap
+        return self.results
+
+    def print_report(self, duration, limit=20):
+        print(f"\n# Availability during the deployment ({duration:.0f}s, {1 / self.interval:.0f} requests/s per endpoint)")
+        print(f"{'endpoint':32} {'requests':>8} {'failed':>7} {'available':>9} {'downtime':>9} {'longest':>8} "
+              f"{'p50':>7} {'p90':>7} {'p99':>7} {'spikes':>6}")
+        for name, result in self.results.items():
+            counted = result['requests'] - result['pending_failures']
+            available = f"{(counted - result['failures']) / counted:.2%}" if counted else '-'
+            latencies_ms = [latency * 1000 for latency in result['latencies']]
+            percentiles = [f"{percentile(latencies_ms, pct):.0f}ms" if latencies_ms else '-' for pct in (50, 90, 99)]
+            print(f"{name[:32]:32} {result['requests']:>8} {result['failures']:>7} {available:>9} {result['total_downtime']:>8.1f}s "
+                  f"{result['longest_gap']:>7.1f}s {percentiles[0]:>7} {percentiles[1]:>7} {percentiles[2]:>7} {result['spikes']:>6}")
+            if result['pending_failures']:
+                print(f"{'':32} ({result['pending_failures']} failed requests before its first good response are not counted)")
+
+        if self.events:
+            by_activity = collections.Counter((event['during'], event['kind']) for event in self.events)
+            print("# Failures and latency spikes by what the deployment was doing:")
+            for (activity, kind), count in by_activity.most_common():
+                print(f"  {count:5} {kind}{'s' if count != 1 else ''} during {activity}")
+            print(f"# {'First ' + str(limit) + ' ' if len(self.events) > limit else ''}events:")
+            for event in self.events[:limit]:
+                print(f"  {time.strftime('%H:%M:%S', time.localtime(event['time']))}.{int(event['time'] % 1 * 1000):03d} "
+                      f"{event['check']} {event['kind']}: {event['detail']} [during {event['during']}]")
+
+
+def site_domain(site):
+    return {Site.PHY: 'isaacphysics', Site.ADA: 'adacomputerscience', Site.SCI: 'isaacscience'}[site]
+
+
+def api_readiness_check(ctx):
+    return ReadinessCheck(f"{ctx['site']} api {ctx['api']}",
+                          f"https://{site_domain(ctx['site'])}.org/api/{ctx['api']}/api/info/segue_environment",
+                          expected_body='{"segueEnvironment":"PROD"}')
+
+
+def app_availability_check(ctx):
+    return ReadinessCheck(f"{ctx['site']} app", f"https://{site_domain(ctx['site'])}.org/")
+
+
+def renderer_availability_check(ctx):
+    """Checks whichever container currently has the renderer's name, as that is the one requests are routed to."""
+    def renderer_url():
+        container = INVENTORY.container(f"{ctx['site']}-renderer")
+        if container is None or not container['running'] or container['ip'] is None:
+            raise LookupError(f"{ctx['site']}-renderer is not running")
+        return f"http://{container['ip']}:{ctx['container_port']}/"
+    return DynamicCheck(f"{ctx['site']} renderer", renderer_url)
+
+
+def container_readiness_check(ctx, container_name):
+    """Checks a container directly on its docker network address, before any traffic is routed to it."""
+    container = INVENTORY.container(container_name) if use_inventory() else None
+    if container is None or not container['running'] or container['ip'] is None:
+        return None
+    return ReadinessCheck(container_name, f"http://{container['ip']}:{ctx['container_port']}/")
+
+
+def live_availability_checks(ctx):
+    """The user-facing endpoints to watch during a live deployment: the app, the API the old app uses and the API the
+    new app will use (looked up as they become known), and the preview renderer on whichever container has its name."""
+    def api_url(version_key, skip_if_same_as=None):
+        def resolve():
+            version = ctx.get(version_key)
+            if version is None or (skip_if_same_as and version == ctx.get(skip_if_same_as)):
+                return None
+            return f"https://{site_domain(ctx['site'])}.org/api/{version}/api/info/segue_environment"
+        return resolve
+
+    segue_environment = '{"segueEnvironment":"PROD"}'
+    return [app_availability_check(ctx),
+            DynamicCheck(f"{ctx['site']} api (old)", api_url('old_api'), expected_body=segue_environment),
+            DynamicCheck(f"{ctx['site']} api (new)", api_url('api', skip_if_same_as='old_api'), expected_body=segue_environment),
+            renderer_availability_check(ctx)]
+
+
+def monitored_for_availability(func):
+    """With --monitor-availability, probes the live endpoints in the background for the whole of the wrapped step and
+    reports how available they were, and what the deployment was doing whenever they failed or slowed down."""
+    @functools.wraps(func)
+    def wrapper(ctx, *args, **kwargs):
+        if not ctx.get('monitor_availability'):
+            return func(ctx, *args, **kwargs)
+        monitor = AvailabilityMonitor(live_availability_checks(ctx), interval=1 / ctx['monitor_rate'], record_events=True,
+                                      track=getattr(_worker, 'prefix', '').strip() or 'main').start()
+        start = time.perf_counter()
+        try:
+            return func(ctx, *args, **kwargs)
+        finally:
+            monitor.stop()
+            monitor.print_report(time.perf_counter() - start)
+    return wrapper
+
+
+def probe_settings(ctx):
+    return {key: ctx[f"probe_{key}"] for key in PROBE_DEFAULTS if ctx.get(f"probe_{key}") is not None}
+
+
+@deploy_step
 def get_old_versions(ctx):
     if not ctx['previous_servers_exist']:
         return
@@ -129,16 +1089,28 @@ def get_old_versions(ctx):
 
     if 'old_app' not in ctx or ctx['old_api'] is None or ('old_app_site' in ctx and ctx['old_app_site'] != ctx['site']):
         print("# Find the previous app version")
-        while previous_app_version == "":
-            previous_app_version = ask_to_run_command(
-                "docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}-"
-            )
-
-            if previous_app_version is not None:
-                previous_app_version = previous_app_version.rstrip()
+        running_versions = INVENTORY.versions(ctx['site'], 'app', 'live') if use_inventory() else None
+        if running_versions is None:
+            while previous_app_version == "":
+                previous_app_version = ask_to_run_command(
+                    "docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}-"
+                )
+
+                if previous_app_version is not None:
+                    previous_app_version = previous_app_version.rstrip()
+                else:
+                    print("\n# ! UNABLE TO FIND PREVIOUS APP VERSION !\n")
+                    previous_app_version = ask(f"Enter old APP version (e.g. v1.2.3) for {ctx['site']} {ctx['env']}: ")
+        elif len(running_versions) == 1:
+            previous_app_version = running_versions[0]
+            print(previous_app_version)
+        else:
+            if running_versions:
+                print(f"\n# ! MULTIPLE LIVE APP VERSIONS RUNNING: {', '.join(running_versions)} !\n")
             else:
                 print("\n# ! UNABLE TO FIND PREVIOUS APP VERSION !\n")
-                previous_app_version = input(f"Enter old APP version (e.g. v1.2.3) for {ctx['site']} {ctx['env']}: ")
+            while previous_app_version == "":
+                previous_app_version = ask(f"Enter old APP version (e.g. v1.2.3) for {ctx['site']} {ctx['env']}: ").strip()
 
         ctx['old_app'] = previous_app_version
         ctx['old_app_site'] = ctx['site']
@@ -148,67 +1120,348 @@ def get_old_versions(ctx):
 
     if 'old_api' not in ctx or ctx['old_api'] is None:
         print("# Find the previous api version")
-        previous_api_version = ask_to_run_command(
-            f"docker inspect --format '{{{{ index .Config.Labels \"apiVersion\"}}}}' {app_name_prefix}{previous_app_version}"
-        )
-
-        if previous_api_version is not None:
-            previous_api_version = previous_api_version.rstrip()
+        if use_inventory():
+            previous_app_container = INVENTORY.container(f"{app_name_prefix}{previous_app_version}")
+            previous_api_version = previous_app_container['labels'].get('apiVersion') if previous_app_container else None
+            if previous_api_version:
+                print(previous_api_version)
         else:
+            previous_api_version = ask_to_run_command(
+                f"docker inspect --format '{{{{ index .Config.Labels \"apiVersion\"}}}}' {app_name_prefix}{previous_app_version}"
+            )
+            if previous_api_version is not None:
+                previous_api_version = previous_api_version.rstrip()
+
+        if not previous_api_version:
             print("\n# ! UNABLE TO FIND PREVIOUS API VERSION !\n")
-            previous_api_version = input(f"Enter old API version (e.g. v1.2.3) for {ctx['site']} {ctx['env']}: ")
+            previous_api_version = ask(f"Enter old API version (e.g. v1.2.3) for {ctx['site']} {ctx['env']}: ")
 
         ctx['old_api'] = previous_api_version
 
 
+@deploy_step
 def update_config(ctx):
+    if ctx.get(f"config_updated_{ctx['env']}"):
+        print(f"# Configuration files for {ctx['site']} {ctx['env']} already updated")
+        return
+    with CONFIG_LOCK, config_cache_file_lock():
+        fetch_config_once()
+        decrypt_config_if_changed(ctx)
+    ctx[f"config_updated_{ctx['env']}"] = True
+
+
+SOPS_CONFIG_DIRECTORY = '/local/src/isaac-sops-config'
+DECRYPTED_CONFIG_DIRECTORY = '/local/data/isaac-sops-config-decrypted'
+CONFIG_CACHE_FILE = os.path.join(STATE_DIRECTORY, 'config-cache.json')
+# The fetched and decrypted configuration is shared between sites, so only update it for one at a time:
+CONFIG_LOCK = threading.Lock()
+# Whether the encrypted configuration has been fetched during this run; it only needs fetching once for every env/site:
+_config_fetched = False
+
+
+@contextlib.contextmanager
+def config_cache_file_lock():
+    """Stops other deployments on this host updating the configuration (or its cache) at the same time as this one."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(STATE_DIRECTORY, exist_ok=True)
+    with open(CONFIG_CACHE_FILE + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def fetch_config_once():
+    global _config_fetched
+    if _config_fetched:
+        print("# Configuration files already fetched during this deployment")
+        return
     print(f"# Update configuration files")
-    ask_to_run_command(f"cd /local/data && ./fetch-isaac-sops-config.sh")
-    print(f"# Decrypt configuration files")
-    ask_to_run_command(f"cd /local/src/isaac-sops-config && ./deploy_in_docker.sh /local/data/keys/$(hostname)_gpg.ppk /local/src/isaac-sops-config /local/data/isaac-sops-config-decrypted {ctx['env']} {ctx['site']}")
-
+    _config_fetched = ask_to_run_command(f"cd /local/data && ./fetch-isaac-sops-config.sh") is not None
+
+
+def encrypted_config_hash():
+    """Hashes the encrypted configuration as fetched: the committed tree, plus any uncommitted changes and untracked
+    (but not ignored) files, such as a newly added env file."""
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=SOPS_CONFIG_DIRECTORY, check=True, capture_output=True).stdout
+
+    digest = hashlib.sha256()
+    digest.update(git('rev-parse', 'HEAD^{tree}'))
+    digest.update(git('diff', '--binary', 'HEAD'))
+    for path in sorted(git('ls-files', '-z', '--others', '--exclude-standard').split(b'\0')):
+        if path:
+            digest.update(path + b'\0')
+            with open(os.path.join(SOPS_CONFIG_DIRECTORY, os.fsdecode(path)), 'rb') as untracked_file:
+                digest.update(hashlib.sha256(untracked_file.read()).digest())
+    return digest.hexdigest()
+
+
+def read_config_cache():
+    try:
+        with open(CONFIG_CACHE_FILE, encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_config_cache(cache):
+    temporary_path = f"{CONFIG_CACHE_FILE}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as cache_file:
+        json.dump(cache, cache_file, indent=2)
+    os.replace(temporary_path, CONFIG_CACHE_FILE)
+
+
+def decrypt_config_if_changed(ctx):
+    """Decrypts the configuration for ctx's env and site, unless what was last decrypted for them came from the same
+    encrypted content and is still there. Pass --refresh-config to decrypt regardless."""
+    cache_key = f"{ctx['env']}/{ctx['site']}"
+    try:
+        content_hash = encrypted_config_hash()
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"# ! Could not hash the encrypted configuration, so it will be decrypted regardless: {e} !")
+        content_hash = None
+
+    cache = read_config_cache()
+    decrypted = os.path.isdir(os.path.join(DECRYPTED_CONFIG_DIRECTORY, ctx['env'], ctx['site']))
+    if content_hash and decrypted and not ctx.get('refresh_config') and cache.get(cache_key) == content_hash:
+        print(f"# Configuration for {ctx['site']} {ctx['env']} is unchanged since it was last decrypted")
+        return
 
+    print(f"# Decrypt configuration files")
+    result = ask_to_run_command(f"cd {SOPS_CONFIG_DIRECTORY} && ./deploy_in_docker.sh /local/data/keys/$(hostname)_gpg.ppk {SOPS_CONFIG_DIRECTORY} {DECRYPTED_CONFIG_DIRECTORY} {ctx['env']} {ctx['site']}")
+    if EXEC and content_hash and result is not None:
+        cache = read_config_cache()
+        cache[cache_key] = content_hash
+        write_config_cache(cache)
+    elif cache.pop(cache_key, None) is not None:
+        write_config_cache(cache)
+
+
+# The API checkout on the server, whose migration scripts are read (can be overridden, e.g. to benchmark elsewhere):
+API_REPO_DIRECTORY = os.environ.get('ISAAC_API_DIRECTORY', '/local/src/isaac-api')
+MIGRATIONS_DIRECTORY = 'src/main/resources/db_scripts/migrations'
+MIGRATION_STATEMENT_MARKER = '@@migration-statement'
+# Migration scripts may manage their own transaction, but are all run inside one transaction here instead:
+TRANSACTION_CONTROL_REGEX = re.compile(r'^(BEGIN|START TRANSACTION|COMMIT|END|ROLLBACK)(\s+(WORK|TRANSACTION))?$', re.IGNORECASE)
+PSQL_TIMING_REGEX = re.compile(r'^Time: (?P<ms>[\d.]+) ms')
+
+
+def split_sql_statements(sql):
+    """Splits SQL into statements on semicolons outside of quotes, comments and dollar-quoted bodies (as used by
+    function definitions). Backslash escapes are honoured in E'...' strings. Statements are returned without their
+    trailing semicolon."""
+    statements = []
+    current = []
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if sql.startswith('--', i):
+            end = sql.find('\n', i)
+            end = len(sql) if end == -1 else end
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            end = len(sql) if end == -1 else end + 2
+        elif char in ("'", '"'):
+            # An escape string constant, i.e. E'...' where the E doesn't end some longer identifier
+            escapes = char == "'" and sql[i - 1:i] in ('E', 'e') and not re.match(r'\w', sql[i - 2:i - 1])
+            end = i + 1
+            while end < len(sql):
+                if escapes and sql[end] == '\\':
+                    end += 2
+                elif sql[end] == char and sql.startswith(char * 2, end):
+                    end += 2
+                elif sql[end] == char:
+                    break
+                else:
+                    end += 1
+            end += 1
+        elif char == '$' and re.match(r'\$(\w*)\$', sql[i:]):
+            tag = re.match(r'\$(\w*)\$', sql[i:]).group(0)
+            end = sql.find(tag, i + len(tag))
+            end = len(sql) if end == -1 else end + len(tag)
+        elif char == ';':
+            statements.append(''.join(current).strip())
+            current = []
+            i += 1
+            continue
+        else:
+            end = i + 1
+        current.append(sql[i:end])
+        i = end
+    statements.append(''.join(current).strip())
+    # Drop anything which is only whitespace and comments:
+    return [statement for statement in statements
+            if re.sub(r'--[^\n]*|/\*.*?\*/', '', statement, flags=re.DOTALL).strip()]
+
+
+def migration_statements(sql):
+    """The statements of a migration script, without any that control the transaction it would be run in."""
+    return [statement for statement in split_sql_statements(sql)
+            if not TRANSACTION_CONTROL_REGEX.match(re.sub(r'--[^\n]*|/\*.*?\*/', '', statement, flags=re.DOTALL).strip())]
+
+
+def plan_migrations(ctx):
+    """Works out which migration scripts were added between the old and new API versions, in the order they should
+    run, and reads each one as it is at the new version. The plan is kept in ctx so it is only computed once."""
+    key = (ctx['old_api'], ctx['api'])
+    if ctx.get('migration_plan', {}).get('versions') == key:
+        return ctx['migration_plan']['migrations']
+
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=API_REPO_DIRECTORY, check=True, capture_output=True, text=True).stdout
+
+    changed = git('diff', '--name-only', '--diff-filter=AM', ctx['old_api'], ctx['api'], '--', MIGRATIONS_DIRECTORY).split()
+    migrations = []
+    # Migration scripts are named so that they sort into the order they need to be run in:
+    for path in sorted(changed, key=os.path.basename):
+        migrations.append({'file': path, 'statements': migration_statements(git('show', f"{ctx['api']}:{path}"))})
+    ctx['migration_plan'] = {'versions': key, 'migrations': migrations}
+    return migrations
+
+
+def migration_script(migrations, lock_timeout, statement_timeout, commit=True):
+    """Builds a psql script which runs every migration in one transaction, timing each statement."""
+    lines = ["\\set ON_ERROR_STOP on", "\\timing on", "BEGIN;",
+             f"SET LOCAL lock_timeout = '{lock_timeout}';", f"SET LOCAL statement_timeout = '{statement_timeout}';"]
+    for migration in migrations:
+        for index, statement in enumerate(migration['statements']):
+            lines.append(f"\\echo {MIGRATION_STATEMENT_MARKER} {migration['file']} {index}")
+            lines.append(f"{statement};")
+    lines.append("COMMIT;" if commit else "ROLLBACK;")
+    return "\n".join(lines) + "\n"
+
+
+def is_migration_timing_line(line):
+    return line.startswith(MIGRATION_STATEMENT_MARKER) or PSQL_TIMING_REGEX.match(line) is not None
+
+
+def parse_migration_timings(output):
+    timings = []
+    current = None
+    for line in (output or '').splitlines():
+        if line.startswith(MIGRATION_STATEMENT_MARKER):
+            path, index = line[len(MIGRATION_STATEMENT_MARKER) + 1:].rsplit(' ', 1)
+            current = (path, int(index))
+        elif current is not None and PSQL_TIMING_REGEX.match(line):
+            timings.append((*current, float(PSQL_TIMING_REGEX.match(line).group('ms'))))
+            current = None
+    return timings
+
+
+def print_migration_plan(migrations):
+    print(f"# {len(migrations)} migration(s) to run, in this order:")
+    for migration in migrations:
+        print(f"--- {migration['file']} ({len(migration['statements'])} statements)")
+        for statement in migration['statements']:
+            print(f"{statement};")
+
+
+@deploy_step
 def run_db_migrations(ctx):
     get_old_versions(ctx)
-    print("# Print migration SQL to terminal (to copy)?")
-    ask_to_run_command(f"cd /local/src/isaac-api && git diff --name-only {ctx['old_api']} {ctx['api']} -- src/main/resources/db_scripts/migrations | xargs cat")
-    print("# If there are any DB migrations, run them (in a transaction with a BEGIN; ROLLBACK; or COMMIT;). The following should be run in a separate terminal:")
-    print(f"docker exec -it {ctx['site']}-pg-{ctx['env']} psql -U rutherford")
+    mode = ctx.get('migrations') or 'manual'
+    if mode == 'manual' and not INTERACTIVE:
+        # Nobody is there to run them, and the new API would otherwise be brought up against the old schema
+        raise StepFailed("Migrations can't be run by hand when running non-interactively; use --migrations apply")
+    if mode == 'manual':
+        print("# Print migration SQL to terminal (to copy)?")
+        ask_to_run_command(f"cd {API_REPO_DIRECTORY} && git diff --name-only {ctx['old_api']} {ctx['api']} -- {MIGRATIONS_DIRECTORY} | xargs cat")
+        print("# If there are any DB migrations, run them (in a transaction with a BEGIN; ROLLBACK; or COMMIT;). The following should be run in a separate terminal:")
+        print(f"docker exec -it {ctx['site']}-pg-{ctx['env']} psql -U rutherford")
+        return
+
+    migrations = plan_migrations(ctx)
+    print_migration_plan(migrations)
+    if not migrations:
+        return
+    if mode != 'apply' and not INTERACTIVE:
+        raise StepFailed(f"There are migrations to run, which --migrations {mode} won't commit; use --migrations apply")
+    if mode == 'plan':
+        return
+
+    commit = mode == 'apply'
+    script_path = os.path.join(STATE_DIRECTORY, 'migrations', f"{ctx['site']}-{ctx['env']}-{ctx['old_api']}-{ctx['api']}.sql")
+    os.makedirs(os.path.dirname(script_path), exist_ok=True)
+    with open(script_path, 'w', encoding='utf-8') as script_file:
+        script_file.write(migration_script(migrations, ctx['lock_timeout'], ctx['statement_timeout'], commit=commit))
+    psql = ctx.get('psql_command') or f"docker exec -i {ctx['site']}-pg-{ctx['env']} psql -U rutherford -q"
+    print(f"# {'Run' if commit else 'Dry-run (rolled back afterwards)'} the migrations in a single transaction "
+          f"(lock_timeout {ctx['lock_timeout']}, statement_timeout {ctx['statement_timeout']}):")
+    # A long migration can print far more than is captured, so the timing lines are picked out as they arrive
+    output = ask_to_run_command(f"{psql} < {script_path}", keep_lines=is_migration_timing_line)
+
+    timings = parse_migration_timings(output)
+    if timings:
+        print("# Statement timings (slowest first):")
+        for path, index, ms in sorted(timings, key=lambda timing: timing[2], reverse=True):
+            print(f"{ms:10.1f}ms  {os.path.basename(path)} #{index + 1}: {migration_statement_summary(migrations, path, index)}")
+        print(f"# Total statement time {sum(timing[2] for timing in timings):.1f}ms")
+
 
+def migration_statement_summary(migrations, path, index):
+    statement = next(migration for migration in migrations if migration['file'] == path)['statements'][index]
+    return ' '.join(statement.split())[:80]
 
+
+@deploy_step
 def write_changelog():
     # TODO can get this from GitHub, given app and api versions
-    input("\nWrite the changelog at https://github.com/isaacphysics/isaac-react-app/releases")
+    if INTERACTIVE:
+        ask("\nWrite the changelog at https://github.com/isaacphysics/isaac-react-app/releases")
+    else:
+        print("\n# Write the changelog at https://github.com/isaacphysics/isaac-react-app/releases")
 
 
+@deploy_step
 def bring_down_any_existing_containers(ctx):
-    app_name_prefix = ctx['site'] + '-app-' + ctx['env'] + '-'
     print(f"# Find running {ctx['site']} {ctx['env']} versions:")
-    ask_to_run_command("docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}-", expected_nonzero_exit_codes=[1])
-    # TODO: only prompt if containers found
+    if not use_inventory():
+        app_name_prefix = ctx['site'] + '-app-' + ctx['env'] + '-'
+        ask_to_run_command("docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}-", expected_nonzero_exit_codes=[1])
+        print(f"# Bring them down using:")
+        ask_to_run_command("docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}- | xargs -L1 -- bash -c './compose {ctx['site']} {ctx['env']} $0 down -v'", expected_nonzero_exit_codes=[1])
+        return
+    running_versions = INVENTORY.versions(ctx['site'], 'app', ctx['env'])
+    if not running_versions:
+        print("None found.")
+        return
+    print("\n".join(running_versions))
     print(f"# Bring them down using:")
-    ask_to_run_command("docker ps --format '{{.Names}}' | " + f"grep {app_name_prefix} | cut -c{len(app_name_prefix) + 1}- | xargs -L1 -- bash -c './compose {ctx['site']} {ctx['env']} $0 down -v'", expected_nonzero_exit_codes=[1])
+    for version in running_versions:
+        ask_to_run_command(f"./compose {ctx['site']} {ctx['env']} {version} down -v")
 
 
+@deploy_step
 def bring_up_the_new_containers(ctx):
     print(f"# Bring up the new {ctx['site']} {ctx['env']} containers:")
-    ask_to_run_command(f"./compose {ctx['site']} {ctx['env']} {ctx['app']} up -d")
+    ask_to_run_command(f"{compose_prefix(ctx)}./compose {ctx['site']} {ctx['env']} {ctx['app']} up -d")
 
 
 def check_running_servers(ctx):
-    print("\n# Determining whether old services running\nMay return exit code 1.")
-
-    api_running = ask_to_run_command(
-        "docker ps --format '{{.Names}}' | grep api-live",
-        expected_nonzero_exit_codes=[1],
-        run_anyway=True
-    )
-    app_running = ask_to_run_command(
-        "docker ps --format '{{.Names}}' | grep app-live",
-        expected_nonzero_exit_codes=[1],
-        run_anyway=True
-    )
-    previous_servers_exist = api_running != "" and app_running != ""
+    if use_inventory():
+        print("\n# Determining whether old services running")
+        api_running = INVENTORY.containers(role='api', env='live')
+        app_running = INVENTORY.containers(role='app', env='live')
+        for container in api_running + app_running:
+            print(container['name'])
+        previous_servers_exist = len(api_running) > 0 and len(app_running) > 0
+    else:
+        print("\n# Determining whether old services running\nMay return exit code 1.")
+        api_running = ask_to_run_command(
+            "docker ps --format '{{.Names}}' | grep api-live",
+            expected_nonzero_exit_codes=[1],
+            run_anyway=True
+        )
+        app_running = ask_to_run_command(
+            "docker ps --format '{{.Names}}' | grep app-live",
+            expected_nonzero_exit_codes=[1],
+            run_anyway=True
+        )
+        previous_servers_exist = api_running != "" and app_running != ""
     ctx['previous_servers_exist'] = previous_servers_exist
 
     if not previous_servers_exist:
@@ -218,15 +1471,19 @@ def check_running_servers(ctx):
         print("# Old containers found.\n")
 
 
+@deploy_step
 def volume_exists(ctx):
-    print("\n# Determining whether necessary containers exist\nMay return exit code 1.")
-
-    volume_grep = ask_to_run_command(
-        "docker volume list | " + f"grep {ctx['site']}-pg-{ctx['env']}",
-        expected_nonzero_exit_codes=[1],
-        run_anyway=True
-    )
-    volume_exists = volume_grep != ""
+    if use_inventory():
+        print("\n# Determining whether necessary volumes exist")
+        volume_exists = INVENTORY.volume_exists(f"{ctx['site']}-pg-{ctx['env']}")
+    else:
+        print("\n# Determining whether necessary volumes exist\nMay return exit code 1.")
+        volume_grep = ask_to_run_command(
+            "docker volume list | " + f"grep {ctx['site']}-pg-{ctx['env']}",
+            expected_nonzero_exit_codes=[1],
+            run_anyway=True
+        )
+        volume_exists = volume_grep != ""
 
     if not volume_exists:
         print(f"\n# Could not find necessary volume {ctx['site']}-pg-{ctx['env']}.")
@@ -235,20 +1492,91 @@ def volume_exists(ctx):
     return volume_exists
 
 
+# The files the compose script mounts into the test database's docker-entrypoint-initdb.d, in the order they're run:
+TEST_DB_INIT_SCRIPTS = [
+    os.path.join(API_REPO_DIRECTORY, 'src/main/resources/db_scripts/postgres-rutherford-create-script.sql'),
+    os.path.join(API_REPO_DIRECTORY, 'src/main/resources/db_scripts/postgres-rutherford-functions.sql'),
+    os.path.join(API_REPO_DIRECTORY, 'src/main/resources/db_scripts/quartz_scheduler_create_script.sql'),
+    '/local/data/test-{site}-db-schema.sql',
+]
+
+
+def test_db_schema_key(ctx):
+    """Identifies the test database's initial contents by hashing the scripts it is built from, as they are on disk when
+    the database is created. When any of them changes, so does the key, so any snapshot taken for the old key is no
+    longer used."""
+    digest = hashlib.sha256()
+    for path in TEST_DB_INIT_SCRIPTS:
+        path = path.format(site=ctx['site'])
+        digest.update(path.encode('utf-8') + b'\0')
+        if os.path.exists(path):
+            with open(path, 'rb') as script_file:
+                digest.update(hashlib.sha256(script_file.read()).digest())
+        else:
+            digest.update(b'missing')
+    return digest.hexdigest()[:16]
+
+
+def test_db_snapshot_path(ctx):
+    try:
+        return os.path.join(ctx['db_snapshot_directory'], f"{ctx['site']}-pg-test-{test_db_schema_key(ctx)}.tar")
+    except OSError as e:
+        print(f"# ! Could not work out the test database schema version, so not using snapshots: {e} !")
+        return None
+
+
+@deploy_step
+def capture_test_db_snapshot(ctx, snapshot):
+    volume = f"{ctx['site']}-pg-test"
+    snapshot_directory, snapshot_name = os.path.split(snapshot)
+    print("# Snapshot the freshly built test database, so later resets can restore it rather than rebuilding it.")
+    print("# Wait for the database to finish initialising (it only listens on TCP once it has):")
+    ask_to_run_command(f"until docker exec {volume} pg_isready -q -h 127.0.0.1 -U rutherford; do sleep 1; done")
+    print("# Stop the database briefly and copy its volume:")
+    ask_to_run_command(f"mkdir -p {snapshot_directory} && docker stop {volume} && "
+                       f"docker run --rm -v {volume}:/from:ro -v {snapshot_directory}:/to --entrypoint sh postgres:16 "
+                       f"-c 'tar -C /from -cf /to/{snapshot_name}.partial . && mv /to/{snapshot_name}.partial /to/{snapshot_name}'; "
+                       f"docker start {volume}")
+    stale_snapshots = [path for path in glob.glob(os.path.join(snapshot_directory, f"{ctx['site']}-pg-test-*.tar")) if path != snapshot]
+    if stale_snapshots:
+        print("# Remove snapshots for old schema versions:")
+        ask_to_run_command(f"rm {' '.join(stale_snapshots)}")
+
+
+@deploy_step
 def deploy_test(ctx):
     print(f"\n[DEPLOY {ctx['site'].upper()} TEST]")
 
     bring_down_any_existing_containers(ctx)
-    print("Note: If there is a database schema change, you might need to alter the default data - usually through a migration followed by a snapshot.")
-    print("# Reset the test database.")
-    ask_to_run_command(f"./clean-test-db.sh {ctx['site']}")
+    reset_test_db(ctx)
     update_config(ctx)
     bring_up_the_new_containers(ctx)
+    snapshot_test_db_if_missing(ctx)
+
+
+@deploy_step
+def reset_test_db(ctx):
+    print("Note: If there is a database schema change, you might need to alter the default data - usually through a migration followed by a snapshot.")
+    snapshot = test_db_snapshot_path(ctx) if ctx.get('db_snapshots') else None
+    ctx['test_db_snapshot'] = snapshot
+    if snapshot and os.path.exists(snapshot):
+        print(f"# Reset the test database from the snapshot for this schema.")
+        ask_to_run_command(f"./clean-test-db.sh {ctx['site']} {snapshot}")
+    else:
+        print("# Reset the test database.")
+        ask_to_run_command(f"./clean-test-db.sh {ctx['site']}")
+
+
+def snapshot_test_db_if_missing(ctx):
+    snapshot = ctx.get('test_db_snapshot')
+    if snapshot and not os.path.exists(snapshot):
+        capture_test_db_snapshot(ctx, snapshot)
 
 
+@deploy_step
 def deploy_staging_or_dev(ctx):
     print(f"\n[DEPLOY {ctx['site'].upper()} {ctx['env'].upper()}]")
-    continue_anyway = not ctx['live'] or 'y' == input("Currently deploying the live site, do you want to deploy staging? [y/n] ").lower()
+    continue_anyway = not ctx['live'] or not INTERACTIVE or 'y' == ask("Currently deploying the live site, do you want to deploy staging? [y/n] ").lower()
     if continue_anyway:
         update_config(ctx)
 
@@ -259,26 +1587,47 @@ def deploy_staging_or_dev(ctx):
         bring_up_the_new_containers(ctx)
 
 
+@deploy_step
+@monitored_for_availability
 def deploy_live(ctx):
     print(f"\n[DEPLOY {ctx['site'].upper()} LIVE]")
 
     get_old_versions(ctx)
 
-    response = input("Is this a front-end-only release? [front-end-only / n] ").lower()
-    while response not in ["front-end-only", "n"]:
-        response = input("Please respond with one of:\n - front-end-only \n - n\n").lower()
+    if ctx.get('release_type'):
+        response = 'front-end-only' if ctx['release_type'] == 'front-end-only' else 'n'
+    else:
+        with operator_prompt():
+            response = ask("Is this a front-end-only release? [front-end-only / n] ").lower()
+            while response not in ["front-end-only", "n"]:
+                response = ask("Please respond with one of:\n - front-end-only \n - n\n").lower()
     front_end_only_release = response == "front-end-only"
 
     if front_end_only_release:
         print("# Front-end-only release - confirm the expected API is running:")
-        ask_to_run_command(f"docker ps --format '{{{{.Names}}}}' | grep {ctx['site']}-api-live-{ctx['api']}")
+        if not use_inventory():
+            ask_to_run_command(f"docker ps --format '{{{{.Names}}}}' | grep {ctx['site']}-api-live-{ctx['api']}")
+        elif INVENTORY.containers(ctx['site'], 'api', 'live', ctx['api']):
+            print(f"{ctx['site']}-api-live-{ctx['api']} is running.")
+        else:
+            print(f"\n# ! {ctx['site']}-api-live-{ctx['api']} IS NOT RUNNING !\n")
+            if 'y' != ask("Continue anyway? [y/n] ").lower():
+                print("! Aborting release process, please clean up after yourself !")
+                sys.exit(1)
     else:
         if ctx['previous_servers_exist']:
             print("# List possibly-unused live apis:")
-            ask_to_run_command(f"docker ps --format '{{{{ .Names }}}}' --filter name={ctx['site']}-api-live-* | grep -v {ctx['old_api']}", expected_nonzero_exit_codes=[1])
-            # TODO: only prompt if containers found
-            print("# Bring down and remove the penultimate live api(s), if that is sensible, using something like:")
-            ask_to_run_command(f"docker ps --format '{{{{ .Names }}}}' --filter name={ctx['site']}-api-live-* | grep -v {ctx['old_api']} | xargs -L1 -- bash -c 'docker stop $0 && docker rm $0'", expected_nonzero_exit_codes=[1])
+            if not use_inventory():
+                ask_to_run_command(f"docker ps --format '{{{{ .Names }}}}' --filter name={ctx['site']}-api-live-* | grep -v {ctx['old_api']}", expected_nonzero_exit_codes=[1])
+                print("# Bring down and remove the penultimate live api(s), if that is sensible, using something like:")
+                ask_to_run_command(f"docker ps --format '{{{{ .Names }}}}' --filter name={ctx['site']}-api-live-* | grep -v {ctx['old_api']} | xargs -L1 -- bash -c 'docker stop $0 && docker rm $0'", expected_nonzero_exit_codes=[1])
+            else:
+                unused_apis = [container['name'] for container in INVENTORY.containers(ctx['site'], 'api', 'live')
+                               if container['version'] != ctx['old_api']]
+                print("\n".join(unused_apis) if unused_apis else "None found.")
+                if unused_apis:
+                    print("# Bring down and remove the penultimate live api(s), if that is sensible, using something like:")
+                    ask_to_run_command(f"docker stop {' '.join(unused_apis)} && docker rm {' '.join(unused_apis)}")
 
         update_config(ctx)
 
@@ -286,52 +1635,585 @@ def deploy_live(ctx):
             run_db_migrations(ctx)
 
         print("# Bring up the new api ready for the new app:")
-        ask_to_run_command(f"./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-api-live-{ctx['api']}")
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-api-live-{ctx['api']}")
 
         print("# Wait until the api is up:")
-        domain = {Site.PHY: 'isaacphysics', Site.ADA: 'adacomputerscience', Site.SCI: 'isaacscience'}[ctx['site']]
-        api_endpoint = f"https://{domain}.org/api/{ctx['api']}/api/info/segue_environment"
-        expected_response = '\'{"segueEnvironment":"PROD"}\''
-        ask_to_run_command(f'while [ "$(curl --silent {api_endpoint})" != {expected_response} ]; do echo "Waiting for API..."; sleep 1; done && echo "The API is up!"')
+        if not wait_until_ready([api_readiness_check(ctx)], probe_settings(ctx)):
+            print("The API did not come up before the deadline.")
+            continue_or_abort()
 
         if ctx['previous_servers_exist']:
             print("# Let the monitoring service know there is a new api service to track:")
             ask_to_run_command("cd /local/src/isaac-monitor && ./monitor_services.py --generate --no-prompt && ./monitor_services.py --reload --no-prompt && cd -", run_anyway=True)
 
-    if ctx['previous_servers_exist']:
+    if ctx['previous_servers_exist'] and ctx.get('blue_green'):
+        blue_green_cutover(ctx)
+    elif ctx['previous_servers_exist']:
         print(f"# Bring up the new app and take down the old one:")
-        ask_to_run_command(f"./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-app-live-{ctx['app']} && "
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-app-live-{ctx['app']} && "
               "sleep 3 && "
               f"docker stop {ctx['site']}-app-live-{ctx['old_app']} && "
               "../isaac-router/reload-router-config")
         print("# Bring down the old preview renderer and bring up the new one")
         ask_to_run_command(f"docker stop {ctx['site']}-renderer && docker rm {ctx['site']}-renderer && "
-          f"./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-renderer")
+          f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-renderer")
     else:
         print(f"# Bring up the new app:")
-        ask_to_run_command(f"./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-app-live-{ctx['app']} && "
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-app-live-{ctx['app']} && "
               "../isaac-router/reload-router-config")
         print("# Bring up the new preview renderer")
-        ask_to_run_command(f"./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-renderer")
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {ctx['site']}-renderer")
+
+
+def move_aside_old_renderer_command(ctx, renderer, old_renderer):
+    """The command to rename the running renderer to old_renderer, so a new one can be started with its name. A rerun
+    after a half-finished cutover must not rename the renderer again if it is already the new version (or missing),
+    and must clear any old_renderer left behind first, so the rename is decided from what is there now."""
+    new_image = f"{DOCKER_REPO}/isaac-{ctx['subject']}-app-renderer:{ctx['app']}"
+    if use_inventory():
+        current = INVENTORY.container(renderer)
+        if current is None or current['image'] == new_image:
+            return None
+        remove_stale = f"docker rm -f {old_renderer} && " if INVENTORY.container(old_renderer) else ""
+        return f"{remove_stale}docker rename {renderer} {old_renderer}"
+    return (f"if docker inspect {renderer} > /dev/null 2>&1 && "
+            f"[ \"$(docker inspect --format '{{{{.Config.Image}}}}' {renderer})\" != \"{new_image}\" ]; then "
+            f"docker rm -f {old_renderer} > /dev/null 2>&1; docker rename {renderer} {old_renderer}; fi")
+
+
+@deploy_step
+def blue_green_cutover(ctx):
+    """Switches the live app and renderer over without stopping the old containers until the new ones are ready and
+    the router has been pointed at them. With --exec and the Docker Engine API, also waits for the new containers to
+    be ready, lets requests to the old ones drain, and measures how long each was unavailable to users."""
+    new_app = f"{ctx['site']}-app-live-{ctx['app']}"
+    old_app = f"{ctx['site']}-app-live-{ctx['old_app']}"
+    renderer = f"{ctx['site']}-renderer"
+    old_renderer = f"{ctx['site']}-renderer-{ctx['old_app']}"
+
+    # Otherwise the commands are only being printed, or there is no way to find the new containers to check them
+    measure = EXEC and use_inventory()
+    app_check, renderer_check = app_availability_check(ctx), renderer_availability_check(ctx)
+    monitor = AvailabilityMonitor([app_check, renderer_check]).start() if measure else None
+    try:
+        print(f"# Bring up the new app alongside the old one:")
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {new_app}")
+        # The renderer has a fixed container name, so the old one has to be moved aside to start the new one next to it:
+        move_aside = move_aside_old_renderer_command(ctx, renderer, old_renderer)
+        if move_aside:
+            print("# Rename the old preview renderer:")
+            ask_to_run_command(move_aside)
+        else:
+            print(f"# {renderer} has already been replaced, or is not running, so is not renamed")
+        print("# Bring up the new preview renderer alongside the old one:")
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-live {ctx['site']} {ctx['app']} up -d {renderer}")
+
+        if measure:
+            print("# Wait until the new containers are ready:")
+            checks = [container_readiness_check(ctx, new_app), container_readiness_check(ctx, renderer)]
+            if None in checks:
+                print("# ! Could not find a network address for the new app and renderer !")
+                continue_or_abort()
+            elif not wait_until_ready(checks, probe_settings(ctx)):
+                print("The new containers did not become ready before the deadline.")
+                continue_or_abort()
+        elif EXEC and not INTERACTIVE:
+            raise StepFailed(f"Can't check {new_app} and {renderer} are ready without the Docker Engine API")
+        else:
+            print(f"# Check {new_app} and {renderer} are ready before going on")
+
+        print("# Point the router at the new app:")
+        ask_to_run_command("../isaac-router/reload-router-config")
 
+        if measure:
+            print(f"# Let requests to the old containers drain for {ctx['drain_seconds']}s")
+            time.sleep(ctx['drain_seconds'])
+        else:
+            print(f"# Leave requests to the old containers {ctx['drain_seconds']}s to drain before going on")
+        print("# Stop the old app and remove the old renderer:")
+        ask_to_run_command(f"docker stop {old_app} {old_renderer} && docker rm {old_renderer}")
+    finally:
+        results = monitor.stop() if monitor else None
+
+    if results:
+        for label, check in [('App', app_check), ('Renderer', renderer_check)]:
+            result = results[check.name]
+            print(f"# {label} switch: longest gap in availability {result['longest_gap']:.2f}s "
+                  f"({result['failures']} of {result['requests']} requests failed)")
 
+
+@deploy_step
 def deploy_etl(ctx):
     print(f"\n[DEPLOY {ctx['site'].upper()} ETL]")
-    continue_anyway = 'y' == input("If there are changes to the content model you might want to delay deploying ETL until any old APIs are down.\nDeploy now? [y/n] ").lower()
+    continue_anyway = not INTERACTIVE or 'y' == ask("If there are changes to the content model you might want to delay deploying ETL until any old APIs are down.\nDeploy now? [y/n] ").lower()
     if continue_anyway:
         if ctx['previous_servers_exist']:
             print("# Bring down the old ETL service")
             get_old_versions(ctx)
             ask_to_run_command(f"./compose-etl {ctx['site']} {ctx['old_app']} down -v")
         print("# Bring up the new ETL service")
-        ask_to_run_command(f"./compose-etl {ctx['site']} {ctx['app']} up -d")
+        ask_to_run_command(f"{compose_prefix(ctx)}./compose-etl {ctx['site']} {ctx['app']} up -d")
 
+@deploy_step
 def get_target_api_version_from_app_image(ctx):
-    print(f"# Pull App image for {ctx['app']}")
-    ask_to_run_command(f"docker pull {DOCKER_REPO}/isaac-{ctx['subject']}-app:{ctx['app']}")
+    app_image = f"{DOCKER_REPO}/isaac-{ctx['subject']}-app:{ctx['app']}"
+    if app_image in ctx.get('prefetched_images', ()):
+        print(f"# App image for {ctx['app']} already pulled")
+    else:
+        print(f"# Pull App image for {ctx['app']}")
+        ask_to_run_command(f"docker pull {app_image}")
 
     print(f"# Get target API version from App image")
-    ctx['api'] = ask_to_run_command(f"docker inspect --format '{{{{ index .Config.Labels \"apiVersion\"}}}}' {DOCKER_REPO}/isaac-{ctx['subject']}-app:{ctx['app']}", run_anyway=True)
+    if use_inventory():
+        ctx['api'] = INVENTORY.image_label(app_image, 'apiVersion')
+    else:
+        ctx['api'] = (ask_to_run_command(f"docker inspect --format '{{{{ index .Config.Labels \"apiVersion\"}}}}' {app_image}", run_anyway=True) or '').strip()
+    if ctx['api']:
+        print(ctx['api'])
+    else:
+        print("\n# ! UNABLE TO FIND TARGET API VERSION !\n")
+        ctx['api'] = ask(f"Enter target API version (e.g. v1.2.3) for {ctx['site']} {ctx['app']}: ").strip()
+
+
+def site_subject(site):
+    return 'ada' if site == Site.ADA else 'phy'
+
+
+def images_for_site(ctx, site, api_version):
+    """Lists the images the deployment of a site to ctx['env'] will use, given the API version the app needs."""
+    subject = site_subject(site)
+    images = [f"{DOCKER_REPO}/isaac-{subject}-app:{ctx['app']}"]
+    if ctx['env'] != 'etl':
+        images.append(f"{DOCKER_REPO}/isaac-api:{api_version}")
+    if ctx['env'] == 'live':
+        images.append(f"{DOCKER_REPO}/isaac-{subject}-app-renderer:{ctx['app']}")
+    if ctx['env'] in ('live', 'etl'):
+        images.append(f"{DOCKER_REPO}/isaac-etl:{api_version}")
+    return images
+
+
+def pull_images(images, parallelism):
+    """Pulls images concurrently, printing progress as each finishes. Returns the images which failed to pull."""
+    failed = []
+    done = 0
+    progress_lock = threading.Lock()
+
+    def pull(image):
+        nonlocal done
+        start = time.perf_counter()
+        with TRACER.span(f"docker pull {image}", 'command'):
+            result = run_streaming_command(f"docker pull {image}", print_output=False)
+        with progress_lock:
+            done += 1
+            if result['return_code'] == 0:
+                print(f"[{done}/{len(images)}] Pulled {image} ({time.perf_counter() - start:.1f}s)")
+            else:
+                failed.append(image)
+                print(f"[{done}/{len(images)}] FAILED to pull {image} (exit code {result['return_code']}): "
+                      f"{result['tail'][-1][1] if result['tail'] else ''}")
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        list(executor.map(pull, images))
+    INVENTORY.invalidate()
+    return failed
+
+
+@deploy_step
+def prefetch_images(ctx, sites):
+    """Pulls every image the deployment needs up front, before anything is taken down. App images are pulled first
+    as their labels say which API version, and so which API and ETL images, are needed."""
+    if not EXEC:
+        print("# Skipping image prefetch, which needs --exec")
+        return
+    if not use_inventory():
+        print("# Skipping image prefetch, which needs the Docker Engine API to read the pulled images' labels")
+        return
+    parallelism = ctx['prefetch_parallelism']
+    app_images = {site: images_for_site(ctx, site, None)[0] for site in sites}
+    print(f"# Prefetch images for {', '.join(sites)}")
+    if not ask_to_execute(f"pull {', '.join(app_images.values())} and the images they depend on, {parallelism} at a time"):
+        return
+    pull_images(list(app_images.values()), parallelism)
+
+    try:
+        images_by_site = {}
+        for site, app_image in app_images.items():
+            api_version = INVENTORY.image_label(app_image, 'apiVersion')
+            if api_version:
+                images_by_site[site] = images_for_site(ctx, site, api_version)
+            else:
+                print(f"# ! Could not read the API version of {app_image}, so will not prefetch its other images !")
+        remaining = sorted({image for images in images_by_site.values() for image in images} - set(app_images.values()))
+        pull_images(remaining, parallelism)
+
+        present = {image for images in images_by_site.values() for image in images if INVENTORY.image_exists(image)}
+        ctx['prefetched_images'] = present
+        ctx['prefetched_sites'] = {site for site, images in images_by_site.items() if set(images) <= present}
+    except InventoryUnavailable as e:
+        # The prefetch is only a head start, so the deployment can go on and pull images as it needs them
+        print(f"# ! Stopped prefetching images, as the Docker Engine API could not be read: {e} !")
+        return
+    for site in sites:
+        status = "all images present locally" if site in ctx['prefetched_sites'] else "some images missing, they will be pulled as needed"
+        print(f"# {site}: {status}")
+
+
+def compose_prefix(ctx):
+    """Lets the compose scripts skip pulling images that have already been prefetched and checked."""
+    return "ISAAC_SKIP_PULL=true " if ctx['site'] in ctx.get('prefetched_sites', ()) else ""
+
+
+# Container names as they might appear in the router's config, e.g. in "proxy_pass http://sci-app-live-v1.2.3:80;":
+ROUTER_CONTAINER_NAME_REGEX = re.compile(r'\b(?:ada|phy|sci)-(?:app|api|renderer|etl)(?:-[\w.]+)*')
+ISAAC_IMAGE_PREFIX = f"{DOCKER_REPO}/isaac-"
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1000:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1000
+    return f"{size:.1f}TB"
+
+
+def router_referenced_names(directory):
+    """The container names mentioned anywhere in the router's config, or None if it can't be read."""
+    if not os.path.isdir(directory):
+        return None
+    names = set()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in files:
+            try:
+                with open(os.path.join(root, name), errors='ignore') as config_file:
+                    names.update(ROUTER_CONTAINER_NAME_REGEX.findall(config_file.read()))
+            except OSError:
+                continue
+    return names
+
+
+def plan_garbage_collection(sites, keep, router_names):
+    """Decides which versioned containers, and the images and compose volumes only they used, can be removed.
+
+    For each site, role and env the most recent version and the `keep` before it (by when their containers were
+    created) are kept, as is any version with a running container or a container the router refers to. Databases and
+    other unversioned containers are never touched. For each isaac image repository the same number of most recent
+    tags are kept, along with any image a remaining container uses."""
+    containers = INVENTORY.containers(running=None)
+    groups = collections.defaultdict(lambda: collections.defaultdict(list))
+    for container in containers:
+        if container['site'] in sites and container['version'] and container['role'] != 'pg':
+            groups[(container['site'], container['role'], container['env'])][container['version']].append(container)
+
+    plan = {'groups': [], 'containers': [], 'images': [], 'volumes': []}
+    for (site, role, env), versions in sorted(groups.items(), key=lambda item: tuple(part or '' for part in item[0])):
+        by_recency = sorted(versions, key=lambda version: max(c['created'] for c in versions[version]), reverse=True)
+        kept, removed = [], []
+        for index, version in enumerate(by_recency):
+            reasons = [reason for reason, applies in (
+                ('running', any(c['running'] for c in versions[version])),
+                ('referenced by the router', any(c['name'] in router_names for c in versions[version])),
+                ('current' if index == 0 else 'recent', index <= keep),
+            ) if applies]
+            if reasons:
+                kept.append((version, reasons))
+            else:
+                removed.append(version)
+                plan['containers'].extend(versions[version])
+        plan['groups'].append({'site': site, 'role': role, 'env': env, 'kept': kept, 'removed': removed})
+
+    removed_names = {container['name'] for container in plan['containers']}
+    remaining = [container for container in containers if container['name'] not in removed_names]
+    images_in_use = {container['image_id'] for container in remaining}
+    volumes_in_use = {volume for container in remaining for volume in container['volumes']}
+
+    # The API and ETL images are shared between sites, but are still only removed if no remaining container uses them
+    repositories = {f"{ISAAC_IMAGE_PREFIX}{name}" for site in sites
+                    for name in (f"{site_subject(site)}-app", f"{site_subject(site)}-app-renderer", 'api', 'etl')}
+    images = {record['id']: record for record in INVENTORY.snapshot['images'].values()}
+    tags_by_repository = collections.defaultdict(list)
+    for record in images.values():
+        for tag in record['tags']:
+            tags_by_repository[tag.rsplit(':', 1)[0]].append((record['created'], tag))
+    recent_tags = {tag for repository in repositories for _, tag in sorted(tags_by_repository[repository], reverse=True)[:keep + 1]}
+    for record in sorted(images.values(), key=lambda record: record['created']):
+        tags = record['tags']
+        if (tags and all(tag.rsplit(':', 1)[0] in repositories for tag in tags) and record['id'] not in images_in_use
+                and not recent_tags.intersection(tags)):
+            plan['images'].append(record)
+
+    # Only volumes belonging to the compose projects of removed containers, never a database's:
+    projects = {container['labels'].get('com.docker.compose.project') for container in plan['containers']} - {None}
+    for name, volume in sorted(INVENTORY.snapshot['volumes'].items()):
+        labels = volume.get('Labels') or {}
+        if (labels.get('com.docker.compose.project') in projects and name not in volumes_in_use
+                and not re.match(r'^(?:ada|phy|sci)-pg-', name)):
+            plan['volumes'].append(name)
+    return plan
+
+
+def print_garbage_collection_plan(plan):
+    print("# Versions to keep and remove:")
+    for group in plan['groups']:
+        label = ' '.join(part for part in (group['site'], group['role'], group['env']) if part)
+        kept = ', '.join(f"{version} ({', '.join(reasons)})" for version, reasons in group['kept'])
+        print(f"{label}: keep {kept or 'nothing'}")
+        if group['removed']:
+            print(f"{' ' * len(label)}  remove {', '.join(group['removed'])}")
+    print(f"# {len(plan['containers'])} stopped containers to remove")
+    image_size = sum(record['size'] for record in plan['images'])
+    print(f"# {len(plan['images'])} images to remove, up to {format_bytes(image_size)} (layers shared with kept images are not freed):")
+    for record in plan['images']:
+        print(f"  {' '.join(record['tags'])} ({format_bytes(record['size'])})")
+    print(f"# {len(plan['volumes'])} volumes to remove{':' if plan['volumes'] else ''}")
+    for name in plan['volumes']:
+        print(f"  {name}")
+
+
+def in_batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def garbage_collect(ctx, sites):
+    """Removes old versions' stopped containers, then the images and volumes nothing else uses, a batch at a time so
+    that a failure or an abort leaves most of the work done, and reports how much disk space was reclaimed."""
+    print(f"\n[GARBAGE COLLECT {', '.join(sites).upper()}]")
+    router_names = router_referenced_names(ctx['router_config_directory'])
+    if router_names is None:
+        print(f"\n# ! Could not read the router config in {ctx['router_config_directory']}, so stopped containers it still refers to are not protected !\n")
+        if 'y' != ask("Continue anyway? [y/n] ").lower():
+            sys.exit(1)
+        router_names = set()
+
+    plan = plan_garbage_collection(sites, ctx['keep'], router_names)
+    print_garbage_collection_plan(plan)
+    if ctx['plan'] or not (plan['containers'] or plan['images'] or plan['volumes']):
+        return
+
+    usage_before = INVENTORY.disk_usage() if EXEC else None
+    batch_size = ctx['gc_batch_size']
+    for batch in in_batches([container['name'] for container in plan['containers']], batch_size):
+        ask_to_run_command(f"docker rm -v {' '.join(batch)}")
+    for batch in in_batches([tag for record in plan['images'] for tag in record['tags']], batch_size):
+        ask_to_run_command(f"docker rmi {' '.join(batch)}")
+    for batch in in_batches(plan['volumes'], batch_size):
+        ask_to_run_command(f"docker volume rm {' '.join(batch)}")
+
+    if usage_before is not None:
+        usage_after = INVENTORY.disk_usage()
+        reclaimed = {kind: usage_before[kind] - usage_after[kind] for kind in usage_before}
+        print(f"# Reclaimed {format_bytes(sum(reclaimed.values()))}: "
+              + ', '.join(f"{format_bytes(size)} of {kind}" for kind, size in reclaimed.items()))
+
+
+def deploy_site(initial_context, site):
+    context = initial_context.copy()
+    context['site'] = site
+    context['subject'] = site_subject(site)
+    get_target_api_version_from_app_image(context)
+    if context['env'] == 'test' and volume_exists(context):
+        deploy_test(context)
+    elif context['env'] in ('staging', 'dev') and volume_exists(context):
+        deploy_staging_or_dev(context)
+    elif context['env'] == 'live':
+        if context['previous_servers_exist']:
+            print("# Bring down test containers")
+            context['env'] = 'test'
+            bring_down_any_existing_containers(context)
+        context['env'] = 'staging'
+        if volume_exists(context):
+            deploy_staging_or_dev(context)
+        context['env'] = 'live'
+        deploy_live(context)
+        context['env'] = 'etl'
+        deploy_etl(context)
+        context['env'] = 'live'
+        write_changelog()
+    elif context['env'] == 'etl':
+        deploy_etl(context)
+
+
+def run_site_worker(initial_context, site, prefix=''):
+    """Deploys a single site, returning the record of the steps that were run and whether the deployment got to the
+    end, rather than letting a failure or abort escape, so that other sites being deployed alongside it are unaffected."""
+    _worker.prefix = prefix
+    _worker.steps = []
+    _worker.stack = []
+    completed = False
+    try:
+        deploy_site(initial_context, site)
+        completed = True
+    except SystemExit:
+        print(f"! Deployment of {site} aborted !")
+    except Exception as e:
+        print(f"! Deployment of {site} failed: {e!r} !")
+    finally:
+        _worker.prefix = ''
+    return _worker.steps, completed
+
+
+def deploy_sites(initial_context, sites, parallel=False):
+    if not parallel or len(sites) < 2:
+        # One at a time, a site which fails or is aborted part way through stops the deployment of the rest
+        results = {}
+        for site in sites:
+            results[site], completed = run_site_worker(initial_context, site)
+            remaining = sites[sites.index(site) + 1:]
+            if not completed and remaining:
+                print(f"! Not deploying {', '.join(remaining)} as {site} did not finish !")
+                break
+        return results
+
+    print(f"# Deploying {', '.join(sites)} concurrently; prompts will be asked one at a time, prefixed by site.")
+    with prefixed_output():
+        with ThreadPoolExecutor(max_workers=len(sites)) as executor:
+            futures = {site: executor.submit(run_site_worker, initial_context, site, f"[{site.upper()}] ") for site in sites}
+            return {site: future.result()[0] for site, future in futures.items()}
+
+
+@contextlib.contextmanager
+def prefixed_output():
+    original_stdout, original_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = PrefixedOutput(original_stdout), PrefixedOutput(original_stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = original_stdout, original_stderr
+
+
+class PlanStep(object):
+    """A step in a deployment plan: an action run against one site's context (with env set for the step), which may
+    only start once the steps it depends on have succeeded."""
+
+    def __init__(self, name, kind, action, site=None, env=None, depends_on=()):
+        self.name = name
+        self.kind = kind
+        self.action = action
+        self.site = site
+        self.env = env
+        self.depends_on = [dependency for dependency in depends_on if dependency is not None]
+
+
+def build_plan(initial_context, sites):
+    """Builds the whole deployment as a graph of steps. Steps for different sites, and steps within a site that don't
+    depend on each other (e.g. pulling images, decrypting config and tearing down test containers), can overlap."""
+    steps = []
+
+    def add(name, kind, action, site, env=None, depends_on=()):
+        steps.append(PlanStep(f"{site}:{name}", kind, action, site, env, depends_on))
+        return steps[-1].name
+
+    def staging_or_dev_steps(site, env, pull):
+        config = add(f"{env}:update-config", 'config', update_config, site, env)
+        migrate = add(f"{env}:db-migrations", 'database', run_db_migrations, site, env, [pull, config]) if initial_context['previous_servers_exist'] else None
+        down = add(f"{env}:bring-down", 'teardown', bring_down_any_existing_containers, site, env, [migrate])
+        return add(f"{env}:bring-up", 'deploy', bring_up_the_new_containers, site, env, [pull, config, down])
+
+    env = initial_context['env']
+    for site in sites:
+        site_ctx = dict(initial_context, site=site, subject=site_subject(site))
+        pull = add('pull-app-image', 'image', get_target_api_version_from_app_image, site, env)
+        if env == 'test' and volume_exists(site_ctx):
+            down = add('test:bring-down', 'teardown', bring_down_any_existing_containers, site, 'test')
+            reset = add('test:reset-db', 'database', reset_test_db, site, 'test', [down])
+            config = add('test:update-config', 'config', update_config, site, 'test')
+            up = add('test:bring-up', 'deploy', bring_up_the_new_containers, site, 'test', [pull, reset, config])
+            if initial_context.get('db_snapshots'):
+                add('test:snapshot-db', 'database', snapshot_test_db_if_missing, site, 'test', [up])
+        elif env in ('staging', 'dev') and volume_exists(site_ctx):
+            staging_or_dev_steps(site, env, pull)
+        elif env == 'live':
+            if initial_context['previous_servers_exist']:
+                add('test:bring-down', 'teardown', bring_down_any_existing_containers, site, 'test')
+            staging = staging_or_dev_steps(site, 'staging', pull) if volume_exists(dict(site_ctx, env='staging')) else None
+            live_config = add('live:update-config', 'config', update_config, site, 'live')
+            live = add('live:deploy', 'cutover', deploy_live, site, 'live', [pull, staging, live_config])
+            etl = add('etl:deploy', 'etl', deploy_etl, site, 'etl', [live])
+            add('live:changelog', 'notes', lambda ctx: write_changelog(), site, 'live', [etl])
+        elif env == 'etl':
+            add('etl:deploy', 'etl', deploy_etl, site, 'etl', [pull])
+    return steps
+
+
+def print_plan(steps):
+    print("\n# Deployment plan (dry run)")
+    for step in steps:
+        dependencies = f" after {', '.join(step.depends_on)}" if step.depends_on else ""
+        print(f"  {step.name} [{step.kind}]{dependencies}")
+
+
+def run_plan_step(step, site_ctx, interactive):
+    _worker.prefix = f"[{step.site.upper()}] "
+    _worker.steps = []
+    _worker.stack = []
+    try:
+        if interactive and not ask_to_execute(f"step {step.name}"):
+            return 'skipped', {}
+        ctx = dict(site_ctx, env=step.env or site_ctx['env'])
+        step.action(ctx)
+        status = 'failed' if any(record['status'] == 'failed' for record in _worker.steps) else 'succeeded'
+        # Hand anything the step found out (e.g. the api version or the old app version) on to later steps:
+        return status, {key: value for key, value in ctx.items() if key != 'env' and site_ctx.get(key, object()) is not value}
+    except SystemExit:
+        return 'aborted', {}
+    except Exception as e:
+        print(f"! Step {step.name} failed: {e} !")
+        return 'failed', {}
+    finally:
+        _worker.prefix = ''
+
+
+def apply_plan(initial_context, steps, jobs, interactive=False):
+    """Runs the plan's steps as their dependencies complete, at most jobs at a time. When a step does not succeed its
+    dependents are skipped; when one is aborted nothing more is started."""
+    site_contexts = {site: dict(initial_context, site=site, subject=site_subject(site)) for site in {step.site for step in steps}}
+    status = {step.name: 'pending' for step in steps}
+    records = {site: [] for site in site_contexts}
+    aborted = False
+    with prefixed_output(), ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while True:
+            progressed = True
+            while progressed:
+                progressed = False
+                for step in steps:
+                    if status[step.name] != 'pending':
+                        continue
+                    dependency_statuses = [status[dependency] for dependency in step.depends_on]
+                    if aborted or any(dependency_status in ('failed', 'skipped', 'aborted') for dependency_status in dependency_statuses):
+                        status[step.name] = 'skipped'
+                        progressed = True
+                    elif all(dependency_status == 'succeeded' for dependency_status in dependency_statuses) and len(running) < jobs:
+                        status[step.name] = 'running'
+                        running[executor.submit(run_plan_step, step, site_contexts[step.site], interactive)] = step
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                status[step.name], outputs = future.result()
+                site_contexts[step.site].update(outputs)
+                aborted = aborted or status[step.name] == 'aborted'
+
+    for step in steps:
+        records[step.site].append({'step': step.name, 'env': step.env, 'depth': 0, 'status': status[step.name]})
+    return records
+
+
+def print_summary(results):
+    print("\n# Deployment summary")
+    for site, steps in results.items():
+        print(f"{site.upper()}:")
+        if not steps:
+            print("  (no steps run)")
+        for record in steps:
+            indent = '  ' * (record['depth'] + 1)
+            print(f"{indent}{record['step']} ({record['env']}): {record['status']}")
+
+
+def deployment_succeeded(results):
+    return all(record['status'] in ('succeeded', 'resumed') for steps in results.values() for record in steps)
 
 
 if __name__ == '__main__':
@@ -340,37 +2222,62 @@ if __name__ == '__main__':
     initial_context = validate_args(initial_context)
 
     EXEC = initial_context['exec']
+    if initial_context['apply'] and not initial_context['interactive']:
+        if not EXEC or (initial_context['env'] == 'live' and not initial_context['release_type']):
+            print("Error: a non-interactive --apply needs --exec, and --release-type for live deployments.")
+            sys.exit(1)
+        if initial_context['env'] in ('staging', 'dev', 'live') and initial_context['migrations'] not in ('apply', 'plan'):
+            print("Error: a non-interactive --apply needs --migrations apply, or --migrations plan if the release has no "
+                  "migrations, as nobody will be there to run them.")
+            sys.exit(1)
+        INTERACTIVE = False
+    if EXEC:
+        open_deploy_log(initial_context['log_file'])
 
     initial_context['live'] = initial_context['env'] == 'live' # As env changes during live deployment
+    sites = [Site.ADA, Site.SCI] if initial_context['site'] == Site.BOTH else [initial_context['site']]
 
-    check_repos_are_up_to_date()
-
-    check_running_servers(initial_context)
+    if initial_context['env'] == 'gc':
+        try:
+            garbage_collect(initial_context, sites)
+        except InventoryUnavailable as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    dry_run = initial_context['plan'] and not initial_context['apply']
+    if not dry_run:
+        JOURNAL = DeployJournal(initial_context['journal'] or os.path.join(
+            STATE_DIRECTORY, 'journals', f"{initial_context['site']}-{initial_context['env']}-{initial_context['app']}.jsonl"),
+            resume=initial_context['resume'])
+    if not dry_run:
+        check_repos_are_up_to_date()
+
+    try:
+        check_running_servers(initial_context)
+    except InventoryUnavailable as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
-    sites = [Site.ADA, Site.SCI] if initial_context['site'] == Site.BOTH else [initial_context['site']]
-    for site in sites:
-        context = initial_context.copy()
-        context['site'] = site
-        context['subject'] = 'ada' if context['site'] == Site.ADA else 'phy'
-        get_target_api_version_from_app_image(context)
-        if context['env'] == 'test' and volume_exists(context):
-            deploy_test(context)
-        elif context['env'] in ('staging', 'dev') and volume_exists(context):
-            deploy_staging_or_dev(context)
-        elif context['env'] == 'live':
-            if context['previous_servers_exist']:
-                print("# Bring down test containers")
-                context['env'] = 'test'
-                bring_down_any_existing_containers(context)
-            context['env'] = 'staging'
-            if volume_exists(context):
-                deploy_staging_or_dev(context)
-            context['env'] = 'live'
-            deploy_live(context)
-            context['env'] = 'etl'
-            deploy_etl(context)
-            context['env'] = 'live'
-            write_changelog()
-        elif context['env'] == 'etl':
-            deploy_etl(context)
+    plan = None
+    if initial_context['plan'] or initial_context['apply']:
+        plan = build_plan(initial_context, sites)
+        print_plan(plan)
+        if dry_run:
+            sys.exit(0)
+
+    try:
+        if initial_context['prefetch']:
+            prefetch_images(initial_context, sites)
+        if plan is not None:
+            results = apply_plan(initial_context, plan, initial_context['jobs'], interactive=initial_context['interactive'])
+        else:
+            results = deploy_sites(initial_context, sites, parallel=initial_context['parallel'])
+    finally:
+        TRACER.print_slowest()
+        trace_file = initial_context['trace_file'] or os.path.join(STATE_DIRECTORY, 'traces', f"deploy-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        print(f"# Timeline written to {TRACER.write_chrome_trace(trace_file)}")
+    print_summary(results)
+    if not deployment_succeeded(results):
+        sys.exit(1)
     print('\nDone!')
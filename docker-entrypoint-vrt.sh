@@ -1,4 +1,16 @@
 #!/bin/bash
 
-yarn install --frozen-lockfile
-yarn cypress run --component --browser chrome "$@"
\ No newline at end of file
+# node_modules is a volume keyed by VRT_DEPENDENCY_KEY (see vrt-in-docker.py), so only install into it once
+if [ -n "$VRT_DEPENDENCY_KEY" ] && [ "$(cat node_modules/.vrt-dependency-key 2>/dev/null)" == "$VRT_DEPENDENCY_KEY" ]; then
+  echo "Dependencies are already installed, skipping yarn install"
+else
+  yarn install --frozen-lockfile || exit 1
+  # Verify the Cypress binary now, while nothing else is using the volume, so that the containers sharing it later
+  # (e.g. both sites' shards) only read the binary and its verified state rather than each writing them
+  yarn cypress verify || exit 1
+  echo "$VRT_DEPENDENCY_KEY" > node_modules/.vrt-dependency-key
+fi
+if [ "$VRT_INSTALL_ONLY" == "true" ]; then
+  exit 0
+fi
+yarn cypress run --component --browser chrome "$@"
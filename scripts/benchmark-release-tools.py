@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# USAGE: python3 scripts/benchmark-release-tools.py [--update-baseline]
+#
+# Runs deploy.py and tag.py end to end against local stand-ins, so that changes to them can be timed repeatably:
+#  - fake docker, git and psql executables, which sleep for a configurable latency and record each invocation
+#  - a fake Docker Engine API on a unix socket (for deploy.py's container inventory)
+#  - a stub GitHub API (for tag.py's tag and build lookups)
+# deploy.py is driven through a pseudo-terminal with its prompts answered automatically. Each script runs in a
+# throwaway copy of the repo with its own HOME, so nothing here touches the real repos, caches or journals. Commands
+# which need the server's /local directories (e.g. decrypting the config) fail quickly, and are continued past.
+#
+# The number of subprocesses and requests each run makes are compared strictly against a baseline, and the wall time
+# of each phase loosely. Timings depend on the machine, so the baseline is kept per machine (under ~/.cache), and
+# timings are scaled by a calibration run (starting the fake tools) to allow for how busy the machine is.
+
+import argparse
+import http.server
+import json
+import os
+import pty
+import re
+import select
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.expanduser('~/.cache/isaac-benchmark/baseline.json')
+CALIBRATION_RUNS = 10
+SANDBOX_FILES = ['deploy.py', 'tag.py', 'compose', 'compose-live', 'compose-etl', 'clean-test-db.sh', 'package.json', '.env']
+
+# Each deploy scenario's arguments, and whether live containers are running (which is when staging runs migrations).
+# Migrations are benchmarked on staging rather than live, as a live deployment would probe the real sites' URLs.
+DEPLOY_SCENARIOS = {
+    'deploy sci staging': (['sci', 'staging', 'v1.3.0', '--exec'], False),
+    'deploy both staging (parallel)': (['both', 'staging', 'v1.3.0', '--exec', '--parallel'], False),
+    'deploy sci staging with migrations': (['sci', 'staging', 'v1.3.0', '--exec', '--migrations', 'dry-run', '--psql-command', 'psql'], True),
+}
+TAG_ARGUMENTS = ['--app', 'minor', '--api', 'minor']
+
+# Answers to deploy.py's prompts, matched against each line of output since the last answer. They aren't anchored to
+# the end of the line, since with --parallel another site's stderr can be written after a waiting prompt.
+PROMPT_ANSWERS = [
+    (re.compile(r'Execute: .*?\?: '), 'y'),
+    (re.compile(r'\[c/a\] '), 'c'),
+    (re.compile(r'\[front-end-only / n\] '), 'n'),
+    (re.compile(r'\[y/n\] '), 'y'),
+    (re.compile(r'Enter old APP version'), 'v1.2.0'),
+    (re.compile(r'Enter (old|target) API version'), 'v4.1.0'),
+]
+
+# tag.py has no timeline of its own, so its phases are the spans of the subprocesses and requests they make
+TAG_PHASES = [
+    ('check repos', re.compile(r'^(git (fetch|status)|GET .*/runs)')),
+    ('find versions', re.compile(r'^GET .*/tags')),
+    ('commit, tag and push', re.compile(r'^git (add|commit|tag|push)')),
+]
+
+FAKE_TOOL = r'''#!/usr/bin/env python3
+import json, os, sys, time
+tool, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+start = time.time()
+time.sleep(float(os.environ.get(f'BENCHMARK_{tool.upper()}_LATENCY', '0')))
+if tool == 'git' and args[:2] == ['status', '--porcelain=v2']:
+    print('# branch.oid 0123456789abcdef0123456789abcdef01234567\n# branch.head main\n# branch.upstream origin/main\n# branch.ab +0 -0')
+elif tool == 'git' and args[:1] == ['rev-parse']:
+    print('main' if '--abbrev-ref' in args else '0123456789abcdef0123456789abcdef01234567')
+elif tool == 'docker' and args[:1] == ['inspect'] and 'apiVersion' in ' '.join(args):
+    print('v4.1.0')
+elif tool == 'git' and args[:1] == ['diff'] and '--name-only' in args:
+    print('src/main/resources/db_scripts/migrations/2024-01-01-add-column.sql\nsrc/main/resources/db_scripts/migrations/2024-02-01-backfill.sql')
+elif tool == 'git' and args[:1] == ['show']:
+    print("BEGIN;\nALTER TABLE t ADD COLUMN c int;\nUPDATE t SET c = 1 WHERE x = E'a\\';b';\nCREATE INDEX t_c ON t (c);\nCOMMIT;")
+elif tool == 'docker' and 'compose' in args[:1] and '-' in args:
+    sys.stdin.read()
+elif tool == 'psql':
+    for line in sys.stdin:
+        if line.startswith('\\echo '):
+            print(line[len('\\echo '):].rstrip())
+        elif line.rstrip().endswith(';'):
+            print('Time: 1.000 ms')
+with open(os.environ['BENCHMARK_EVENTS'], 'a') as events:
+    events.write(json.dumps({'name': ' '.join([tool] + args), 'start': start, 'end': time.time()}) + '\n')
+'''
+
+
+def record_event(events_path, name, start):
+    with open(events_path, 'a') as events:
+        events.write(json.dumps({'name': name, 'start': start, 'end': time.time()}) + '\n')
+
+
+def docker_engine_data(live_containers):
+    names = [f'{site}-{name}' for site in ['ada', 'sci'] for name in ['app-staging-v1.2.0', 'api-staging-v4.0.0', 'pg-staging']]
+    if live_containers:
+        names += [f'{site}-{name}' for site in ['ada', 'sci'] for name in ['app-live-v1.2.0', 'api-live-v4.0.0', 'pg-live']]
+    containers = [
+        {'Names': [f'/{name}'], 'Id': name, 'Image': name, 'ImageID': name, 'State': 'running',
+         'Labels': {'apiVersion': 'v4.0.0'} if '-app-' in name else {},
+         'NetworkSettings': {'Networks': {'isaac': {'IPAddress': '127.0.0.1'}}}}
+        for name in names
+    ]
+    images = [{'Id': f'{subject}-app', 'RepoTags': [f'ghcr.io/isaacphysics/isaac-{subject}-app:v1.3.0'],
+               'Labels': {'apiVersion': 'v4.1.0'}, 'Size': 100_000_000} for subject in ['ada', 'phy']]
+    return {'/containers/json': containers, '/volumes': {'Volumes': [{'Name': 'ada-pg-staging'}, {'Name': 'sci-pg-staging'}]},
+            '/images/json': images}
+
+
+def start_docker_engine(socket_path, live_containers=False):
+    data = docker_engine_data(live_containers)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(data.get(self.path.split('?')[0], {})).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            request, _ = super().get_request()
+            return request, ('local', 0)
+
+    server = Server(socket_path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_github_stub(events_path, latency):
+    tags = [f'v{major}.{minor}.{patch}' for major in range(3, 5) for minor in range(10) for patch in range(5)]
+    tags += [f'v4.10.0rc{rc}' for rc in range(1, 4)]
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.time()
+            time.sleep(latency)
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            headers = {}
+            if url.path.endswith('/tags'):
+                page, per_page = int(query.get('page', ['1'])[0]), int(query.get('per_page', ['30'])[0])
+                body = [{'name': name} for name in sorted(tags, reverse=True)[(page - 1) * per_page:page * per_page]]
+                if page * per_page < len(tags):
+                    headers['Link'] = f'<http://127.0.0.1:{self.server.server_port}{url.path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            else:
+                body = {'workflow_runs': [{'status': 'completed', 'conclusion': 'success', 'html_url': 'http://stub/run'}]}
+            encoded = json.dumps(body).encode()
+            self.send_response(200)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+            record_event(events_path, f'GET {url.path}', start)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_sandbox(root, latencies):
+    app_directory = os.path.join(root, 'isaac-react-app')
+    os.makedirs(app_directory)
+    for name in SANDBOX_FILES:
+        shutil.copy2(os.path.join(REPO_DIRECTORY, name), app_directory)
+    os.makedirs(os.path.join(root, 'isaac-api', 'src', 'main', 'resources', 'db_scripts'))
+    with open(os.path.join(root, 'isaac-api', 'pom.xml'), 'w') as pom:
+        pom.write('<project>\n  <properties>\n    <segue.version>v4.1.1-SNAPSHOT</segue.version>\n  </properties>\n</project>\n')
+
+    bin_directory = os.path.join(root, 'bin')
+    os.makedirs(bin_directory)
+    for tool in ['docker', 'git', 'psql']:
+        path = os.path.join(bin_directory, tool)
+        with open(path, 'w') as fake_tool:
+            fake_tool.write(FAKE_TOOL.replace('#!/usr/bin/env python3', f'#!{sys.executable}', 1))
+        os.chmod(path, 0o755)
+
+    env = dict(os.environ, HOME=os.path.join(root, 'home'), PATH=f"{bin_directory}{os.pathsep}{os.environ['PATH']}",
+               DOCKER_HOST=f"unix://{os.path.join(root, 'docker.sock')}", BENCHMARK_EVENTS=os.path.join(root, 'events.jsonl'),
+               ISAAC_API_DIRECTORY=os.path.join(root, 'isaac-api'))
+    env.pop('GITHUB_TOKEN', None)
+    for tool, latency in latencies.items():
+        env[f'BENCHMARK_{tool.upper()}_LATENCY'] = str(latency)
+    os.makedirs(env['HOME'])
+    return app_directory, env
+
+
+def read_events(env):
+    try:
+        with open(env['BENCHMARK_EVENTS']) as events:
+            return [json.loads(line) for line in events]
+    except OSError:
+        return []
+
+
+def run_in_pty(command, cwd, env, timeout):
+    """Runs a command attached to a pseudo-terminal, answering its prompts from PROMPT_ANSWERS."""
+    controller, terminal = pty.openpty()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdin=terminal, stdout=terminal, stderr=terminal, close_fds=True)
+    os.close(terminal)
+    output, answered_at, deadline = '', 0, time.monotonic() + timeout
+    try:
+        while process.poll() is None or select.select([controller], [], [], 0)[0]:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"{' '.join(command)} did not finish within {timeout}s:\n{output[-2000:]}")
+            if select.select([controller], [], [], 0.05)[0]:
+                try:
+                    output += os.read(controller, 65536).decode(errors='replace')
+                except OSError:
+                    break
+                continue
+            position = answered_at
+            for line in output[answered_at:].split('\n'):
+                position += len(line) + 1
+                answer = next((answer for prompt, answer in PROMPT_ANSWERS if prompt.search(line.replace('\r', ''))), None)
+                if answer is not None:
+                    os.write(controller, f'{answer}\n'.encode())
+                    answered_at = min(position, len(output))
+                    break
+    finally:
+        os.close(controller)
+    return process.wait(), output
+
+
+def calibrate(root):
+    """Times starting the fake tools with no latency, as a measure of how fast this machine is running right now."""
+    _, env = make_sandbox(root, {})
+    docker = os.path.join(root, 'bin', 'docker')
+    start = time.monotonic()
+    for _ in range(CALIBRATION_RUNS):
+        subprocess.run([docker, 'version'], env=env, check=True, capture_output=True)
+    return time.monotonic() - start
+
+
+def benchmark_deploy(name, arguments, live_containers, root, latencies, timeout):
+    app_directory, env = make_sandbox(root, latencies)
+    docker_engine = start_docker_engine(os.path.join(root, 'docker.sock'), live_containers)
+    trace_path = os.path.join(root, 'trace.json')
+    try:
+        start = time.monotonic()
+        return_code, output = run_in_pty([sys.executable, 'deploy.py', *arguments, '--trace-file', trace_path], app_directory, env, timeout)
+        wall = time.monotonic() - start
+    finally:
+        docker_engine.shutdown()
+        docker_engine.server_close()
+    if not os.path.exists(trace_path):
+        raise RuntimeError(f"{name} exited with {return_code} without writing a timeline:\n{output[-2000:]}")
+
+    with open(trace_path) as trace_file:
+        phases = step_phases(json.load(trace_file)['traceEvents'])
+    return summarise(wall, phases, read_events(env))
+
+
+def step_phases(trace_events):
+    """Totals each step's own execution time, i.e. less the time spent in the steps nested inside it (such as
+    deploy_live's), so that no time is counted in more than one phase."""
+    phases = {}
+    steps = [event for event in trace_events if event.get('ph') == 'X' and event['cat'] == 'step']
+    # Parents start no later, and end no earlier, than their children on the same track
+    steps.sort(key=lambda event: (event['tid'], event['ts'], -event['dur']))
+    open_steps = []
+    for event in steps:
+        while open_steps and (open_steps[-1]['tid'] != event['tid'] or event['ts'] >= open_steps[-1]['ts'] + open_steps[-1]['dur']):
+            open_steps.pop()
+        phases[event['name']] = phases.get(event['name'], 0.0) + event['args']['execution_s']
+        if open_steps:
+            parent = open_steps[-1]['name']
+            phases[parent] -= event['args']['execution_s']
+        open_steps.append(event)
+    # The trace's times are rounded, which can leave a step with no time of its own just below zero
+    return {name: max(seconds, 0.0) for name, seconds in phases.items()}
+
+
+def benchmark_tag(root, latencies, timeout):
+    app_directory, env = make_sandbox(root, latencies)
+    github = start_github_stub(env['BENCHMARK_EVENTS'], latencies['github'])
+    env['GITHUB_API_URL'] = f'http://127.0.0.1:{github.server_port}'
+    try:
+        start = time.monotonic()
+        result = subprocess.run([sys.executable, 'tag.py', *TAG_ARGUMENTS], cwd=app_directory, env=env, input='y\n' * 20,
+                                capture_output=True, text=True, timeout=timeout)
+        wall = time.monotonic() - start
+    finally:
+        github.shutdown()
+        github.server_close()
+    if result.returncode != 0:
+        print(f"Warning: tag.py exited with {result.returncode}:\n{result.stdout[-2000:]}{result.stderr[-2000:]}")
+
+    events = read_events(env)
+    phases = {}
+    for phase, pattern in TAG_PHASES:
+        matching = [event for event in events if pattern.search(event['name'])]
+        if matching:
+            phases[phase] = max(event['end'] for event in matching) - min(event['start'] for event in matching)
+    return summarise(wall, phases, events)
+
+
+def summarise(wall, phases, events):
+    subprocesses = {}
+    for event in events:
+        if not event['name'].startswith('GET '):
+            tool = event['name'].split(' ', 1)[0]
+            subprocesses[tool] = subprocesses.get(tool, 0) + 1
+    subprocesses['total'] = sum(subprocesses.values())
+    return {'wall_s': round(wall, 3), 'phases_s': {phase: round(seconds, 3) for phase, seconds in sorted(phases.items())},
+            'subprocesses': dict(sorted(subprocesses.items())), 'http_requests': sum(event['name'].startswith('GET ') for event in events)}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def median_run(runs):
+    """Combines repeated runs, taking the median of every timing (counts are the same on every run)."""
+    combined = dict(runs[0])
+    combined['wall_s'] = median([run['wall_s'] for run in runs])
+    combined['phases_s'] = {phase: median([run['phases_s'].get(phase, 0.0) for run in runs]) for phase in runs[0]['phases_s']}
+    return combined
+
+
+def compare_with_baseline(results, baseline, tolerance, speed):
+    """Prints each measurement next to its baseline. Returns the counts which went up, which are regressions, and the
+    timings which got slower by more than the tolerance, after scaling the baseline's by how much slower this machine
+    is running now than when it was recorded (speed)."""
+    regressions, slower = [], []
+    for benchmark, result in results.items():
+        previous = baseline.get(benchmark, {})
+        print(f"\n{benchmark}")
+        print(f"{'':40} {'now':>9} {'baseline':>9} {'change':>8}")
+        rows = [('total wall time', result['wall_s'], previous.get('wall_s'), True)]
+        rows += [(f'  {phase}', seconds, previous.get('phases_s', {}).get(phase), True) for phase, seconds in result['phases_s'].items()]
+        rows += [(f'{tool} subprocesses', count, previous.get('subprocesses', {}).get(tool), False) for tool, count in result['subprocesses'].items()]
+        rows += [('GitHub requests', result['http_requests'], previous.get('http_requests'), False)]
+        for label, now, before, is_time in rows:
+            if is_time and before is not None:
+                before = round(before * speed, 3)
+            change = '' if before in (None, 0) else f'{(now - before) / before:+7.0%}'
+            unit = 's' if is_time else ''
+            before_text = '-' if before is None else f'{before:.2f}{unit}' if is_time else str(before)
+            print(f"{label[:40]:40} {f'{now:.2f}{unit}' if is_time else str(now):>9} {before_text:>9} {change:>8}")
+            if before is None:
+                continue
+            if not is_time and now > before:
+                regressions.append(f"{benchmark}: {label.strip()} {before} -> {now}")
+            # Tiny phases are dominated by noise, so only flag timings that moved by a noticeable amount of time too
+            elif is_time and now > before * (1 + tolerance) and now - before > 0.1:
+                slower.append(f"{benchmark}: {label.strip()} {before} -> {now}")
+    return regressions, slower
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark deploy.py and tag.py against local stand-ins for docker, git, psql and GitHub.')
+    parser.add_argument('--docker-latency', type=float, default=0.05, help="Seconds each fake docker command takes (default 0.05)")
+    parser.add_argument('--git-latency', type=float, default=0.02, help="Seconds each fake git command takes (default 0.02)")
+    parser.add_argument('--psql-latency', type=float, default=0.05, help="Seconds each fake psql command takes (default 0.05)")
+    parser.add_argument('--github-latency', type=float, default=0.05, help="Seconds each stub GitHub request takes (default 0.05)")
+    parser.add_argument('--repeat', type=int, default=3, help="Run each benchmark this many times and report the median (default 3)")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to allow each run before giving up (default 300)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help=f"The stored results to compare with (default {DEFAULT_BASELINE})")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="How much slower than the (calibrated) baseline a timing must be to be reported (default 0.2)")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cli_args = parse_command_line_arguments()
+    latencies = {'docker': cli_args.docker_latency, 'git': cli_args.git_latency, 'psql': cli_args.psql_latency,
+                 'github': cli_args.github_latency}
+
+    results = {}
+    benchmarks = [(name, lambda root, arguments=arguments, live=live, name=name: benchmark_deploy(name, arguments, live, root, latencies, cli_args.timeout))
+                  for name, (arguments, live) in DEPLOY_SCENARIOS.items()]
+    benchmarks.append(('tag minor release', lambda root: benchmark_tag(root, latencies, cli_args.timeout)))
+    calibrations = []
+    for name, benchmark in benchmarks:
+        print(f"# Benchmarking {name}")
+        runs = []
+        for _ in range(cli_args.repeat):
+            with tempfile.TemporaryDirectory(prefix='isaac-benchmark-') as root:
+                calibrations.append(calibrate(os.path.join(root, 'calibration')))
+                runs.append(benchmark(os.path.join(root, 'benchmark')))
+        results[name] = median_run(runs)
+    results = {'latencies': latencies, 'calibration_s': round(median(calibrations), 3), **results}
+
+    try:
+        with open(cli_args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except (OSError, ValueError):
+        baseline = {}
+    if not baseline:
+        print(f"No baseline at {cli_args.baseline} yet: run with --update-baseline to record one for this machine")
+    elif baseline.get('latencies', latencies) != latencies:
+        print("Warning: the baseline was recorded with different fake latencies, so the timings are not comparable")
+    speed = results['calibration_s'] / baseline['calibration_s'] if baseline.get('calibration_s') else 1.0
+    print(f"Calibration: {results['calibration_s']:.2f}s to start the fake tools {CALIBRATION_RUNS} times"
+          + (f", {speed:.2f}x the baseline's, so its timings are scaled by that" if baseline.get('calibration_s') else ""))
+    regressions, slower = compare_with_baseline(
+        {name: result for name, result in results.items() if name not in ('latencies', 'calibration_s')}, baseline, cli_args.tolerance, speed)
+
+    if slower:
+        print("\nSlower than the calibrated baseline (timings are noisy, so check by running again):\n"
+              + "\n".join(f" - {timing}" for timing in slower))
+    if cli_args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(cli_args.baseline)), exist_ok=True)
+        with open(cli_args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"\nBaseline written to {cli_args.baseline}")
+    elif regressions:
+        print("\nMore subprocesses or requests than the baseline:\n" + "\n".join(f" - {regression}" for regression in regressions))
+        sys.exit(1)
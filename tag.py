@@ -3,19 +3,30 @@
 
 # USAGE: python tag.py --app=minor --api=major
 #
+# Set GITHUB_TOKEN to make authenticated requests to GitHub, which have a much higher rate limit. GITHUB_API_URL can
+# point the script at another GitHub API (e.g. a local stub) instead.
+#
 # TODO ./build-in-docker would be good to be triggered automatically on tag
 # TODO support release candidate versions?
 # TODO tag-in-docker might be cleaner if we could get the git auth working nicely
 
 import argparse
+import functools
+import hashlib
+import json
+import os
 import requests
+import requests.adapters
+import shutil
 import subprocess
 import sys
+import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-SEMVER_REGEX = re.compile(fr'^v(?P<major>\d+?).(?P<minor>\d+?).(?P<patch>\d+?)(rc(?P<rc>\d+?))?$')
+SEMVER_REGEX = re.compile(r'^v(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)(rc(?P<rc>\d+))?$')
 react_api_env_var_name = 'REACT_APP_API_VERSION'
-REACT_API_ENV_REGEX = re.compile(fr'{react_api_env_var_name}=(?P<version>.*)')
+REACT_API_ENV_REGEX = re.compile(fr'^(?P<prefix>{react_api_env_var_name}=)(?P<version>.*?)(?P<suffix>\r?)$', re.MULTILINE)
 semver_options = {
     'major': 'Makes incompatible API changes',
     'minor': 'Adds (backwards-compatible) functionality',
@@ -30,11 +41,144 @@ subprocess_options = {
     'api': dict({'cwd': api_working_directory}, **_default_subprocess_options),
 }
 
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+GITHUB_CACHE_DIRECTORY = os.path.expanduser('~/.cache/isaac-tag/github')
+github_repos = {'app': 'isaacphysics/isaac-react-app', 'api': 'isaacphysics/isaac-api'}
+
+class GitHubClient(object):
+    """A GitHub API client which reuses pooled connections, authenticates if given a token and caches responses on disk.
+    Cached responses are revalidated with If-None-Match, and GitHub doesn't count a 304 against the rate limit."""
+
+    def __init__(self, base_url=GITHUB_API_URL, token=None, cache_directory=GITHUB_CACHE_DIRECTORY):
+        self.base_url = base_url.rstrip('/')
+        self.cache_directory = cache_directory
+        self.session = requests.Session()
+        self.session.mount(self.base_url, requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=8))
+        self.session.headers.update({'Accept': 'application/vnd.github+json', 'X-GitHub-Api-Version': '2022-11-28'})
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def _cache_path(self, url, params):
+        key = json.dumps([url, sorted((params or {}).items()), self.session.headers.get('Authorization', '')])
+        return os.path.join(self.cache_directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, path, params=None):
+        return self._get(f'{self.base_url}{path}', params)[0]
+
+    def get_all_pages(self, path, params=None):
+        """GETs every page of a paginated list, following the Link headers GitHub sends."""
+        items = []
+        url, params = f'{self.base_url}{path}', dict(params or {}, per_page=100)
+        while url:
+            body, url = self._get(url, params)
+            items.extend(body)
+            params = None  # The next page's URL already includes the query parameters
+        return items
+
+    def _get(self, url, params=None):
+        cache_path = self._cache_path(url, params)
+        cached = None
+        headers = {}
+        try:
+            with open(cache_path, encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            headers['If-None-Match'] = cached['etag']
+        except (OSError, ValueError, KeyError):
+            cached = None
+
+        response = self.session.get(url, params=params, headers=headers, timeout=30)
+        if response.status_code == 304 and cached is not None:
+            return cached['body'], cached.get('next')
+        response.raise_for_status()
+        body = response.json()
+        next_url = response.links.get('next', {}).get('url')
+        if response.headers.get('ETag'):
+            os.makedirs(self.cache_directory, exist_ok=True)
+            temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as cache_file:
+                json.dump({'etag': response.headers['ETag'], 'body': body, 'next': next_url}, cache_file)
+            os.replace(temporary_path, cache_path)
+        return body, next_url
+
+github = GitHubClient(token=os.environ.get('GITHUB_TOKEN'))
+
+@functools.total_ordering
+class Version(object):
+    """A parsed vX.Y.Z or vX.Y.ZrcN tag. Versions order by semver, with release candidates before their release."""
+
+    def __init__(self, major, minor, patch, rc=None):
+        self.major, self.minor, self.patch, self.rc = major, minor, patch, rc
+
+    @classmethod
+    def parse(cls, name):
+        match = SEMVER_REGEX.match(name)
+        if not match:
+            return None
+        return cls(int(match.group('major')), int(match.group('minor')), int(match.group('patch')),
+                   int(match.group('rc')) if match.group('rc') is not None else None)
+
+    @property
+    def base(self):
+        return Version(self.major, self.minor, self.patch)
+
+    @property
+    def is_rc(self):
+        return self.rc is not None
+
+    def _key(self):
+        return self.major, self.minor, self.patch, self.rc is None, self.rc or 0
+
+    def __eq__(self, other):
+        return isinstance(other, Version) and self._key() == other._key()
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __str__(self):
+        return f"v{self.major}.{self.minor}.{self.patch}" + (f"rc{self.rc}" if self.is_rc else "")
+
+    def __repr__(self):
+        return f"Version({self})"
+
+class VersionIndex(object):
+    """Every version tag of a repo, parsed and sorted, so lookups don't depend on the order tags are listed in."""
+
+    def __init__(self, tag_names):
+        self.versions = sorted({version for version in map(Version.parse, tag_names) if version is not None})
+
+    @classmethod
+    def from_github(cls, repo, client=None):
+        return cls(tag['name'] for tag in (client or github).get_all_pages(f'/repos/{repo}/tags'))
+
+    @classmethod
+    def from_git(cls, cwd='.'):
+        """Builds the index from the tags in a local clone, without any network access."""
+        return cls(subprocess.run(['git', 'tag', '--list', 'v*'], cwd=cwd, check=True, capture_output=True, text=True).stdout.split())
+
+    def latest_mainline(self):
+        return next((version for version in reversed(self.versions) if not version.is_rc), None)
+
+    def latest_rc(self, base=None):
+        """The latest release candidate, optionally only among those for the given base version (e.g. v1.2.3)."""
+        base = Version.parse(base) if isinstance(base, str) else base
+        return next((version for version in reversed(self.versions)
+                     if version.is_rc and (base is None or version.base == base.base)), None)
+
+    def next_after(self, version):
+        version = Version.parse(version) if isinstance(version, str) else version
+        return next((candidate for candidate in self.versions if candidate > version), None)
+
 def parse_command_line_arguments():
     parser = argparse.ArgumentParser(description='Tag the code ready for a release.\n' +
                                                  '; '.join(option.upper() + ': ' + description for option, description in semver_options.items()) + ".")
     parser.add_argument('--app', choices=['major', 'minor', 'patch', 'rc'], help='Set the semver update type for the App')
     parser.add_argument('--api', choices=semver_options.keys(), help='Set the semver update type for the API')
+    parser.add_argument('--wait-for-ci', type=float, metavar='SECONDS',
+                        help='Wait up to this long for the CI builds of each repo\'s HEAD commit to finish')
+    parser.add_argument('--offline', action='store_true', help='Find the previous versions from local git tags rather than GitHub')
     return parser.parse_args()
 
 def ask_for_update_type_for(service_name):
@@ -56,41 +200,78 @@ def get_update_description_from_user(cli_input):
             update_description[service_name] = ask_for_update_type_for(service_name)
     return update_description
 
-def get_versions_from_github():
-    app_mainline = [x['name'] for x in requests.get('https://api.github.com/repos/isaacphysics/isaac-react-app/tags').json() if 'rc' not in x['name']][0]
-    api_mainline = [x['name'] for x in requests.get('https://api.github.com/repos/isaacphysics/isaac-api/tags').json() if 'rc' not in x['name']][0]
-    try:
-        app_rc = [x['name'] for x in requests.get('https://api.github.com/repos/isaacphysics/isaac-react-app/tags').json() if 'rc' in x['name']][0]
-    except IndexError:
-        app_rc = None
-    try:
-        api_rc = [x['name'] for x in requests.get('https://api.github.com/repos/isaacphysics/isaac-api/tags').json() if 'rc' in x['name']][0]
-    except IndexError:
-        api_rc = None
+def get_version_indexes(offline=False):
+    if offline:
+        return {'app': VersionIndex.from_git(), 'api': VersionIndex.from_git(api_working_directory)}
+    with ThreadPoolExecutor(max_workers=len(github_repos)) as executor:
+        futures = {service_name: executor.submit(VersionIndex.from_github, repo) for service_name, repo in github_repos.items()}
+        return {service_name: future.result() for service_name, future in futures.items()}
+
+def get_versions_from_github(offline=False):
+    indexes = get_version_indexes(offline)
+    versions = {}
+    for service_name, index in indexes.items():
+        if index.latest_mainline() is None:
+            print(f"Error: could not find any release tags for the {service_name}.")
+            sys.exit(1)
+        mainline = index.latest_mainline()
+        versions[f'{service_name}-mainline'] = str(mainline)
+        # The release in progress is the one after the latest mainline release; RCs of anything older are stale
+        in_progress = index.next_after(mainline)
+        latest_rc = index.latest_rc(in_progress.base) if in_progress is not None else None
+        versions[f'{service_name}-rc'] = str(latest_rc) if latest_rc else None
+    return versions
+
+build_workflows = {'app': 'node.js.yml', 'api': 'maven.yml'}
+
+CI_WAIT_INITIAL_INTERVAL = 5
+CI_WAIT_MAX_INTERVAL = 60
 
-    return {
-        'app-mainline': app_mainline,
-        'api-mainline': api_mainline,
-        'app-rc': app_rc,
-        'api-rc': api_rc
-    }
+def get_latest_build_run(repo, branch=None, head_sha=None):
+    params = {'head_sha': head_sha} if head_sha else {'branch': branch}
+    runs = github.get(f"/repos/{github_repos[repo]}/actions/workflows/{build_workflows[repo]}/runs", params)['workflow_runs']
+    return runs[0] if runs else None
 
 def get_build_results_from_github(repo, branch):
     conclusion = 'unknown'
     link = None
     try:
-        if repo == 'api':
-            result = requests.get(f"https://api.github.com/repos/isaacphysics/isaac-api/actions/workflows/maven.yml/runs?branch={branch}").json()['workflow_runs'][0]
-            conclusion = result['conclusion']
-            link = result['html_url']
-        elif repo == 'app':
-            result = requests.get(f"https://api.github.com/repos/isaacphysics/isaac-react-app/actions/workflows/node.js.yml/runs?branch={branch}").json()['workflow_runs'][0]
+        if repo in build_workflows:
+            result = get_latest_build_run(repo, branch=branch)
             conclusion = result['conclusion']
             link = result['html_url']
     except Exception as e:
         print(f"Failed to fetch build results from GitHub: {e}")
     return conclusion, link
 
+def wait_for_build_results_from_github(repo, head_sha, timeout):
+    """Polls the build for exactly `head_sha` until it concludes or `timeout` seconds pass, backing off between polls.
+
+    Polls are conditional requests (see GitHubClient), so an unchanged run costs GitHub nothing against the rate limit.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    interval = CI_WAIT_INITIAL_INTERVAL
+    conclusion, link = 'not started', None
+    while True:
+        try:
+            result = get_latest_build_run(repo, head_sha=head_sha)
+            if result is not None:
+                link = result['html_url']
+                conclusion = result['conclusion'] if result['status'] == 'completed' else result['status']
+                if result['status'] == 'completed':
+                    break
+        except Exception as e:
+            print(f"Failed to fetch build results from GitHub: {e}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            conclusion = f'still {conclusion}'
+            break
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, CI_WAIT_MAX_INTERVAL)
+    print(f"The {repo} build of {head_sha[:7]} is {conclusion} (waited {time.monotonic() - started:.0f}s)")
+    return conclusion, link
+
 def increment_version(update_type):
     def repl_matcher(match):
         if update_type != 'none':
@@ -144,25 +325,66 @@ def prompt_user(prompt, warning=True, continue_string='Continue anyway?'):
         elif user_response.lower() == 'y':
             acknowledged = True
 
-def check_app_and_api_are_clean(update_description):
-    for service_name in ['app', 'api']:
-        if update_description[service_name] != 'none':
-            branch = subprocess.run("git rev-parse --abbrev-ref HEAD", **subprocess_options[service_name]).stdout.strip()
-            if branch != 'main':
-                prompt_user(f'The {service_name} repo is not on the "main" branch.')
+def parse_porcelain_v2_status(status_output):
+    """Splits `git status --porcelain=v2 --branch` output into the branch headers and a short-format line per change."""
+    headers, changes = {}, []
+    for line in status_output.splitlines():
+        if line.startswith('# '):
+            key, _, value = line[2:].partition(' ')
+            headers[key] = value
+        elif line.startswith(('1 ', '2 ', 'u ')):
+            # Ordinary, renamed/copied and unmerged entries have 8, 9 and 10 fields before the path respectively
+            fields = line.split(' ', {'1': 8, '2': 9, 'u': 10}[line[0]])
+            changes.append(f"{fields[1].replace('.', ' ')} {fields[-1].replace(chr(9), ' <- ')}")
+        elif line.startswith('? '):
+            changes.append(f"?? {line[2:]}")
+    return headers, changes
+
+def find_repo_problems(service_name, ci_timeout=None):
+    problems = []
+    try:
+        subprocess.run("git fetch", **subprocess_options[service_name])
+    except subprocess.CalledProcessError as e:
+        problems.append(f'`git fetch` failed, so the comparison with the remote may be out of date:\n{e.stderr.strip()}')
+    headers, changes = parse_porcelain_v2_status(subprocess.run("git status --porcelain=v2 --branch", **subprocess_options[service_name]).stdout)
+
+    branch = headers.get('branch.head')
+    if branch != 'main':
+        problems.append(f'The repo is not on the "main" branch (it is on "{branch}").')
+
+    if ci_timeout is not None:
+        head_sha = headers.get('branch.oid')
+        build_conclusion, build_link = wait_for_build_results_from_github(service_name, head_sha, ci_timeout)
+        if build_conclusion != 'success':
+            problems.append(f'The remote build of {head_sha[:7]} on "{branch}" has status "{build_conclusion}"!: {build_link}')
+    else:
+        build_conclusion, build_link = get_build_results_from_github(service_name, branch)
+        if build_conclusion != 'success':
+            problems.append(f'The last remote build for branch "{branch}" finished with status "{build_conclusion}"!: {build_link}')
+
+    upstream = headers.get('branch.upstream')
+    ahead, behind = (abs(int(count)) for count in headers.get('branch.ab', '+0 -0').split())
+    if upstream != 'origin/main':
+        problems.append(f'The repo is tracking {upstream or "no remote branch"} rather than origin/main.')
+    elif ahead or behind:
+        problems.append(f'The repo is {ahead} commit(s) ahead of and {behind} behind origin/main (i.e. you need to `git pull` or push).')
 
-            build_conclusion, build_link = get_build_results_from_github(service_name, branch)
-            if build_conclusion != 'success':
-                prompt_user(f'The last remote build for branch "{branch}" of {service_name} finished with status "{build_conclusion}"!: {build_link}')
+    if changes:
+        problems.append('The repo is reporting the following uncommitted changes or untracked files:\n' + "\n".join(changes))
+    return problems
 
-            subprocess.run("git fetch", **subprocess_options[service_name])
-            diff_with_remote = subprocess.run("git diff origin/main --name-only", **subprocess_options[service_name]).stdout.strip()
-            if len(diff_with_remote) > 0:
-                prompt_user(f'The {service_name} repo does not have the latest changes from the remote branch (i.e. you are not on main or you need to `git pull`).')
+def check_app_and_api_are_clean(update_description, ci_timeout=None):
+    services = [service_name for service_name in ['app', 'api'] if update_description[service_name] != 'none']
+    if not services:
+        return
+    with ThreadPoolExecutor(max_workers=len(services)) as executor:
+        problems = dict(zip(services, executor.map(functools.partial(find_repo_problems, ci_timeout=ci_timeout), services)))
 
-            status = subprocess.run("git status --short", **subprocess_options[service_name]).stdout.strip()
-            if len(status) > 0:
-                prompt_user(f'The {service_name} repo is reporting the following uncommitted changes or untracked files:\n{status}')
+    report = []
+    for service_name in services:
+        report.extend(f'[{service_name}] {problem}' for problem in problems[service_name])
+    if report:
+        prompt_user(f'Found {len(report)} problem(s) with the repos:\n' + "\n".join(report))
 
 def check_user_is_ready_to_release(target_versions, update_description):
     front_end_only = update_description['api'] == 'none'
@@ -172,23 +394,59 @@ def check_user_is_ready_to_release(target_versions, update_description):
             confirmation_string.append(f"{service_name.upper()} ({update_description[service_name]}) {target_versions[service_name]}")
     prompt_user("\n".join(confirmation_string), warning=False, continue_string="Continue?")
 
+PACKAGE_JSON_VERSION_REGEX = re.compile(r'^(?P<prefix>\s*"version"\s*:\s*")(?P<version>[^"]*)(?P<suffix>")', re.MULTILINE)
+POM_SEGUE_VERSION_REGEX = re.compile(r'(?P<prefix><segue\.version>)(?P<version>[^<]*)(?P<suffix></segue\.version>)')
+
+def write_file_atomically(path, content):
+    """Writes to a temporary file alongside `path` and renames it into place, so the file is never left half-written."""
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8', newline='') as temporary_file:
+        temporary_file.write(content)
+    shutil.copymode(path, temporary_path)
+    os.replace(temporary_path, path)
+
+def replace_version_in_file(path, regex, version):
+    # newline='' keeps the file's line endings exactly as they were
+    with open(path, encoding='utf-8', newline='') as file:
+        content = file.read()
+    new_content, replacements = regex.subn(lambda match: f"{match.group('prefix')}{version}{match.group('suffix')}", content, count=1)
+    if replacements == 0:
+        raise ValueError(f'Could not find a version to update in {path}')
+    return new_content
+
+def set_package_json_version(path, version):
+    # Like `npm version`, package.json records the version without the leading "v"
+    version = version[1:] if version.startswith('v') else version
+    with open(path, encoding='utf-8', newline='') as file:
+        content = file.read()
+    expected = dict(json.loads(content), version=version)
+    # Dependencies etc. can have "version" fields of their own, so only replace the one which is the package's
+    for match in PACKAGE_JSON_VERSION_REGEX.finditer(content):
+        new_content = f"{content[:match.start('version')]}{version}{content[match.end('version'):]}"
+        if json.loads(new_content) == expected:
+            write_file_atomically(path, new_content)
+            return
+    raise ValueError(f'Could not find the package version to update in {path}')
+
+def set_dot_env_api_version(path, version):
+    write_file_atomically(path, replace_version_in_file(path, REACT_API_ENV_REGEX, version))
+
+def set_pom_segue_version(path, version):
+    write_file_atomically(path, replace_version_in_file(path, POM_SEGUE_VERSION_REGEX, version))
+
 def set_versions(versions, update_description):
     # Record the App version
     # package.json
-    subprocess.run(f"npm --no-git-tag-version version {versions['app']}", **subprocess_options['app'])
+    set_package_json_version('package.json', versions['app'])
 
     # Record the API version
     if update_description['api'] != 'none':
         # .env
         if not versions['api'].endswith('-SNAPSHOT'):
-            new_content = []
-            with open('.env', 'r') as dot_env_file:
-                new_content = [REACT_API_ENV_REGEX.sub(f"{react_api_env_var_name}={versions['api']}", line) for line in dot_env_file.readlines()]
-            with open('.env', 'w') as dot_env_file:
-                dot_env_file.writelines(new_content)
+            set_dot_env_api_version('.env', versions['api'])
 
         # pom.xml
-        subprocess.run(f"mvn versions:set-property -Dproperty=segue.version -DnewVersion={versions['api']} -DgenerateBackupPoms=false", **subprocess_options['api'])
+        set_pom_segue_version(os.path.join(api_working_directory, 'pom.xml'), versions['api'])
 
 def commit_and_tag_changes(versions, update_description):
     changed_files = {'app': 'package.json .env', 'api': 'pom.xml'}
@@ -212,9 +470,9 @@ if __name__ == '__main__':
     cli_args = parse_command_line_arguments()
     update_description = get_update_description_from_user(cli_args)
 
-    check_app_and_api_are_clean(update_description)
+    check_app_and_api_are_clean(update_description, ci_timeout=cli_args.wait_for_ci)
 
-    most_recent_versions = get_versions_from_github()
+    most_recent_versions = get_versions_from_github(offline=cli_args.offline)
     relevant_recent_versions = get_previous_versions_for_update_type(most_recent_versions, update_description)
     target_versions = update_versions(relevant_recent_versions, update_description)
     check_user_is_ready_to_release(target_versions, update_description)
@@ -0,0 +1,24 @@
+import importlib.util
+import os
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(filename):
+    """Imports one of the scripts in the root of the repo, whose names aren't always valid module names."""
+    spec = importlib.util.spec_from_file_location(filename[:-len('.py')].replace('-', '_'), os.path.join(REPO_ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def deploy():
+    return load_script('deploy.py')
+
+
+@pytest.fixture(scope='module')
+def vrt_in_docker():
+    return load_script('vrt-in-docker.py')
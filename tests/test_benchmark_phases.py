@@ -0,0 +1,46 @@
+import pytest
+
+from conftest import load_script
+
+
+@pytest.fixture(scope='module')
+def benchmark():
+    return load_script('scripts/benchmark-release-tools.py')
+
+
+def step(name, tid, start, duration, prompt_wait=0.0):
+    return {'name': name, 'cat': 'step', 'ph': 'X', 'pid': 1, 'tid': tid, 'ts': round(start * 1e6), 'dur': round(duration * 1e6),
+            'args': {'execution_s': duration - prompt_wait, 'prompt_wait_s': prompt_wait}}
+
+
+def test_nested_steps_are_only_counted_once(benchmark):
+    events = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'main'}},
+        step('get_target_api_version_from_app_image', 0, 0.0, 1.0),
+        step('deploy_live', 0, 1.0, 10.0, prompt_wait=2.0),
+        step('update_config', 0, 1.5, 2.0),
+        step('run_db_migrations', 0, 3.5, 3.0, prompt_wait=2.0),
+        step('get_old_versions', 0, 4.0, 0.5),
+        step('blue_green_cutover', 0, 7.0, 4.0),
+        {'name': 'docker pull', 'cat': 'command', 'ph': 'X', 'pid': 1, 'tid': 0, 'ts': 7_000_000, 'dur': 1_000_000, 'args': {}},
+        # A step which ends when the next starts isn't its parent
+        step('deploy_etl', 0, 11.0, 1.0),
+    ]
+    phases = benchmark.step_phases(events)
+    assert phases == pytest.approx({
+        'get_target_api_version_from_app_image': 1.0,
+        'deploy_live': 10.0 - 2.0 - 2.0 - 1.0 - 4.0,
+        'update_config': 2.0,
+        'run_db_migrations': 3.0 - 2.0 - 0.5,
+        'get_old_versions': 0.5,
+        'blue_green_cutover': 4.0,
+        'deploy_etl': 1.0,
+    })
+    # The phases add up to the time spent in the outermost steps, less waiting for the operator
+    assert sum(phases.values()) == pytest.approx(12.0 - 2.0)
+
+
+def test_steps_on_other_tracks_are_not_nested(benchmark):
+    events = [step('deploy_staging_or_dev', 0, 0.0, 5.0), step('deploy_staging_or_dev', 1, 1.0, 3.0),
+              step('update_config', 1, 1.0, 1.0)]
+    assert benchmark.step_phases(events) == pytest.approx({'deploy_staging_or_dev': 7.0, 'update_config': 1.0})
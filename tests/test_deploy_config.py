@@ -0,0 +1,48 @@
+import subprocess
+
+import pytest
+
+
+@pytest.fixture
+def config_checkout(deploy, tmp_path, monkeypatch):
+    def git(*args):
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+                       cwd=tmp_path, check=True, capture_output=True)
+    git('init', '-q')
+    (tmp_path / '.gitignore').write_text("*.decrypted\n")
+    (tmp_path / 'live.env.enc').write_text("ENC[AES256_GCM,data:one]\n")
+    git('add', '.')
+    git('commit', '-q', '-m', 'Config')
+    monkeypatch.setattr(deploy, 'SOPS_CONFIG_DIRECTORY', str(tmp_path))
+    return tmp_path
+
+
+def test_config_hash_follows_untracked_files(deploy, config_checkout):
+    committed = deploy.encrypted_config_hash()
+    assert deploy.encrypted_config_hash() == committed
+
+    # Ignored files aren't part of the config
+    (config_checkout / 'live.env.decrypted').write_text("SECRET=1\n")
+    assert deploy.encrypted_config_hash() == committed
+
+    (config_checkout / 'dev.env.enc').write_text("ENC[AES256_GCM,data:two]\n")
+    added = deploy.encrypted_config_hash()
+    assert added != committed
+
+    (config_checkout / 'dev.env.enc').write_text("ENC[AES256_GCM,data:three]\n")
+    changed = deploy.encrypted_config_hash()
+    assert changed not in (committed, added)
+
+    (config_checkout / 'dev.env.enc').rename(config_checkout / 'staging.env.enc')
+    assert deploy.encrypted_config_hash() not in (committed, added, changed)
+
+    (config_checkout / 'staging.env.enc').unlink()
+    assert deploy.encrypted_config_hash() == committed
+
+
+def test_config_hash_follows_uncommitted_changes(deploy, config_checkout):
+    committed = deploy.encrypted_config_hash()
+    (config_checkout / 'live.env.enc').write_text("ENC[AES256_GCM,data:changed]\n")
+    assert deploy.encrypted_config_hash() != committed
+    (config_checkout / 'live.env.enc').write_text("ENC[AES256_GCM,data:one]\n")
+    assert deploy.encrypted_config_hash() == committed
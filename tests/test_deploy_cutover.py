@@ -0,0 +1,105 @@
+import pytest
+
+REPO = 'ghcr.io/isaacphysics'
+OLD_RENDERER_IMAGE = f'{REPO}/isaac-phy-app-renderer:v1.1.0'
+NEW_RENDERER_IMAGE = f'{REPO}/isaac-phy-app-renderer:v1.2.0'
+
+
+def container(deploy, name, image, ip='172.20.0.9'):
+    fields = deploy.CONTAINER_NAME_REGEX.match(name).groupdict()
+    return dict(fields, name=name, ip=ip, id=name, image=image, image_id=image, labels={}, created=0, volumes=[], running=True)
+
+
+@pytest.fixture
+def cutover(deploy, monkeypatch):
+    """Runs blue_green_cutover, recording the commands it runs and whether it waited, slept or monitored anything."""
+    calls = []
+    monkeypatch.setattr(deploy, 'ask_to_run_command', lambda command, **kwargs: calls.append(('run', command)))
+    monkeypatch.setattr(deploy, 'wait_until_ready', lambda checks, settings: calls.append(('wait', [check.name for check in checks])) or True)
+    monkeypatch.setattr(deploy.time, 'sleep', lambda seconds: calls.append(('sleep', seconds)))
+
+    class FakeMonitor(object):
+        def __init__(self, checks, **kwargs):
+            self.checks = checks
+
+        def start(self):
+            calls.append(('monitor', [check.name for check in self.checks]))
+            return self
+
+        def stop(self):
+            calls.append(('stop monitor', None))
+            return {check.name: {'longest_gap': 0.0, 'failures': 0, 'requests': 10} for check in self.checks}
+    monkeypatch.setattr(deploy, 'AvailabilityMonitor', FakeMonitor)
+
+    def run(exec_commands, containers=None):
+        monkeypatch.setattr(deploy, 'EXEC', exec_commands)
+        fake = deploy.DockerInventory(socket_path='/nonexistent')
+        if containers is not None:
+            fake._snapshot = {'containers': {record['name']: record for record in containers}, 'images': {}, 'volumes': {}}
+        monkeypatch.setattr(deploy, 'INVENTORY', fake)
+        ctx = {'site': 'sci', 'subject': 'phy', 'app': 'v1.2.0', 'old_app': 'v1.1.0', 'env': 'live',
+               'drain_seconds': 5, 'container_port': 80}
+        deploy.blue_green_cutover(ctx)
+        return calls
+    run.calls = calls
+    return run
+
+
+def test_printed_commands_do_not_wait_drain_or_monitor(deploy, cutover):
+    calls = cutover(exec_commands=False)
+    assert [kind for kind, _ in calls] == ['run'] * 5
+    commands = [command for _, command in calls]
+    assert commands[0] == './compose-live sci v1.2.0 up -d sci-app-live-v1.2.0'
+    # Without the inventory, whether to rename the renderer is left to the shell
+    assert commands[1].startswith('if docker inspect sci-renderer > /dev/null 2>&1 && ')
+    assert f'!= "{NEW_RENDERER_IMAGE}" ]; then docker rm -f sci-renderer-v1.1.0 > /dev/null 2>&1; ' \
+           'docker rename sci-renderer sci-renderer-v1.1.0; fi' in commands[1]
+    assert commands[2:] == ['./compose-live sci v1.2.0 up -d sci-renderer',
+                            '../isaac-router/reload-router-config',
+                            'docker stop sci-app-live-v1.1.0 sci-renderer-v1.1.0 && docker rm sci-renderer-v1.1.0']
+
+
+def test_executed_cutover_waits_drains_and_monitors(deploy, cutover):
+    calls = cutover(exec_commands=True, containers=[
+        container(deploy, 'sci-app-live-v1.1.0', f'{REPO}/isaac-phy-app:v1.1.0'),
+        container(deploy, 'sci-app-live-v1.2.0', f'{REPO}/isaac-phy-app:v1.2.0'),
+        container(deploy, 'sci-renderer', OLD_RENDERER_IMAGE),
+    ])
+    assert calls == [
+        ('monitor', ['sci app', 'sci renderer']),
+        ('run', './compose-live sci v1.2.0 up -d sci-app-live-v1.2.0'),
+        ('run', 'docker rename sci-renderer sci-renderer-v1.1.0'),
+        ('run', './compose-live sci v1.2.0 up -d sci-renderer'),
+        ('wait', ['sci-app-live-v1.2.0', 'sci-renderer']),
+        ('run', '../isaac-router/reload-router-config'),
+        ('sleep', 5),
+        ('run', 'docker stop sci-app-live-v1.1.0 sci-renderer-v1.1.0 && docker rm sci-renderer-v1.1.0'),
+        ('stop monitor', None),
+    ]
+
+
+@pytest.mark.parametrize('containers, expected_move_aside', [
+    # A stale renderer left by an earlier cutover is removed before the rename
+    ([('sci-renderer', OLD_RENDERER_IMAGE), ('sci-renderer-v1.1.0', OLD_RENDERER_IMAGE)],
+     'docker rm -f sci-renderer-v1.1.0 && docker rename sci-renderer sci-renderer-v1.1.0'),
+    # A rerun after the new renderer came up doesn't move it aside again
+    ([('sci-renderer', NEW_RENDERER_IMAGE), ('sci-renderer-v1.1.0', OLD_RENDERER_IMAGE)], None),
+    # Nor does a rerun after the rename but before the new renderer came up
+    ([('sci-renderer-v1.1.0', OLD_RENDERER_IMAGE)], None),
+])
+def test_rerun_after_a_half_finished_cutover(deploy, cutover, monkeypatch, containers, expected_move_aside):
+    # The fake commands don't change the inventory, so the new renderer never appears in it
+    monkeypatch.setattr(deploy, 'container_readiness_check', lambda ctx, name: deploy.ReadinessCheck(name, f'http://{name}/'))
+    calls = cutover(exec_commands=True, containers=[container(deploy, 'sci-app-live-v1.2.0', f'{REPO}/isaac-phy-app:v1.2.0')]
+                    + [container(deploy, name, image) for name, image in containers])
+    commands = [command for kind, command in calls if kind == 'run']
+    assert commands[1] == (expected_move_aside or './compose-live sci v1.2.0 up -d sci-renderer')
+    assert len(commands) == (5 if expected_move_aside else 4)
+
+
+def test_executed_cutover_without_the_inventory_fails_non_interactively(deploy, cutover, monkeypatch):
+    monkeypatch.setattr(deploy, 'INTERACTIVE', False)
+    with pytest.raises(deploy.StepFailed, match='ready'):
+        cutover(exec_commands=True)
+    # The router is never pointed at containers which may not be ready
+    assert ('run', '../isaac-router/reload-router-config') not in cutover.calls
@@ -0,0 +1,134 @@
+import pytest
+
+REPO = 'ghcr.io/isaacphysics'
+
+
+def container(deploy, name, created, running=False, image_id=None, project=None, volumes=()):
+    fields = deploy.CONTAINER_NAME_REGEX.match(name).groupdict()
+    return dict(fields, name=name, ip=None, id=name, image=image_id, image_id=image_id or f"image-of-{name}",
+                labels={'com.docker.compose.project': project} if project else {}, created=created,
+                volumes=list(volumes), running=running)
+
+
+def image(image_id, tags, created, size=100):
+    return {'id': image_id, 'tags': tags, 'labels': {}, 'size': size, 'created': created}
+
+
+@pytest.fixture
+def inventory(deploy, monkeypatch):
+    """Replaces the Docker inventory with one whose snapshot is built from the given containers, images and volumes."""
+    def make(containers=(), images=(), volumes=()):
+        fake = deploy.DockerInventory(socket_path='/nonexistent')
+        fake._snapshot = {
+            'containers': {record['name']: record for record in containers},
+            'images': {key: record for record in images for key in [record['id'], *record['tags']]},
+            'volumes': {volume['Name']: volume for volume in volumes},
+        }
+        monkeypatch.setattr(deploy, 'INVENTORY', fake)
+        return fake
+    return make
+
+
+def removed_versions(plan):
+    return {(group['site'], group['role'], group['env']): group['removed'] for group in plan['groups'] if group['removed']}
+
+
+def kept(plan, site, role, env):
+    group = next(group for group in plan['groups'] if (group['site'], group['role'], group['env']) == (site, role, env))
+    return dict(group['kept'])
+
+
+@pytest.mark.parametrize('keep, running, router_names, expected_removed', [
+    # The most recent version and `keep` before it are kept
+    (2, {'v1.5.0'}, set(), ['v1.2.0', 'v1.1.0']),
+    (0, {'v1.5.0'}, set(), ['v1.4.0', 'v1.3.0', 'v1.2.0', 'v1.1.0']),
+    # Anything running is kept, however old
+    (0, {'v1.5.0', 'v1.1.0'}, set(), ['v1.4.0', 'v1.3.0', 'v1.2.0']),
+    # As is anything the router refers to, even when stopped
+    (0, {'v1.5.0'}, {'sci-app-live-v1.2.0'}, ['v1.4.0', 'v1.3.0', 'v1.1.0']),
+    # Nothing running, so only recency counts
+    (1, set(), set(), ['v1.3.0', 'v1.2.0', 'v1.1.0']),
+])
+def test_versions_kept_by_retention_running_and_router(deploy, inventory, keep, running, router_names, expected_removed):
+    versions = ['v1.1.0', 'v1.2.0', 'v1.3.0', 'v1.4.0', 'v1.5.0']
+    inventory(containers=[container(deploy, f"sci-app-live-{version}", created, running=version in running)
+                          for created, version in enumerate(versions)])
+    plan = deploy.plan_garbage_collection(['sci'], keep, router_names)
+    assert removed_versions(plan).get(('sci', 'app', 'live'), []) == expected_removed
+    assert sorted(container['name'] for container in plan['containers']) == sorted(f"sci-app-live-{version}" for version in expected_removed)
+
+
+def test_reasons_for_keeping_are_reported(deploy, inventory):
+    inventory(containers=[container(deploy, 'sci-api-live-v3.0.0', 1, running=True),
+                          container(deploy, 'sci-api-live-v3.1.0', 2),
+                          container(deploy, 'sci-api-live-v3.2.0', 3)])
+    plan = deploy.plan_garbage_collection(['sci'], 0, {'sci-api-live-v3.1.0'})
+    assert kept(plan, 'sci', 'api', 'live') == {'v3.2.0': ['current'], 'v3.1.0': ['referenced by the router'], 'v3.0.0': ['running']}
+
+
+def test_databases_unversioned_containers_and_other_sites_are_never_removed(deploy, inventory):
+    inventory(containers=[container(deploy, 'sci-pg-live', 1), container(deploy, 'sci-pg-test', 1), container(deploy, 'sci-renderer', 1),
+                          container(deploy, 'ada-app-live-v1.0.0', 1), container(deploy, 'ada-app-live-v1.1.0', 2),
+                          container(deploy, 'sci-app-live-v1.0.0', 1), container(deploy, 'sci-app-live-v1.1.0', 2)])
+    plan = deploy.plan_garbage_collection(['sci'], 0, set())
+    assert [container['name'] for container in plan['containers']] == ['sci-app-live-v1.0.0']
+
+
+@pytest.mark.parametrize('volume_name, mounted_by_remaining, removed', [
+    ('sci-test-old_cache', False, True),
+    ('sci-test-old_cache', True, False),
+    # Database volumes are never removed, even when they belong to a removed container's compose project
+    ('sci-pg-test', False, False),
+    ('ada-pg-live', False, False),
+])
+def test_volumes_removed_only_with_their_compose_project(deploy, inventory, volume_name, mounted_by_remaining, removed):
+    inventory(
+        containers=[container(deploy, 'sci-app-test-old', 1, project='sci-test-old', volumes=[volume_name]),
+                    container(deploy, 'sci-app-test-new', 2, running=True, volumes=[volume_name] if mounted_by_remaining else [])],
+        volumes=[{'Name': volume_name, 'Labels': {'com.docker.compose.project': 'sci-test-old'}},
+                 {'Name': 'unrelated', 'Labels': {}}],
+    )
+    plan = deploy.plan_garbage_collection(['sci'], 0, set())
+    assert [container['name'] for container in plan['containers']] == ['sci-app-test-old']
+    assert plan['volumes'] == ([volume_name] if removed else [])
+
+
+def test_shared_images_are_kept_while_another_site_uses_them(deploy, inventory):
+    inventory(
+        containers=[container(deploy, 'sci-api-live-v3.0.0', 1, image_id='api-3.0'),
+                    container(deploy, 'sci-api-live-v3.1.0', 2, image_id='api-3.1', running=True),
+                    container(deploy, 'ada-api-live-v2.9.0', 1, image_id='api-2.9', running=True),
+                    container(deploy, 'ada-etl-v2.9.0', 1, image_id='etl-2.9')],
+        images=[image('api-2.9', [f"{REPO}/isaac-api:v2.9.0"], 1),
+                image('api-3.0', [f"{REPO}/isaac-api:v3.0.0"], 2),
+                image('api-3.1', [f"{REPO}/isaac-api:v3.1.0"], 3),
+                image('api-3.2', [f"{REPO}/isaac-api:v3.2.0"], 4),
+                image('etl-2.9', [f"{REPO}/isaac-etl:v2.9.0"], 1),
+                image('etl-3.2', [f"{REPO}/isaac-etl:v3.2.0"], 4)],
+    )
+    plan = deploy.plan_garbage_collection(['sci'], 0, set())
+    # v2.9.0 of the API and ETL are older than what sci keeps, but ada's containers still use them
+    assert [record['id'] for record in plan['images']] == ['api-3.0']
+
+
+@pytest.mark.parametrize('tags, removed', [
+    ([f"{REPO}/isaac-phy-app:v1.0.0"], True),
+    # Images also tagged outside the isaac repositories, or for a site not being collected, are left alone
+    ([f"{REPO}/isaac-phy-app:v1.0.0", "example/other:latest"], False),
+    ([f"{REPO}/isaac-ada-app:v1.0.0"], False),
+    ([], False),
+])
+def test_only_isaac_images_for_the_sites_being_collected_are_removed(deploy, inventory, tags, removed):
+    inventory(images=[image('old', tags, 1), image('new', [f"{REPO}/isaac-phy-app:v2.0.0", f"{REPO}/isaac-ada-app:v2.0.0"], 2)])
+    plan = deploy.plan_garbage_collection(['sci'], 0, set())
+    assert [record['id'] for record in plan['images']] == (['old'] if removed else [])
+
+
+def test_router_referenced_names(deploy, tmp_path):
+    (tmp_path / 'sites').mkdir()
+    (tmp_path / 'sites' / 'sci.conf').write_text("upstream app { server sci-app-live-v1.3.0:80; }\n"
+                                                "location /api/v3.0.0/ { proxy_pass http://sci-api-live-v3.0.0:8080/; }\n")
+    (tmp_path / '.git').mkdir()
+    (tmp_path / '.git' / 'ORIG_HEAD').write_text("sci-app-live-v0.0.1")
+    assert deploy.router_referenced_names(str(tmp_path)) == {'sci-app-live-v1.3.0', 'sci-api-live-v3.0.0'}
+    assert deploy.router_referenced_names(str(tmp_path / 'missing')) is None
@@ -0,0 +1,153 @@
+import http.server
+import json
+import socketserver
+import threading
+
+import pytest
+
+REPO = 'ghcr.io/isaacphysics'
+
+ENGINE_DATA = {
+    '/containers/json': [
+        {'Names': ['/sci-app-live-v1.2.0'], 'Id': 'c1', 'Image': f'{REPO}/isaac-phy-app:v1.2.0', 'ImageID': 'sha256:app',
+         'State': 'running', 'Created': 100, 'Labels': {'com.docker.compose.project': 'sci-live'},
+         'Mounts': [{'Type': 'bind', 'Source': '/local'}],
+         'NetworkSettings': {'Networks': {'bridge': {'IPAddress': '172.17.0.2'}, 'isaac': {'IPAddress': '172.20.0.5'}}}},
+        {'Names': ['/sci-pg-live'], 'Id': 'c2', 'Image': 'postgres:16', 'ImageID': 'sha256:pg', 'State': 'exited',
+         'Created': 50, 'Mounts': [{'Type': 'volume', 'Name': 'sci-pg-live'}], 'NetworkSettings': {'Networks': {}}},
+        {'Names': ['/unrelated'], 'Id': 'c3', 'Image': 'busybox', 'ImageID': 'sha256:busybox', 'State': 'running'},
+    ],
+    '/volumes': {'Volumes': [{'Name': 'sci-pg-live'}]},
+    '/images/json': [
+        {'Id': 'sha256:app', 'RepoTags': [f'{REPO}/isaac-phy-app:v1.2.0'], 'Labels': {'apiVersion': 'v4.0.0'},
+         'Size': 100, 'Created': 90},
+        {'Id': 'sha256:dangling', 'RepoTags': None, 'Labels': None},
+    ],
+}
+
+
+class FakeDockerEngine(http.server.BaseHTTPRequestHandler):
+    """Answers from `server.responses` (path -> (status, raw body)), falling back to ENGINE_DATA. A status of None
+    sends the body as the whole raw response."""
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        status, body = self.server.responses.get(path, (200, json.dumps(ENGINE_DATA.get(path, {})).encode()))
+        if status is None:
+            self.wfile.write(body)
+            return
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+@pytest.fixture
+def docker_engine(tmp_path):
+    server = UnixServer(str(tmp_path / 'docker.sock'), FakeDockerEngine)
+    server.responses = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_snapshot_from_the_engine_api(deploy, docker_engine):
+    inventory = deploy.DockerInventory(socket_path=docker_engine.server_address)
+    assert inventory.available()
+
+    app = inventory.container('sci-app-live-v1.2.0')
+    assert (app['site'], app['role'], app['env'], app['version']) == ('sci', 'app', 'live', 'v1.2.0')
+    assert (app['ip'], app['image_id'], app['created'], app['running']) == ('172.20.0.5', 'sha256:app', 100, True)
+    assert app['volumes'] == [] and app['labels'] == {'com.docker.compose.project': 'sci-live'}
+
+    assert inventory.container('sci-pg-live')['volumes'] == ['sci-pg-live']
+    assert inventory.container('unrelated')['site'] is None
+    assert [container['name'] for container in inventory.containers('sci', running=None)] == ['sci-app-live-v1.2.0', 'sci-pg-live']
+    assert inventory.versions('sci', 'app', 'live') == ['v1.2.0']
+    assert inventory.volume_exists('sci-pg-live') and not inventory.volume_exists('ada-pg-live')
+    assert inventory.image_exists(f'{REPO}/isaac-phy-app:v1.2.0') and inventory.image_exists('sha256:dangling')
+    assert inventory.image_label(f'{REPO}/isaac-phy-app:v1.2.0', 'apiVersion') == 'v4.0.0'
+    assert inventory.image_label(f'{REPO}/isaac-api:v4.0.0', 'apiVersion') is None
+
+    # The snapshot is kept until invalidated
+    docker_engine.responses['/volumes'] = (200, b'{"Volumes": []}')
+    assert inventory.volume_exists('sci-pg-live')
+    inventory.invalidate()
+    assert not inventory.volume_exists('sci-pg-live')
+
+
+def test_non_200_status_is_unavailable(deploy, docker_engine):
+    docker_engine.responses['/images/json'] = (500, b'{"message": "server error"}')
+    inventory = deploy.DockerInventory(socket_path=docker_engine.server_address)
+    with pytest.raises(deploy.InventoryUnavailable, match='500'):
+        inventory.snapshot
+    assert not inventory.available()
+
+
+def test_connection_failure_is_unavailable(deploy, tmp_path):
+    inventory = deploy.DockerInventory(socket_path=str(tmp_path / 'missing.sock'))
+    with pytest.raises(deploy.InventoryUnavailable, match='Could not query'):
+        inventory.snapshot
+    assert not inventory.available()
+
+
+@pytest.mark.parametrize('status, body', [
+    # Truncated or otherwise malformed JSON
+    (200, b'[{"Names": ["/sci-app-live-v1.2.0"], "Id": '),
+    (200, b'<html>proxy error</html>'),
+    # Not HTTP at all
+    (None, b'garbage\r\n\r\n'),
+    # The connection closes before the whole body has been sent
+    (None, b'HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n[{"Names": '),
+])
+def test_malformed_responses_are_unavailable(deploy, docker_engine, status, body):
+    docker_engine.responses['/containers/json'] = (status, body)
+    inventory = deploy.DockerInventory(socket_path=docker_engine.server_address)
+    with pytest.raises(deploy.InventoryUnavailable):
+        inventory.snapshot
+    assert not inventory.available()
+
+
+@pytest.fixture
+def prefetch_context(deploy, monkeypatch):
+    monkeypatch.setattr(deploy, 'EXEC', True)
+    monkeypatch.setattr(deploy, 'INTERACTIVE', False)
+    return {'site': 'sci', 'env': 'live', 'app': 'v1.2.0', 'prefetch_parallelism': 2}
+
+
+def test_prefetch_is_skipped_without_the_inventory(deploy, monkeypatch, tmp_path, capsys, prefetch_context):
+    monkeypatch.setattr(deploy, 'INVENTORY', deploy.DockerInventory(socket_path=str(tmp_path / 'missing.sock')))
+    monkeypatch.setattr(deploy, 'pull_images', lambda images, parallelism: pytest.fail('should not pull'))
+
+    deploy.prefetch_images(prefetch_context, ['sci'])
+    assert 'Skipping image prefetch' in capsys.readouterr().out
+    assert 'prefetched_sites' not in prefetch_context
+
+
+def test_prefetch_stops_if_the_inventory_goes_away(deploy, monkeypatch, docker_engine, capsys, prefetch_context):
+    monkeypatch.setattr(deploy, 'INVENTORY', deploy.DockerInventory(socket_path=docker_engine.server_address))
+    pulled = []
+
+    def pull_images(images, parallelism):
+        pulled.append(images)
+        docker_engine.responses['/containers/json'] = (503, b'daemon restarting')
+        deploy.INVENTORY.invalidate()
+        return []
+    monkeypatch.setattr(deploy, 'pull_images', pull_images)
+
+    deploy.prefetch_images(prefetch_context, ['sci'])
+    assert pulled == [[f'{REPO}/isaac-phy-app:v1.2.0']]
+    assert 'Stopped prefetching images' in capsys.readouterr().out
+    assert 'prefetched_sites' not in prefetch_context
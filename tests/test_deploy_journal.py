@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+
+def context(**overrides):
+    return dict({'site': 'sci', 'env': 'staging', 'app': 'v1.2.0', 'api': 'v4.0.0', 'old_app': 'v1.1.0',
+                 'old_api': 'v3.9.0', 'previous_servers_exist': True}, **overrides)
+
+
+def run_step(deploy, journal, ctx, step='find_things', outputs=None, result=True):
+    """Checkpoints a fake step, returning whether it actually ran."""
+    ran = []
+
+    def run():
+        ran.append(step)
+        ctx.update(outputs or {})
+        record['status'] = 'succeeded'
+        return result
+    record = {'step': step, 'env': ctx['env'], 'status': 'running'}
+    assert journal.checkpoint(record, ctx, run) == result
+    return bool(ran)
+
+
+@pytest.fixture
+def journal_path(deploy, tmp_path, monkeypatch):
+    monkeypatch.setattr(deploy, 'EXEC', False)
+    return str(tmp_path / 'journals' / 'sci-staging-v1.2.0.jsonl')
+
+
+def test_round_trip_restores_outputs_and_skips(deploy, journal_path):
+    journal = deploy.DeployJournal(journal_path)
+    assert run_step(deploy, journal, context(), outputs={'test_db_snapshot': '/tmp/snapshot.sql'}, result='done')
+
+    with open(journal_path) as journal_file:
+        entries = [json.loads(line) for line in journal_file]
+    assert [(entry['key'], entry['status']) for entry in entries] == [('sci:staging:find_things', 'started'),
+                                                                      ('sci:staging:find_things', 'completed')]
+    assert entries[1]['inputs'] == {key: context()[key] for key in deploy.JOURNAL_INPUT_KEYS}
+    assert entries[1]['outputs'] == {'test_db_snapshot': '/tmp/snapshot.sql'}
+
+    resumed = deploy.DeployJournal(journal_path, resume=True)
+    ctx = context()
+    assert not run_step(deploy, resumed, ctx, result='done')
+    assert ctx['test_db_snapshot'] == '/tmp/snapshot.sql'
+
+
+@pytest.mark.parametrize('changed', [
+    {'app': 'v1.3.0'},
+    {'old_app': 'v1.0.0'},
+    {'previous_servers_exist': False},
+])
+def test_step_is_run_again_when_its_inputs_changed(deploy, journal_path, capsys, changed):
+    run_step(deploy, deploy.DeployJournal(journal_path), context())
+
+    resumed = deploy.DeployJournal(journal_path, resume=True)
+    assert run_step(deploy, resumed, context(**changed))
+    assert f"for a different {', '.join(changed)}, so running it again" in capsys.readouterr().out
+    # Other steps, and other sites' steps, are still matched separately
+    assert run_step(deploy, resumed, context(), step='other_step')
+    assert run_step(deploy, resumed, context(site='ada'))
+
+
+def test_retagged_app_image_is_a_changed_input(deploy, journal_path, monkeypatch):
+    image = f"{deploy.DOCKER_REPO}/isaac-phy-app:master"
+    fake = deploy.DockerInventory(socket_path='/nonexistent')
+    fake._snapshot = {'containers': {}, 'volumes': {}, 'images': {image: {'id': 'sha256:first', 'labels': {}}}}
+    monkeypatch.setattr(deploy, 'EXEC', True)
+    monkeypatch.setattr(deploy, 'INVENTORY', fake)
+    run_step(deploy, deploy.DeployJournal(journal_path), context(app='master', subject='phy'))
+
+    assert not run_step(deploy, deploy.DeployJournal(journal_path, resume=True), context(app='master', subject='phy'))
+    fake._snapshot['images'][image] = {'id': 'sha256:second', 'labels': {}}
+    assert run_step(deploy, deploy.DeployJournal(journal_path, resume=True), context(app='master', subject='phy'))
+
+
+def test_failed_step_is_run_again(deploy, journal_path):
+    journal = deploy.DeployJournal(journal_path)
+    with pytest.raises(deploy.StepFailed):
+        journal.checkpoint({'step': 'find_things', 'status': 'running'}, context(),
+                           lambda: (_ for _ in ()).throw(deploy.StepFailed("broken")))
+    assert run_step(deploy, deploy.DeployJournal(journal_path, resume=True), context())
+
+
+def test_previous_journal_is_moved_aside_rather_than_truncated(deploy, journal_path, tmp_path, capsys):
+    run_step(deploy, deploy.DeployJournal(journal_path), context())
+    with open(journal_path) as journal_file:
+        previous = journal_file.read()
+
+    deploy.DeployJournal(journal_path)
+    assert 'Moved the previous journal aside' in capsys.readouterr().out
+    with open(journal_path) as journal_file:
+        assert journal_file.read() == ''
+    rotated = [path for path in (tmp_path / 'journals').iterdir() if path.name != 'sci-staging-v1.2.0.jsonl']
+    assert len(rotated) == 1 and rotated[0].read_text() == previous
+
+    # An empty journal has nothing worth keeping
+    deploy.DeployJournal(journal_path)
+    assert len(list((tmp_path / 'journals').iterdir())) == 2
@@ -0,0 +1,145 @@
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+
+def throwaway_postgres_psql():
+    """A psql command for a Postgres database the tests may use, from ISAAC_TEST_PSQL or else a local psql's defaults."""
+    psql = os.environ.get('ISAAC_TEST_PSQL') or ('psql -X -q' if shutil.which('psql') else None)
+    if psql is None:
+        return None
+    connected = subprocess.run(f"{psql} -c 'SELECT 1'", shell=True, capture_output=True, timeout=30).returncode == 0
+    return psql if connected else None
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("CREATE TABLE a (id int); DROP TABLE b;", ["CREATE TABLE a (id int)", "DROP TABLE b"]),
+    ("INSERT INTO t VALUES ('a;b'); SELECT 1", ["INSERT INTO t VALUES ('a;b')", "SELECT 1"]),
+    ("INSERT INTO t VALUES ('it''s; fine');", ["INSERT INTO t VALUES ('it''s; fine')"]),
+    ('SELECT "odd;name" FROM t;', ['SELECT "odd;name" FROM t']),
+    ("UPDATE t SET x = E'\\';';\nCOMMIT;", ["UPDATE t SET x = E'\\';'", "COMMIT"]),
+    ("UPDATE t SET x = e'\\\\'; SELECT 1;", ["UPDATE t SET x = e'\\\\'", "SELECT 1"]),
+    # Outside E'...' strings a backslash is just a character, so the string ends at the next quote
+    ("SELECT 'a\\'; SELECT 1;", ["SELECT 'a\\'", "SELECT 1"]),
+    ("SELECT name'x;y' FROM t;", ["SELECT name'x;y' FROM t"]),
+    ("CREATE FUNCTION f() RETURNS int AS $$ BEGIN RETURN 1; END; $$ LANGUAGE plpgsql; SELECT f();",
+     ["CREATE FUNCTION f() RETURNS int AS $$ BEGIN RETURN 1; END; $$ LANGUAGE plpgsql", "SELECT f()"]),
+    ("DO $body$ BEGIN PERFORM 1; END $body$;", ["DO $body$ BEGIN PERFORM 1; END $body$"]),
+    ("-- a comment; with a semicolon\nSELECT 1; /* another; */ SELECT 2;",
+     ["-- a comment; with a semicolon\nSELECT 1", "/* another; */ SELECT 2"]),
+    ("SELECT 1;\n-- only a comment after the last statement\n", ["SELECT 1"]),
+])
+def test_split_sql_statements(deploy, sql, expected):
+    assert deploy.split_sql_statements(sql) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("BEGIN;\nALTER TABLE t ADD COLUMN c int;\nCOMMIT;", ["ALTER TABLE t ADD COLUMN c int"]),
+    ("START TRANSACTION; UPDATE t SET c = 1; END;", ["UPDATE t SET c = 1"]),
+    ("begin work; UPDATE t SET c = 1; commit transaction;", ["UPDATE t SET c = 1"]),
+    ("-- Run in a transaction\nBEGIN; SELECT 1; ROLLBACK;", ["SELECT 1"]),
+    # Only whole transaction control statements are dropped, not ones inside function bodies
+    ("CREATE FUNCTION f() RETURNS void AS $$ BEGIN END; $$ LANGUAGE plpgsql;",
+     ["CREATE FUNCTION f() RETURNS void AS $$ BEGIN END; $$ LANGUAGE plpgsql"]),
+    ("SELECT 'COMMIT';", ["SELECT 'COMMIT'"]),
+])
+def test_migration_statements_drop_transaction_control(deploy, sql, expected):
+    assert deploy.migration_statements(sql) == expected
+
+
+def test_parse_migration_timings(deploy):
+    output = "\n".join([
+        "Timing is on.",
+        "BEGIN",
+        "Time: 0.123 ms",
+        "SET",
+        "Time: 0.050 ms",
+        "@@migration-statement db_scripts/migrations/2024-01-01-a.sql 0",
+        "ALTER TABLE",
+        "Time: 12.500 ms",
+        "@@migration-statement db_scripts/migrations/2024-01-01-a.sql 1",
+        "UPDATE 10",
+        "Time: 1500.25 ms (00:01.500)",
+        "@@migration-statement db_scripts/migrations/2024-02-01 b.sql 0",
+        "ERROR:  relation \"t\" does not exist",
+    ])
+    assert deploy.parse_migration_timings(output) == [
+        ("db_scripts/migrations/2024-01-01-a.sql", 0, 12.5),
+        ("db_scripts/migrations/2024-01-01-a.sql", 1, 1500.25),
+    ]
+
+
+def test_parse_migration_timings_of_no_output(deploy):
+    assert deploy.parse_migration_timings(None) == []
+
+
+def test_migration_script_round_trips_through_the_timing_parser(deploy):
+    migrations = [{'file': 'a.sql', 'statements': ["UPDATE t SET x = E'\\';'", "SELECT 1"]}]
+    script = deploy.migration_script(migrations, '5s', '5min', commit=False)
+    assert "UPDATE t SET x = E'\\';';\n" in script
+    assert script.splitlines()[2] == "BEGIN;" and script.splitlines()[-1] == "ROLLBACK;"
+    echoes = [line[len("\\echo "):] for line in script.splitlines() if line.startswith("\\echo ")]
+    output = "\n".join(f"{echo}\nOK\nTime: 1.0 ms" for echo in echoes)
+    assert deploy.parse_migration_timings(output) == [('a.sql', 0, 1.0), ('a.sql', 1, 1.0)]
+
+
+@pytest.mark.parametrize('mode, migrations, fails', [
+    ('manual', [], True),
+    ('plan', [], False),
+    ('plan', [{'file': 'a.sql', 'statements': ["SELECT 1"]}], True),
+    ('dry-run', [{'file': 'a.sql', 'statements': ["SELECT 1"]}], True),
+])
+def test_migrations_are_never_left_unapplied_when_running_non_interactively(deploy, monkeypatch, mode, migrations, fails):
+    monkeypatch.setattr(deploy, 'INTERACTIVE', False)
+    monkeypatch.setattr(deploy, 'plan_migrations', lambda ctx: migrations)
+    ctx = {'site': 'sci', 'env': 'live', 'migrations': mode, 'previous_servers_exist': True, 'old_app': 'v1.0.0',
+           'old_app_site': 'sci', 'old_api': 'v2.0.0', 'api': 'v2.1.0'}
+    if fails:
+        with pytest.raises(deploy.StepFailed):
+            deploy.run_db_migrations(ctx)
+    else:
+        deploy.run_db_migrations(ctx)
+
+
+def test_timings_are_kept_from_beyond_the_capture_limit(deploy):
+    # Like psql's output for a long migration, with each statement printing far more than its timing
+    script = ("for index in range(200):\n"
+              "    print(f'@@migration-statement a.sql {index}', 'x' * 1000, f'Time: {index}.5 ms', sep='\\n')")
+    result = deploy.run_streaming_command(f"{shlex.quote(sys.executable)} -c {shlex.quote(script)}",
+                                          print_output=False, keep_lines=deploy.is_migration_timing_line)
+    assert result['return_code'] == 0
+    assert len(result['stdout']) == deploy.CAPTURE_LIMIT
+    timings = deploy.parse_migration_timings("\n".join(result['kept_lines']))
+    assert timings == [('a.sql', index, index + 0.5) for index in range(200)]
+
+
+@pytest.mark.skipif(throwaway_postgres_psql() is None, reason="needs a Postgres to run migrations against (set ISAAC_TEST_PSQL)")
+def test_migrations_against_postgres(deploy, monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(deploy, 'EXEC', True)
+    monkeypatch.setattr(deploy, 'INTERACTIVE', False)
+    monkeypatch.setattr(deploy, 'STATE_DIRECTORY', str(tmp_path))
+    # Temporary tables disappear with psql's session, so nothing is left behind even though this commits
+    migrations = [{'file': 'db_scripts/migrations/2024-01-01-big.sql', 'statements': [
+        "CREATE TEMPORARY TABLE migration_test (id int, note text)",
+        # More output than is captured, so the timings after it are only seen if they are picked out of the stream
+        f"SELECT repeat('x', {deploy.CAPTURE_LIMIT + 1000})",
+        "INSERT INTO migration_test SELECT n, 'it''s; fine' FROM generate_series(1, 1000) AS n",
+    ]}, {'file': 'db_scripts/migrations/2024-02-01-update.sql', 'statements': [
+        "UPDATE migration_test SET id = id + 1",
+        "DO $$ BEGIN PERFORM 1; END; $$",
+    ]}]
+    monkeypatch.setattr(deploy, 'plan_migrations', lambda ctx: migrations)
+    ctx = {'site': 'sci', 'env': 'live', 'migrations': 'apply', 'previous_servers_exist': True, 'old_app': 'v1.0.0',
+           'old_app_site': 'sci', 'old_api': 'v2.0.0', 'api': 'v2.1.0', 'lock_timeout': '5s', 'statement_timeout': '1min',
+           'psql_command': throwaway_postgres_psql()}
+    deploy.run_db_migrations(ctx)
+
+    report = capsys.readouterr().out.split("# Statement timings (slowest first):\n", 1)[1].splitlines()
+    assert len(report) == 6 and report[-1].startswith("# Total statement time")
+    timed = sorted(line.split('ms  ', 1)[1] for line in report[:-1])
+    assert timed == sorted(f"{os.path.basename(migration['file'])} #{index + 1}: {statement[:80]}"
+                           for migration in migrations for index, statement in enumerate(migration['statements']))
@@ -0,0 +1,17 @@
+def test_db_schema_key_follows_the_mounted_scripts(deploy, tmp_path, monkeypatch):
+    scripts = [tmp_path / 'create.sql', tmp_path / 'functions.sql', tmp_path / 'test-{site}-db-schema.sql']
+    monkeypatch.setattr(deploy, 'TEST_DB_INIT_SCRIPTS', [str(path) for path in scripts])
+    scripts[0].write_text("CREATE TABLE a (id int);")
+    scripts[1].write_text("CREATE FUNCTION f() ...;")
+    (tmp_path / 'test-sci-db-schema.sql').write_text("INSERT INTO a VALUES (1);")
+
+    key = deploy.test_db_schema_key({'site': 'sci'})
+    assert key == deploy.test_db_schema_key({'site': 'sci'})
+    assert key != deploy.test_db_schema_key({'site': 'ada'})
+
+    scripts[1].write_text("CREATE FUNCTION f() ... changed;")
+    changed_key = deploy.test_db_schema_key({'site': 'sci'})
+    assert changed_key != key
+
+    (tmp_path / 'test-sci-db-schema.sql').unlink()
+    assert deploy.test_db_schema_key({'site': 'sci'}) not in (key, changed_key)
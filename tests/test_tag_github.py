@@ -0,0 +1,99 @@
+import http.server
+import json
+import threading
+from urllib.parse import urlsplit
+
+import pytest
+
+from conftest import load_script
+
+class StubGitHub(http.server.BaseHTTPRequestHandler):
+    """Serves `server.pages` (path -> (etag, body, next path)) and records the headers of every request it gets."""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        etag, body, next_path = self.server.pages[urlsplit(self.path).path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        if next_path:
+            self.send_header('Link', f'<http://{self.headers["Host"]}{next_path}>; rel="next", <http://{self.headers["Host"]}/last>; rel="last"')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub_github():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubGitHub)
+    server.pages, server.requests = {}, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def load_tag(monkeypatch, tmp_path, stub_github, token=None):
+    monkeypatch.setenv('GITHUB_API_URL', f'http://127.0.0.1:{stub_github.server_address[1]}')
+    if token:
+        monkeypatch.setenv('GITHUB_TOKEN', token)
+    else:
+        monkeypatch.delenv('GITHUB_TOKEN', raising=False)
+    tag = load_script('tag.py')
+    tag.github.cache_directory = str(tmp_path / 'cache')
+    return tag
+
+def test_revalidated_responses_are_served_from_the_cache(monkeypatch, tmp_path, stub_github):
+    tag = load_tag(monkeypatch, tmp_path, stub_github)
+    stub_github.pages['/repos/o/r/actions/runs'] = ('"etag-1"', {'workflow_runs': [{'id': 1}]}, None)
+
+    assert tag.github.get('/repos/o/r/actions/runs') == {'workflow_runs': [{'id': 1}]}
+    assert 'If-None-Match' not in stub_github.requests[0][1]
+
+    # The stub only answers 304 now, so the body can only have come from the cache
+    stub_github.pages['/repos/o/r/actions/runs'] = ('"etag-1"', None, None)
+    assert tag.github.get('/repos/o/r/actions/runs') == {'workflow_runs': [{'id': 1}]}
+    assert stub_github.requests[1][1]['If-None-Match'] == '"etag-1"'
+
+    # A changed resource gets a new ETag, and the new body replaces the cached one
+    stub_github.pages['/repos/o/r/actions/runs'] = ('"etag-2"', {'workflow_runs': []}, None)
+    assert tag.github.get('/repos/o/r/actions/runs') == {'workflow_runs': []}
+    assert tag.github.get('/repos/o/r/actions/runs') == {'workflow_runs': []}
+    assert stub_github.requests[3][1]['If-None-Match'] == '"etag-2"'
+
+@pytest.mark.parametrize('token, expected_authorization', [
+    (None, None),
+    ('', None),
+    ('secret', 'Bearer secret'),
+])
+def test_authorization_is_only_sent_with_a_token(monkeypatch, tmp_path, stub_github, token, expected_authorization):
+    tag = load_tag(monkeypatch, tmp_path, stub_github, token=token)
+    stub_github.pages['/repos/o/r'] = ('"etag"', {}, None)
+
+    tag.github.get('/repos/o/r')
+    assert stub_github.requests[0][1].get('Authorization') == expected_authorization
+
+def test_pagination_follows_every_next_link(monkeypatch, tmp_path, stub_github):
+    tag = load_tag(monkeypatch, tmp_path, stub_github)
+    stub_github.pages.update({
+        '/repos/o/r/tags': ('"p1"', [{'name': 'v1.0.2'}, {'name': 'v1.0.1'}], '/repositories/1/tags?per_page=100&page=2'),
+        '/repositories/1/tags': ('"p2"', [{'name': 'v1.0.0'}], '/repositories/1/tags-3?per_page=100&page=3'),
+        '/repositories/1/tags-3': ('"p3"', [{'name': 'v0.9.0rc1'}], None),
+    })
+
+    names = [item['name'] for item in tag.github.get_all_pages('/repos/o/r/tags')]
+    assert names == ['v1.0.2', 'v1.0.1', 'v1.0.0', 'v0.9.0rc1']
+    assert [path for path, _ in stub_github.requests] == [
+        '/repos/o/r/tags?per_page=100', '/repositories/1/tags?per_page=100&page=2', '/repositories/1/tags-3?per_page=100&page=3']
+
+    # A second walk revalidates each page, and still follows the cached next links
+    assert [item['name'] for item in tag.github.get_all_pages('/repos/o/r/tags')] == names
+    assert [headers.get('If-None-Match') for _, headers in stub_github.requests[3:]] == ['"p1"', '"p2"', '"p3"']
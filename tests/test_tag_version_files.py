@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import load_script
+
+@pytest.fixture(scope='module')
+def tag():
+    return load_script('tag.py')
+
+def write_bytes(path, content):
+    path.write_bytes(content.encode('utf-8'))
+    return path
+
+def test_package_json_version_has_no_leading_v_and_keeps_formatting(tag, tmp_path):
+    package_json = write_bytes(tmp_path / 'package.json',
+                               '{\n  "name": "isaac-react-app",\n  "version":  "3.1.0-SNAPSHOT",\n  "private": true\n}\n')
+    tag.set_package_json_version(str(package_json), 'v3.1.0')
+    assert package_json.read_text() == '{\n  "name": "isaac-react-app",\n  "version":  "3.1.0",\n  "private": true\n}\n'
+
+def test_package_json_nested_version_is_not_touched(tag, tmp_path):
+    original = ('{\r\n  "name": "isaac-react-app",\r\n  "engines": {\r\n    "version": "18"\r\n  },\r\n'
+                '  "version": "3.1.0",\r\n  "overrides": {\r\n    "version": "1.0.0"\r\n  }\r\n}\r\n')
+    package_json = write_bytes(tmp_path / 'package.json', original)
+    tag.set_package_json_version(str(package_json), '3.1.1-SNAPSHOT')
+    assert package_json.read_bytes().decode('utf-8') == original.replace('"version": "3.1.0"', '"version": "3.1.1-SNAPSHOT"')
+
+def test_dot_env_keeps_crlf_line_endings(tag, tmp_path):
+    dot_env = write_bytes(tmp_path / '.env', 'REACT_APP_SITE=sci\r\nREACT_APP_API_VERSION=v3.0.0\r\nOTHER=1\r\n')
+    tag.set_dot_env_api_version(str(dot_env), 'v3.1.0')
+    assert dot_env.read_bytes().decode('utf-8') == 'REACT_APP_SITE=sci\r\nREACT_APP_API_VERSION=v3.1.0\r\nOTHER=1\r\n'
+
+def test_pom_indentation_is_unchanged(tag, tmp_path):
+    original = '<project>\n\t<properties>\n\t\t<segue.version>v3.0.0</segue.version>\n\t\t<java.version>17</java.version>\n\t</properties>\n</project>\n'
+    pom = write_bytes(tmp_path / 'pom.xml', original)
+    tag.set_pom_segue_version(str(pom), 'v3.0.1-SNAPSHOT')
+    assert pom.read_bytes().decode('utf-8') == original.replace('v3.0.0', 'v3.0.1-SNAPSHOT')
+
+@pytest.mark.parametrize('filename, content, setter', [
+    ('package.json', '{\n  "name": "isaac-react-app",\n  "private": true\n}\n', 'set_package_json_version'),
+    ('package.json', '{\n  "engines": {\n    "version": "18"\n  }\n}\n', 'set_package_json_version'),
+    ('.env', 'REACT_APP_SITE=sci\n# REACT_APP_API_VERSION is set elsewhere\n', 'set_dot_env_api_version'),
+    ('pom.xml', '<project>\n  <version>1.0</version>\n</project>\n', 'set_pom_segue_version'),
+])
+def test_original_file_is_left_alone_without_a_match(tag, tmp_path, filename, content, setter):
+    path = write_bytes(tmp_path / filename, content)
+    with pytest.raises(ValueError):
+        getattr(tag, setter)(str(path), 'v3.1.0')
+    assert path.read_bytes().decode('utf-8') == content
+    assert [entry.name for entry in tmp_path.iterdir()] == [filename]
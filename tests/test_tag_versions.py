@@ -0,0 +1,81 @@
+import pytest
+
+from conftest import load_script
+
+@pytest.fixture(scope='module')
+def tag():
+    return load_script('tag.py')
+
+@pytest.mark.parametrize('name, expected', [
+    ('v1.2.3', (1, 2, 3, None)),
+    ('v1.2.3rc1', (1, 2, 3, 1)),
+    ('v10.0.12rc0', (10, 0, 12, 0)),
+    ('v1a2b3', None),
+    ('v1.2', None),
+    ('1.2.3', None),
+    ('v1.2.3-SNAPSHOT', None),
+    ('v1.2.3rc', None),
+])
+def test_parse(tag, name, expected):
+    version = tag.Version.parse(name)
+    assert (None if version is None else (version.major, version.minor, version.patch, version.rc)) == expected
+    if version is not None:
+        assert str(version) == name
+
+@pytest.mark.parametrize('lower, higher', [
+    ('v1.2.3rc1', 'v1.2.3'),
+    ('v1.2.3rc1', 'v1.2.3rc2'),
+    ('v1.2.3rc9', 'v1.2.3rc10'),
+    ('v1.2.3', 'v1.2.4rc0'),
+    ('v1.2.9', 'v1.2.10'),
+    ('v1.9.0', 'v1.10.0rc1'),
+    ('v1.99.99', 'v2.0.0'),
+])
+def test_ordering(tag, lower, higher):
+    assert tag.Version.parse(lower) < tag.Version.parse(higher)
+    assert tag.Version.parse(higher) > tag.Version.parse(lower)
+
+TAGS = ['v1.2.3rc1', 'v1.10.0rc2', 'v1.2.3', 'v1.9.0', 'v1.10.0rc1', 'v1.9.0rc3', 'latest', 'v1a2b3', 'v1.2.4rc1']
+
+@pytest.mark.parametrize('tags, expected', [
+    (TAGS, 'v1.9.0'),
+    (['v1.2.3rc1'], None),
+    ([], None),
+])
+def test_latest_mainline(tag, tags, expected):
+    latest = tag.VersionIndex(tags).latest_mainline()
+    assert (str(latest) if latest else None) == expected
+
+@pytest.mark.parametrize('base, expected', [
+    (None, 'v1.10.0rc2'),
+    ('v1.10.0', 'v1.10.0rc2'),
+    ('v1.10.0rc1', 'v1.10.0rc2'),
+    ('v1.9.0', 'v1.9.0rc3'),
+    ('v1.2.4', 'v1.2.4rc1'),
+    ('v1.11.0', None),
+])
+def test_latest_rc(tag, base, expected):
+    latest = tag.VersionIndex(TAGS).latest_rc(base)
+    assert (str(latest) if latest else None) == expected
+
+@pytest.mark.parametrize('version, expected', [
+    ('v1.2.3rc1', 'v1.2.3'),
+    ('v1.2.3', 'v1.2.4rc1'),
+    ('v1.9.0', 'v1.10.0rc1'),
+    ('v1.10.0rc2', None),
+])
+def test_next_after(tag, version, expected):
+    following = tag.VersionIndex(TAGS).next_after(version)
+    assert (str(following) if following else None) == expected
+
+@pytest.mark.parametrize('tags, expected_rc', [
+    # The RC being bumped belongs to the release after the latest mainline one, not whichever RC is highest
+    (['v1.9.0', 'v1.10.0rc1', 'v1.10.0rc2', 'v1.11.0rc1'], 'v1.10.0rc2'),
+    # An RC of a release that has already gone out isn't a candidate any more
+    (['v1.9.0rc3', 'v1.9.0'], None),
+    (['v1.9.0'], None),
+])
+def test_versions_use_the_rc_of_the_release_in_progress(tag, monkeypatch, tags, expected_rc):
+    monkeypatch.setattr(tag, 'get_version_indexes', lambda offline: {'app': tag.VersionIndex(tags)})
+    versions = tag.get_versions_from_github()
+    assert versions == {'app-mainline': 'v1.9.0', 'app-rc': expected_rc}
@@ -0,0 +1,72 @@
+import pytest
+
+
+@pytest.fixture
+def source_tree(vrt_in_docker, tmp_path, monkeypatch):
+    """A small app under a temporary working directory, with its import graph cached there too."""
+    files = {
+        'src/app/components/Button.tsx': 'import React from "react";\nimport "./Button.scss";\n',
+        'src/app/components/Button.scss': '@use "../../scss/common/colours";\n',
+        'src/scss/common/_colours.scss': '$blue: #00f;\n',
+        'src/app/components/index.ts': 'export * from "./Button";\n',
+        'src/app/pages/Home.tsx': 'import {Button} from "../components";\nconst data = require("./home.json");\n',
+        'src/app/pages/home.json': '{}\n',
+        'src/app/pages/About.tsx': "import {Page} from './Page';\n",
+        'src/app/pages/Page.tsx': 'export const Page = () => null;\n',
+        'src/app/services/theme.ts': 'export const theme = 1;\n',
+        'src/test/pages/Home.cy.tsx': 'import {Home} from "../../app/pages/Home";\n',
+        'src/test/pages/About.cy.tsx': 'import {About} from "../../app/pages/About";\n',
+        'cypress/support/component.tsx': 'import "../../src/app/services/theme";\n',
+    }
+    for path, content in files.items():
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(content)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(vrt_in_docker, 'VRT_CACHE_DIRECTORY', str(tmp_path / 'cache'))
+    monkeypatch.setattr(vrt_in_docker, 'IMPORT_GRAPH_CACHE', str(tmp_path / 'cache' / 'import-graph.json'))
+    return tmp_path
+
+
+@pytest.mark.parametrize('importer, specifier, expected', [
+    ('src/app/pages/Home.tsx', '../components', 'src/app/components/index.ts'),
+    ('src/app/pages/About.tsx', './Page', 'src/app/pages/Page.tsx'),
+    ('src/app/pages/Home.tsx', './home.json', 'src/app/pages/home.json'),
+    ('src/app/components/Button.tsx', './Button.scss', 'src/app/components/Button.scss'),
+    # Sass finds partials by their underscored name
+    ('src/app/components/Button.scss', '../../scss/common/colours', 'src/scss/common/_colours.scss'),
+    # Packages, and files that don't exist, aren't part of the graph
+    ('src/app/components/Button.tsx', 'react', None),
+    ('src/app/pages/Home.tsx', './Missing', None),
+    ('src/app/components/Button.scss', '~bootstrap/scss/bootstrap', None),
+])
+def test_resolve_import(vrt_in_docker, source_tree, importer, specifier, expected):
+    assert vrt_in_docker.resolve_import(importer, specifier) == expected
+
+
+@pytest.mark.parametrize('changes, expected', [
+    ({'src/app/pages/Page.tsx'}, ['src/test/pages/About.cy.tsx']),
+    # Through a barrel file, a stylesheet and a Sass partial
+    ({'src/app/components/Button.tsx'}, ['src/test/pages/Home.cy.tsx']),
+    ({'src/scss/common/_colours.scss'}, ['src/test/pages/Home.cy.tsx']),
+    ({'src/app/pages/home.json', 'src/app/pages/Page.tsx'}, ['src/test/pages/About.cy.tsx', 'src/test/pages/Home.cy.tsx']),
+    # A changed spec runs itself
+    ({'src/test/pages/About.cy.tsx'}, ['src/test/pages/About.cy.tsx']),
+    # Changes outside src that aren't shared affect nothing
+    ({'README.md'}, []),
+    # Shared files, or anything the support files import, mean every spec runs
+    ({'yarn.lock'}, None),
+    ({'cypress/support/component.tsx'}, None),
+    ({'src/app/services/theme.ts'}, None),
+])
+def test_affected_specs(vrt_in_docker, source_tree, monkeypatch, changes, expected):
+    monkeypatch.setattr(vrt_in_docker, 'changed_files', lambda base_ref: set(changes))
+    assert vrt_in_docker.affected_specs('origin/main') == expected
+
+
+def test_import_graph_is_only_rescanned_where_files_changed(vrt_in_docker, source_tree, capsys):
+    vrt_in_docker.build_import_graph()
+    assert "11 files, 11 rescanned" in capsys.readouterr().out
+    (source_tree / 'src/app/pages/About.tsx').write_text("import {Page} from './Page';\nimport '../components';\n")
+    graph = vrt_in_docker.build_import_graph()
+    assert "11 files, 1 rescanned" in capsys.readouterr().out
+    assert graph['src/app/pages/About.tsx'] == ['src/app/components/index.ts', 'src/app/pages/Page.tsx']
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from conftest import load_script
+
+np = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture(scope='module')
+def vrt_report():
+    return load_script('vrt-report.py')
+
+
+def write_png(path, colour, size=(4, 3)):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.new('RGBA', size, colour).save(path)
+
+
+def test_screenshots_sharing_a_name_get_their_own_heatmaps(vrt_report, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for spec_directory, colour in [('test/pages', (255, 0, 0, 255)), ('test/components', (0, 0, 255, 255))]:
+        snapshots = os.path.join('src', spec_directory, '__image_snapshots__', 'sci')
+        write_png(os.path.join(snapshots, 'Homepage.png'), (0, 0, 0, 255))
+        write_png(os.path.join(snapshots, f'Homepage{vrt_report.ACTUAL_SUFFIX}'), colour)
+
+    results = [vrt_report.compare(site, baseline, actual, 'report') for site, baseline, actual in
+               (('sci', *pair) for pair in vrt_report.find_regressions('sci'))]
+    assert sorted(result['heatmap'] for result in results) == [
+        os.path.join('report', 'sci', 'test', 'components', 'Homepage.heatmap.png'),
+        os.path.join('report', 'sci', 'test', 'pages', 'Homepage.heatmap.png'),
+    ]
+    for result in results:
+        with Image.open(result['heatmap']) as heatmap:
+            red, _, _ = heatmap.getpixel((0, 0))
+        # Each heat-map shows its own screenshot's change: red differs by 255 on one, blue on the other
+        assert red == 255
+        assert result['status'] == 'changed' and result['changed_fraction'] == 1.0
+
+
+def test_pixels_missing_from_both_images_are_unchanged(vrt_report, tmp_path):
+    baseline, actual = str(tmp_path / 'src' / 'a.png'), str(tmp_path / 'src' / 'a.actual.png')
+    write_png(baseline, (10, 20, 30, 255), size=(4, 2))
+    write_png(actual, (10, 20, 30, 255), size=(2, 4))
+    result = vrt_report.compare('ada', baseline, actual, str(tmp_path / 'report'))
+    # Only the parts of the 4x4 union covered by exactly one of the images differ
+    assert result['status'] == 'resized' and result['changed_pixels'] == 8
+    # The heat-map stays in the report, even though the screenshot isn't under src/
+    assert os.path.dirname(os.path.dirname(result['heatmap'])) == str(tmp_path / 'report' / 'ada')
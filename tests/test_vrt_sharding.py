@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.mark.parametrize('specs, durations, shard_count, expected', [
+    # Longest first, each onto the least loaded shard
+    (['a', 'b', 'c', 'd'], {'a': 10, 'b': 8, 'c': 5, 'd': 3}, 2, [(['a', 'd'], 13), (['b', 'c'], 13)]),
+    (['a', 'b', 'c'], {'a': 30, 'b': 1, 'c': 1}, 2, [(['a'], 30), (['b', 'c'], 2)]),
+    # Specs without a recorded duration count as the average recorded one
+    (['a', 'b', 'new'], {'a': 4, 'b': 2}, 2, [(['a'], 4), (['new', 'b'], 5)]),
+    # With no durations at all, every spec counts the same, and ties are broken by name
+    (['c', 'b', 'a'], {}, 2, [(['a', 'c'], 2), (['b'], 1)]),
+    # Shards with nothing to do are left out
+    (['a'], {'a': 1}, 3, [(['a'], 1)]),
+    ([], {}, 2, []),
+])
+def test_partition_specs(vrt_in_docker, specs, durations, shard_count, expected):
+    shards = vrt_in_docker.partition_specs(specs, durations, shard_count)
+    assert [(shard['specs'], shard['expected_seconds']) for shard in shards] == expected
+    assert sorted(spec for shard in shards for spec in shard['specs']) == sorted(specs)
+
+
+def junit(file, suites):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>'
+            f'<testsuite name="Root Suite" file="{file}" time="0" failures="0"/>'
+            + ''.join(f'<testsuite name="{name}" time="{time}" failures="{failures}" errors="{errors}"/>' for name, time, failures, errors in suites)
+            + '</testsuites>')
+
+
+def test_read_junit_results(vrt_in_docker, tmp_path):
+    (tmp_path / 'one.xml').write_text(junit('src/test/a.cy.tsx', [('renders', 1.5, 0, 0), ('scrolls', 2.0, 0, 0)]))
+    (tmp_path / 'two.xml').write_text(junit('src/test/b.cy.tsx', [('renders', 3.0, 1, 0)]))
+    (tmp_path / 'three.xml').write_text(junit('src/test/c.cy.tsx', [('renders', 0.5, 0, 1)]))
+    (tmp_path / 'truncated.xml').write_text('<testsuites><testsuite file="src/test/d.cy.tsx"')
+    (tmp_path / 'no-file.xml').write_text('<testsuites><testsuite name="x" time="1" failures="0"/></testsuites>')
+    (tmp_path / 'notes.txt').write_text('not a result')
+    assert vrt_in_docker.read_junit_results(str(tmp_path)) == {
+        'src/test/a.cy.tsx': {'seconds': 3.5, 'failed': False},
+        'src/test/b.cy.tsx': {'seconds': 3.0, 'failed': True},
+        'src/test/c.cy.tsx': {'seconds': 0.5, 'failed': True},
+    }
+
+
+def test_read_junit_results_of_a_missing_directory(vrt_in_docker, tmp_path):
+    assert vrt_in_docker.read_junit_results(str(tmp_path / 'missing')) == {}
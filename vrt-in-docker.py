@@ -1,15 +1,40 @@
 import os.path
+import glob
+import hashlib
+import json
+import re
+import shutil
 import subprocess
+import sys
+import threading
+import time
 import argparse
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
-def run(site: str, update_baselines: bool, cypress_args):
-    subprocess.run([
+CYPRESS_IMAGE = "cypress/browsers:node-22.21.0-chrome-141.0.7390.107-1-ff-144.0-edge-141.0.3537.92-1"
+SPEC_PATTERN = "src/**/*.cy.tsx"
+VRT_CACHE_DIRECTORY = os.path.expanduser("~/.cache/isaac-vrt")
+DEPENDENCY_CACHE_INDEX = os.path.join(VRT_CACHE_DIRECTORY, "dependency-cache.json")
+DEPENDENCY_VOLUME_PREFIX = "isaac_vrt_deps_"
+DEFAULT_DEPENDENCY_CACHE_BUDGET_GB = 10.0
+IMPORT_GRAPH_CACHE = os.path.join(VRT_CACHE_DIRECTORY, "import-graph.json")
+IMPORT_REGEX = re.compile(r"""(?:\bfrom|\bimport|\brequire\s*\(|\bimport\s*\(|@import|@use|@forward)\s*["']([^"']+)["']""")
+SCANNED_EXTENSIONS = (".ts", ".tsx", ".js", ".jsx", ".scss", ".css")
+RESOLVED_EXTENSIONS = ("", ".ts", ".tsx", ".js", ".jsx", ".json", ".scss", ".css")
+# Changes to these affect every spec (the bundler config, Cypress support files, dependencies...), so run the full suite
+SHARED_PATH_PREFIXES = ("config/", "cypress/", "public/", "package.json", "yarn.lock", "tsconfig.json",
+                        "cypress.config.ts", "index-sci.html", "index-ada.html", "docker-entrypoint-vrt.sh")
+
+
+def docker_run_command(site: str, update_baselines: bool, cypress_args, dependency_key: str, volume="visual_testing_local", extra_args=()):
+    return [
         "docker",
         "run",
         "--platform", "linux/amd64",
         "--rm",
         "-w", "/tests",
-        "-v", "visual_testing_local:/tests",
+        "-v", f"{volume}:/tests",
         "-v", f"{os.path.abspath('docker-entrypoint-vrt.sh')}:/tests/docker-entrypoint-vrt.sh",
         "-v", f"{os.path.abspath('./src')}:/tests/src",
         "-v", f"{os.path.abspath('./package.json')}:/tests/package.json",
@@ -21,23 +46,420 @@ def run(site: str, update_baselines: bool, cypress_args):
         "-v", f"{os.path.abspath('./public')}:/tests/public",
         "-v", f"{os.path.abspath('./index-sci.html')}:/tests/index-sci.html",
         "-v", f"{os.path.abspath('./index-ada.html')}:/tests/index-ada.html",
+        "-v", f"{DEPENDENCY_VOLUME_PREFIX}{dependency_key}:/tests/node_modules",
+        *extra_args,
         "-e", f"CYPRESS_SITE={site}",
         "-e", f"CYPRESS_UPDATE_BASELINE={'true' if update_baselines else 'false'}",
         "-e", "CYPRESS_INTERNAL_BROWSER_CONNECT_TIMEOUT=300000",
-        "-e", "CYPRESS_CACHE_FOLDER=/tests/.cache/Cypress",
-        "cypress/browsers:node-22.21.0-chrome-141.0.7390.107-1-ff-144.0-edge-141.0.3537.92-1",
+        # The Cypress binary is installed and verified alongside node_modules, so that every container using this dependency
+        # volume, whichever site or shard it's for, only ever reads the same binary:
+        "-e", "CYPRESS_CACHE_FOLDER=/tests/node_modules/.cache/Cypress",
+        "-e", f"VRT_DEPENDENCY_KEY={dependency_key}",
+        CYPRESS_IMAGE,
         "/tests/docker-entrypoint-vrt.sh",
         *cypress_args
-    ])
+    ]
+
+
+def run(site: str, update_baselines: bool, cypress_args, dependency_key: str):
+    return subprocess.run(docker_run_command(site, update_baselines, cypress_args, dependency_key)).returncode
+
+
+def dependency_cache_key():
+    """Hashes everything that determines the contents of node_modules (and the Cypress binary installed alongside it).
+
+    package.json's own "version" is left out, since it changes on every release without changing any dependencies.
+    """
+    with open("package.json") as package_json_file:
+        package_json = json.load(package_json_file)
+    package_json.pop("version", None)
+    digest = hashlib.sha256(CYPRESS_IMAGE.encode())
+    digest.update(json.dumps(package_json, sort_keys=True).encode())
+    with open("yarn.lock", "rb") as yarn_lock_file:
+        digest.update(yarn_lock_file.read())
+    return digest.hexdigest()[:16]
+
+
+def load_dependency_cache_index():
+    try:
+        with open(DEPENDENCY_CACHE_INDEX) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_dependency_cache_index(index):
+    os.makedirs(VRT_CACHE_DIRECTORY, exist_ok=True)
+    temporary_path = f"{DEPENDENCY_CACHE_INDEX}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
+    os.replace(temporary_path, DEPENDENCY_CACHE_INDEX)
+
+
+def dependencies_installed(dependency_key: str):
+    """Whether the dependency volume for this key exists and an install into it finished, which the entrypoint marks by
+    writing the key to node_modules/.vrt-dependency-key. A volume left by an interrupted install has no marker."""
+    volume = f"{DEPENDENCY_VOLUME_PREFIX}{dependency_key}"
+    if subprocess.run(["docker", "volume", "inspect", volume], capture_output=True).returncode != 0:
+        return False
+    marker = subprocess.run(["docker", "run", "--rm", "-v", f"{volume}:/node_modules:ro", "--entrypoint", "cat", CYPRESS_IMAGE,
+                             "/node_modules/.vrt-dependency-key"], capture_output=True, text=True)
+    return marker.returncode == 0 and marker.stdout.strip() == dependency_key
+
+
+def prepare_dependencies(dependency_key: str):
+    """Makes sure the dependency volume for this key has been installed, returning whether it was already there."""
+    volume = f"{DEPENDENCY_VOLUME_PREFIX}{dependency_key}"
+    hit = dependencies_installed(dependency_key)
+    if not hit:
+        print(f"Dependency cache miss for {dependency_key}: installing into {volume}")
+        subprocess.run(["docker", "volume", "create", "--label", f"isaac-vrt-dependency-key={dependency_key}", volume],
+                       check=True, capture_output=True)
+        # Install once up front, so that containers sharing the volume (e.g. shards) never install into it concurrently
+        install = subprocess.run(docker_run_command("sci", False, [], dependency_key, extra_args=["-e", "VRT_INSTALL_ONLY=true"]))
+        if install.returncode != 0:
+            subprocess.run(["docker", "volume", "rm", volume], capture_output=True)
+            print("Failed to install dependencies")
+            sys.exit(1)
+    else:
+        print(f"Dependency cache hit for {dependency_key}: reusing {volume}")
+
+    index = load_dependency_cache_index()
+    entry = index.setdefault(dependency_key, {"hits": 0, "misses": 0})
+    entry["hits" if hit else "misses"] += 1
+    entry["last_used"] = time.time()
+    save_dependency_cache_index(index)
+    print(f"Dependency cache: {sum(entry['hits'] for entry in index.values())} hits, "
+          f"{sum(entry['misses'] for entry in index.values())} misses across {len(index)} cached dependency sets")
+    return hit
+
+
+def parse_docker_size(size: str):
+    units = {"B": 1, "kB": 1e3, "KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12}
+    for unit in sorted(units, key=len, reverse=True):
+        if size.endswith(unit):
+            try:
+                return float(size[:-len(unit)]) * units[unit]
+            except ValueError:
+                break
+    return 0.0
+
+
+def evict_dependency_volumes(current_key: str, budget_bytes: float):
+    """Removes the least recently used dependency volumes (other than the current one) until they fit in the budget."""
+    disk_usage = subprocess.run(["docker", "system", "df", "-v", "--format", "json"], capture_output=True, text=True)
+    if disk_usage.returncode != 0:
+        print("Could not measure the dependency cache, so nothing was evicted")
+        return
+    volumes = {volume["Name"]: volume for volume in json.loads(disk_usage.stdout or "{}").get("Volumes") or []
+               if volume["Name"].startswith(DEPENDENCY_VOLUME_PREFIX)}
+    total = sum(parse_docker_size(volume["Size"]) for volume in volumes.values())
+    index = load_dependency_cache_index()
+    least_recently_used = sorted(volumes, key=lambda name: index.get(name[len(DEPENDENCY_VOLUME_PREFIX):], {}).get("last_used", 0))
+    for name in least_recently_used:
+        if total <= budget_bytes:
+            break
+        key = name[len(DEPENDENCY_VOLUME_PREFIX):]
+        if key == current_key or int(volumes[name].get("Links") or 0) > 0:
+            continue
+        if subprocess.run(["docker", "volume", "rm", name], capture_output=True).returncode == 0:
+            total -= parse_docker_size(volumes[name]["Size"])
+            index.pop(key, None)
+            print(f"Evicted dependency cache {key} ({volumes[name]['Size']})")
+    save_dependency_cache_index(index)
+    print(f"Dependency cache is using {total / 1e9:.1f}GB of its {budget_bytes / 1e9:.1f}GB budget")
+
+
+def resolve_import(importer: str, specifier: str):
+    """Resolves an import to a file under src the way the bundler (or Sass) would, or returns None for packages."""
+    is_style = importer.endswith((".scss", ".css"))
+    if not specifier.startswith(".") and not (is_style and ":" not in specifier and not specifier.startswith("~")):
+        return None
+    base = os.path.normpath(os.path.join(os.path.dirname(importer), specifier))
+    candidates = [base + extension for extension in RESOLVED_EXTENSIONS]
+    candidates += [os.path.join(base, "index" + extension) for extension in RESOLVED_EXTENSIONS[1:]]
+    if is_style:
+        candidates += [os.path.join(os.path.dirname(base), "_" + os.path.basename(base) + extension) for extension in ("", ".scss")]
+    return next((candidate for candidate in candidates if os.path.isfile(candidate)), None)
+
+
+def build_import_graph():
+    """Maps each source file under src and cypress/support to the files it imports.
+
+    The graph is cached, and only files whose size or modification time have changed since the last run are rescanned.
+    """
+    try:
+        with open(IMPORT_GRAPH_CACHE) as graph_file:
+            cached = json.load(graph_file)
+    except (OSError, ValueError):
+        cached = {}
+
+    graph, rescanned = {}, 0
+    for path in glob.glob("src/**/*", recursive=True) + glob.glob("cypress/support/**/*", recursive=True):
+        if not path.endswith(SCANNED_EXTENSIONS) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        entry = cached.get(path)
+        if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+            with open(path, encoding="utf-8", errors="replace") as source_file:
+                specifiers = IMPORT_REGEX.findall(source_file.read())
+            imports = sorted({resolved for resolved in (resolve_import(path, specifier) for specifier in specifiers) if resolved})
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size, "imports": imports}
+            rescanned += 1
+        graph[path] = entry
+
+    os.makedirs(VRT_CACHE_DIRECTORY, exist_ok=True)
+    temporary_path = f"{IMPORT_GRAPH_CACHE}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as graph_file:
+        json.dump(graph, graph_file)
+    os.replace(temporary_path, IMPORT_GRAPH_CACHE)
+    print(f"Import graph: {len(graph)} files, {rescanned} rescanned")
+    return {path: entry["imports"] for path, entry in graph.items()}
+
+
+def changed_files(base_ref: str):
+    """Lists files that differ between the working tree (including untracked files) and where it branched from base_ref."""
+    def git(*args):
+        return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout
+    merge_base = git("merge-base", base_ref, "HEAD").strip()
+    return set(git("diff", "--name-only", merge_base).split("\n") + git("ls-files", "--others", "--exclude-standard").split("\n")) - {""}
+
+
+def affected_specs(base_ref: str):
+    """Returns the specs that transitively import a changed file, or None if the full suite should run."""
+    changes = changed_files(base_ref)
+    shared_changes = sorted(path for path in changes if path.startswith(SHARED_PATH_PREFIXES))
+    if shared_changes:
+        print(f"Shared files changed ({', '.join(shared_changes[:5])}{', ...' if len(shared_changes) > 5 else ''}): running every spec")
+        return None
+
+    importers = {}
+    for path, imports in build_import_graph().items():
+        for imported in imports:
+            importers.setdefault(imported, set()).add(path)
+    affected, to_visit = set(), [os.path.normpath(path) for path in changes if path.startswith("src/")]
+    while to_visit:
+        path = to_visit.pop()
+        if path not in affected:
+            affected.add(path)
+            to_visit.extend(importers.get(path, ()))
+    # Every spec loads the support files, so anything they import is shared too
+    affected_support_files = sorted(path for path in affected if path.startswith("cypress/support/"))
+    if affected_support_files:
+        print(f"Changes reach {', '.join(affected_support_files)}, which every spec loads: running every spec")
+        return None
+    specs = sorted(path for path in affected if path.endswith(".cy.tsx") and os.path.isfile(path))
+    print(f"{len(changes)} changed files since {base_ref} affect {len(specs)} specs")
+    return specs
+
+
+def durations_path(site: str):
+    return os.path.join(VRT_CACHE_DIRECTORY, f"durations-{site}.json")
+
+
+def load_spec_durations(site: str):
+    try:
+        with open(durations_path(site)) as durations_file:
+            return json.load(durations_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_spec_durations(site: str, durations):
+    os.makedirs(VRT_CACHE_DIRECTORY, exist_ok=True)
+    temporary_path = f"{durations_path(site)}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as durations_file:
+        json.dump(durations, durations_file, indent=2, sort_keys=True)
+    os.replace(temporary_path, durations_path(site))
+
+
+def partition_specs(specs, durations, shard_count: int):
+    """Greedily assigns the longest specs first to whichever shard has the least work so far.
+
+    Specs without a recorded duration are assumed to take as long as the average recorded spec.
+    """
+    known = [durations[spec] for spec in specs if spec in durations]
+    default_duration = sum(known) / len(known) if known else 1.0
+    shards = [{"specs": [], "expected_seconds": 0.0} for _ in range(shard_count)]
+    for spec in sorted(specs, key=lambda spec: (-durations.get(spec, default_duration), spec)):
+        shard = min(shards, key=lambda shard: shard["expected_seconds"])
+        shard["specs"].append(spec)
+        shard["expected_seconds"] += durations.get(spec, default_duration)
+    return [shard for shard in shards if shard["specs"]]
+
+
+def read_junit_results(results_directory: str):
+    """Reads the per-spec JUnit files Cypress writes, returning {spec: {"seconds": ..., "failed": ...}}."""
+    results = {}
+    for junit_path in glob.glob(os.path.join(results_directory, "*.xml")):
+        try:
+            suites = ElementTree.parse(junit_path).getroot().iter("testsuite")
+        except ElementTree.ParseError:
+            continue
+        spec, seconds, failed = None, 0.0, False
+        for suite in suites:
+            spec = spec or suite.get("file")
+            seconds += float(suite.get("time") or 0)
+            failed = failed or int(suite.get("failures") or 0) > 0 or int(suite.get("errors") or 0) > 0
+        if spec:
+            results[spec] = {"seconds": seconds, "failed": failed}
+    return results
+
+
+def stream_with_prefix(process, prefix: str):
+    for line in process.stdout:
+        sys.stdout.write(f"[{prefix}] {line}")
+        sys.stdout.flush()
+
+
+def run_with_prefixed_output(command, prefix: str):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    thread = threading.Thread(target=stream_with_prefix, args=(process, prefix), daemon=True)
+    thread.start()
+    return process, thread
+
+
+def run_in_background(site: str, update_baselines: bool, cypress_args, dependency_key: str, volume: str):
+    process, thread = run_with_prefixed_output(docker_run_command(site, update_baselines, cypress_args, dependency_key, volume=volume), site)
+    return_code = process.wait()
+    thread.join()
+    return return_code == 0, f"Visual regression results for {site}: exit code {return_code}\n{'PASSED' if return_code == 0 else 'FAILED'}"
+
+
+def run_sharded(site: str, update_baselines: bool, cypress_args, dependency_key: str, shard_count: int, specs=None,
+                volume="visual_testing_local", output_prefix=""):
+    specs = specs if specs is not None else sorted(glob.glob(SPEC_PATTERN, recursive=True))
+    durations = load_spec_durations(site)
+    shards = partition_specs(specs, durations, shard_count)
+    started = time.time()
+
+    processes, threads = [], []
+    for index, shard in enumerate(shards):
+        shard["name"] = f"shard-{index + 1}"
+        shard["results_directory"] = os.path.join(VRT_CACHE_DIRECTORY, "results", site, shard["name"])
+        shutil.rmtree(shard["results_directory"], ignore_errors=True)
+        os.makedirs(shard["results_directory"])
+        print(f"{output_prefix}{shard['name']}: {len(shard['specs'])} specs, ~{shard['expected_seconds']:.0f}s expected")
+        command = docker_run_command(
+            site, update_baselines,
+            ["--spec", ",".join(shard["specs"]),
+             "--reporter", "junit", "--reporter-options", "mochaFile=/results/[hash].xml",
+             *cypress_args],
+            dependency_key,
+            volume=f"{volume}_{shard['name']}",
+            extra_args=["-v", f"{shard['results_directory']}:/results"],
+        )
+        process, thread = run_with_prefixed_output(command, f"{output_prefix}{shard['name']}")
+        processes.append(process)
+        threads.append(thread)
+
+    for shard, process, thread in zip(shards, processes, threads):
+        shard["return_code"] = process.wait()
+        thread.join()
+        shard["results"] = read_junit_results(shard["results_directory"])
+
+    return report_sharded_run(site, shards, durations, started)
+
+
+def report_sharded_run(site: str, shards, durations, started: float):
+    """Combines the shards' results, returning whether they all passed and a report to print."""
+    failed_specs, missing_specs = [], []
+    for shard in shards:
+        for spec in shard["specs"]:
+            result = shard["results"].get(spec)
+            if result is None:
+                missing_specs.append(spec)
+                continue
+            durations[spec] = result["seconds"]
+            if result["failed"]:
+                failed_specs.append(spec)
+    save_spec_durations(site, durations)
+
+    snapshot_directory = os.path.join("src", "**", "__image_snapshots__", site)
+    diffs = sorted(path for path in glob.glob(os.path.join(snapshot_directory, "*.diff.png"), recursive=True)
+                   if os.path.getmtime(path) >= started)
+    failed_shards = [shard["name"] for shard in shards if shard["return_code"] != 0]
+
+    report = [f"Visual regression results for {site} ({len(shards)} shards):"]
+    for shard in shards:
+        report.append(f"  {shard['name']}: exit code {shard['return_code']}, {len(shard['specs'])} specs")
+    if failed_specs:
+        report.append("Failed specs:\n" + "\n".join(f"  {spec}" for spec in failed_specs))
+    if missing_specs:
+        report.append("Specs with no results (the shard may have crashed):\n" + "\n".join(f"  {spec}" for spec in missing_specs))
+    if diffs:
+        report.append("Snapshot diffs:\n" + "\n".join(f"  {path}" for path in diffs))
+    succeeded = not (failed_shards or failed_specs or missing_specs)
+    report.append("PASSED" if succeeded else "FAILED")
+    return succeeded, "\n".join(report)
+
+
+def run_site(site: str, args, cypress_args, dependency_key: str, specs, isolated: bool):
+    # When running more than one site at once, each gets its own working volume, so that their builds and results don't
+    # mix. The Cypress binary cache in the dependency volume is deliberately shared (see docker_run_command).
+    volume = f"visual_testing_local_{site}" if isolated else "visual_testing_local"
+    if args.shards:
+        return run_sharded(site=site, update_baselines=args.update_baselines, cypress_args=cypress_args, dependency_key=dependency_key,
+                           shard_count=args.shards, specs=specs, volume=volume, output_prefix=f"{site}/" if isolated else "")
+    spec_args = ["--spec", ",".join(specs)] if specs is not None else []
+    return run_in_background(site, args.update_baselines, spec_args + cypress_args, dependency_key, volume)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run visual regression tests')
-    parser.add_argument('site', type=str, choices=["ada", "sci"])
+    parser.add_argument('site', type=str, choices=["ada", "sci", "both"])
     parser.add_argument(
         '--update-baselines',
         action="store_true",
         help="If provided, the run's results will become the new baselines for you to include in your commit.",
     )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        help="Split the specs across this many containers run in parallel, balanced by previously recorded spec durations.",
+    )
+
+    parser.add_argument(
+        '--dependency-cache-budget',
+        type=float,
+        default=DEFAULT_DEPENDENCY_CACHE_BUDGET_GB,
+        help="How many GB of cached dependency volumes to keep before evicting the least recently used ones.",
+    )
+
+    parser.add_argument(
+        '--affected',
+        action="store_true",
+        help="Only run the specs that depend on files changed since --base-ref (or every spec if shared files changed).",
+    )
+    parser.add_argument('--base-ref', default="origin/main", help="The ref to compare against for --affected.")
+    parser.add_argument(
+        '--report',
+        action="store_true",
+        help="If the run fails, summarise the failed screenshots with vrt-report.py.",
+    )
 
     args, unknown = parser.parse_known_args()
-    run(site=args.site, update_baselines=args.update_baselines, cypress_args=unknown)
+    specs = affected_specs(args.base_ref) if args.affected else None
+    if specs == []:
+        print("No specs are affected by the changes")
+        sys.exit(0)
+    dependency_key = dependency_cache_key()
+    prepare_dependencies(dependency_key)
+    evict_dependency_volumes(dependency_key, args.dependency_cache_budget * 1e9)
+
+    if args.site != "both" and not args.shards:
+        spec_args = ["--spec", ",".join(specs)] if specs is not None else []
+        return_code = run(site=args.site, update_baselines=args.update_baselines, cypress_args=spec_args + unknown, dependency_key=dependency_key)
+    else:
+        sites = ["ada", "sci"] if args.site == "both" else [args.site]
+        with ThreadPoolExecutor(max_workers=len(sites)) as executor:
+            results = list(executor.map(lambda site: run_site(site, args, unknown, dependency_key, specs, isolated=len(sites) > 1), sites))
+        for succeeded, report in results:
+            print(f"\n{report}")
+        if len(sites) > 1:
+            print("\n" + ", ".join(f"{site}: {'PASSED' if succeeded else 'FAILED'}" for site, (succeeded, _) in zip(sites, results)))
+        return_code = 0 if all(succeeded for succeeded, _ in results) else 1
+
+    if return_code != 0 and args.report:
+        subprocess.run([sys.executable, os.path.abspath("vrt-report.py"), args.site])
+    sys.exit(return_code)
@@ -0,0 +1,146 @@
+import os.path
+import glob
+import hashlib
+import html
+import json
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+
+VRT_CACHE_DIRECTORY = os.path.expanduser("~/.cache/isaac-vrt")
+ACTUAL_SUFFIX = ".actual.png"
+
+
+def find_regressions(site: str):
+    """Pairs each actual screenshot the visual regression plugin left behind with the baseline it was compared to."""
+    pattern = os.path.join("src", "**", "__image_snapshots__", site, f"*{ACTUAL_SUFFIX}")
+    return [(actual[:-len(ACTUAL_SUFFIX)] + ".png", actual) for actual in sorted(glob.glob(pattern, recursive=True))]
+
+
+def heatmap_path_for(output_directory: str, site: str, baseline_path: str):
+    """Mirrors the directory of the spec the screenshot came from, as screenshots in different specs can share a name."""
+    spec_directory = os.path.relpath(os.path.dirname(os.path.dirname(os.path.dirname(baseline_path))), "src")
+    if spec_directory.startswith(os.pardir):
+        # Not from under src/, so there is no spec directory to mirror; keep it apart from the others all the same
+        spec_directory = hashlib.sha256(os.path.abspath(baseline_path).encode()).hexdigest()[:12]
+    name = os.path.basename(baseline_path)[:-len(".png")]
+    return os.path.join(output_directory, site, spec_directory, f"{name}.heatmap.png")
+
+
+def load_rgba(path: str):
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGBA"), dtype=np.int16)
+
+
+def compare(site: str, baseline_path: str, actual_path: str, output_directory: str):
+    """Measures how an actual screenshot differs from its baseline, and writes a heat-map of where it differs."""
+    result = {"site": site, "name": os.path.basename(baseline_path)[:-len(".png")], "baseline": baseline_path, "actual": actual_path}
+    actual = load_rgba(actual_path)
+    if not os.path.exists(baseline_path):
+        return dict(result, status="new", changed_pixels=int(actual.shape[0] * actual.shape[1]), changed_fraction=1.0,
+                    max_channel_delta=255, mean_channel_delta=255.0, bounding_box=[0, 0, actual.shape[1], actual.shape[0]], heatmap=None)
+    baseline = load_rgba(baseline_path)
+
+    # Compare over the union of the two sizes, treating pixels outside either image as completely different
+    height, width = max(baseline.shape[0], actual.shape[0]), max(baseline.shape[1], actual.shape[1])
+    padded = np.full((2, height, width, 4), -255, dtype=np.int16)
+    padded[0, :baseline.shape[0], :baseline.shape[1]] = baseline
+    padded[1, :actual.shape[0], :actual.shape[1]] = actual
+    delta = np.minimum(np.abs(padded[1] - padded[0]).max(axis=-1), 255)
+    changed = delta > 0
+
+    changed_pixels = int(changed.sum())
+    rows, columns = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    bounding_box = [int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1] if changed_pixels else None
+
+    # Dim a greyscale copy of the actual image and paint the size of each pixel's change over it in red
+    greyscale = padded[1, :, :, :3].clip(0, 255).mean(axis=-1) * 0.3
+    heatmap = np.stack([np.maximum(greyscale, delta), greyscale, greyscale], axis=-1).astype(np.uint8)
+    heatmap_path = heatmap_path_for(output_directory, site, baseline_path)
+    os.makedirs(os.path.dirname(heatmap_path), exist_ok=True)
+    Image.fromarray(heatmap, "RGB").save(heatmap_path)
+
+    return dict(
+        result,
+        status="resized" if baseline.shape != actual.shape else "changed" if changed_pixels else "identical",
+        baseline_size=[baseline.shape[1], baseline.shape[0]],
+        actual_size=[actual.shape[1], actual.shape[0]],
+        changed_pixels=changed_pixels,
+        changed_fraction=changed_pixels / float(height * width),
+        max_channel_delta=int(delta.max()),
+        mean_channel_delta=float(delta[changed].mean()) if changed_pixels else 0.0,
+        bounding_box=bounding_box,
+        heatmap=heatmap_path,
+    )
+
+
+def severity(result):
+    """Orders regressions so that new or resized screenshots come first, then the largest and strongest changes."""
+    return result["status"] in ("new", "resized"), result["changed_fraction"], result["max_channel_delta"]
+
+
+def write_html_report(results, output_directory: str):
+    def image_link(path):
+        if not path:
+            return ""
+        relative_path = html.escape(os.path.relpath(os.path.abspath(path), output_directory))
+        return f'<a href="{relative_path}"><img src="{relative_path}" loading="lazy"></a>'
+
+    rows = "\n".join(
+        f"<tr><td>{index + 1}</td><td>{result['site']}</td><td>{html.escape(result['name'])}</td><td>{result['status']}</td>"
+        f"<td>{result['changed_pixels']} ({result['changed_fraction']:.4%})</td><td>{result['max_channel_delta']}</td>"
+        f"<td>{result['bounding_box']}</td>"
+        f"<td>{image_link(result['baseline'] if os.path.exists(result['baseline']) else None)}</td>"
+        f"<td>{image_link(result['actual'])}</td><td>{image_link(result['heatmap'])}</td></tr>"
+        for index, result in enumerate(results)
+    )
+    with open(os.path.join(output_directory, "report.html"), "w") as report_file:
+        report_file.write(f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Visual regression report</title>
+<style>body {{ font-family: sans-serif; }} td {{ vertical-align: top; padding: 4px; border-bottom: 1px solid #ccc; }} img {{ max-width: 300px; }}</style>
+</head><body>
+<h1>Visual regression report ({len(results)} screenshots differ)</h1>
+<table><tr><th>#</th><th>Site</th><th>Screenshot</th><th>Status</th><th>Changed pixels</th><th>Max delta</th><th>Bounding box</th>
+<th>Baseline</th><th>Actual</th><th>Heat-map</th></tr>
+{rows}
+</table></body></html>
+""")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarise the screenshots that failed visual regression tests')
+    parser.add_argument('site', type=str, choices=["ada", "sci", "both"], nargs="?", default="both")
+    parser.add_argument('--output', default=os.path.join(VRT_CACHE_DIRECTORY, "report"), help="The directory to write the report to.")
+    parser.add_argument('--processes', type=int, default=None, help="How many processes to compare screenshots with.")
+    args = parser.parse_args()
+
+    if np is None:
+        print("vrt-report.py needs NumPy and Pillow: pip install numpy pillow")
+        sys.exit(1)
+
+    sites = ["ada", "sci"] if args.site == "both" else [args.site]
+    pairs = [(site, baseline, actual) for site in sites for baseline, actual in find_regressions(site)]
+    if not pairs:
+        print("No failed screenshots found")
+        sys.exit(0)
+
+    output_directory = os.path.abspath(args.output)
+    os.makedirs(output_directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        results = list(executor.map(compare, *zip(*pairs), [output_directory] * len(pairs), chunksize=max(1, len(pairs) // 32)))
+    results = sorted((result for result in results if result["status"] != "identical"), key=severity, reverse=True)
+
+    with open(os.path.join(output_directory, "report.json"), "w") as report_file:
+        json.dump(results, report_file, indent=2)
+    write_html_report(results, output_directory)
+
+    for result in results[:10]:
+        print(f"{result['site']} {result['name']}: {result['status']}, {result['changed_pixels']} pixels changed "
+              f"({result['changed_fraction']:.4%}), max delta {result['max_channel_delta']}")
+    print(f"Report written to {os.path.join(output_directory, 'report.html')}")